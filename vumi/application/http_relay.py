@@ -4,12 +4,17 @@ from base64 import b64encode
 
 from twisted.python import log
 from twisted.web import http
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, DeferredList
 
 from vumi.application.base import ApplicationWorker
-from vumi.utils import http_request_full
+from vumi.blinkenlights.metrics import MetricManager, Count
+from vumi.message import from_json
+from vumi.transports.http_dispatcher import OutboundHttpDispatcher
+from vumi.utils import http_request_full, HttpConnectionPool
 from vumi.errors import VumiError
-from vumi.config import ConfigText, ConfigUrl
+from vumi.config import (
+    ConfigText, ConfigUrl, ConfigDict, ConfigInt, ConfigFloat)
 
 
 class HTTPRelayError(VumiError):
@@ -28,6 +33,30 @@ class HTTPRelayConfig(ApplicationWorker.CONFIG_CLASS):
         "HTTP method for submitting messages.", default='POST', static=True)
     auth_method = ConfigText(
         "HTTP authentication method.", default='basic', static=True)
+    http_connection_pool = ConfigDict(
+        "Options for a pool of persistent connections to relay over. May"
+        " contain `max_connections_per_host`, `max_persistent_per_host`,"
+        " `idle_timeout` and `metrics_prefix` (to publish the connection"
+        " reuse rate). If this isn't set, each relayed message uses a new"
+        " connection.", static=True)
+    event_batch_size = ConfigInt(
+        "If more than 1, events are relayed in batches of up to this many,"
+        " POSTed to `event_url` as a JSON list. Batched events are"
+        " acknowledged as soon as they're added to a batch.",
+        default=1, static=True)
+    event_batch_interval = ConfigFloat(
+        "The most seconds to wait for a batch of events to fill up before"
+        " relaying it anyway.", default=0.1, static=True)
+    event_batch_retries = ConfigInt(
+        "The number of times to retry relaying a batch of events that"
+        " couldn't be delivered.", default=0, static=True)
+    event_batch_retry_delay = ConfigFloat(
+        "The delay in seconds before retrying a batch of events. Each retry"
+        " after the first waits twice as long.", default=1.0, static=True)
+    metrics_prefix = ConfigText(
+        "If set, the number of batched events that couldn't be relayed is"
+        " published as the `event_batch.failed` metric with this prefix.",
+        static=True)
 
     username = ConfigText("Username for HTTP authentication.", default='')
     password = ConfigText("Password for HTTP authentication.", default='')
@@ -37,6 +66,9 @@ class HTTPRelayApplication(ApplicationWorker):
     CONFIG_CLASS = HTTPRelayConfig
 
     reply_header = 'X-Vumi-HTTPRelay-Reply'
+    clock = reactor
+    # Batches of events are retried on these responses.
+    event_batch_retry_codes = frozenset([429] + range(500, 600))
 
     def validate_config(self):
         self.supported_auth_methods = {
@@ -51,6 +83,44 @@ class HTTPRelayApplication(ApplicationWorker):
                     'HTTP Authentication method %s not supported' % (
                     repr(config.auth_method,)))
 
+    @inlineCallbacks
+    def setup_application(self):
+        config = self.get_static_config()
+        self.http_pool = HttpConnectionPool.from_config(
+            config.http_connection_pool)
+        self.event_batch_size = config.event_batch_size
+        self.event_batch_interval = config.event_batch_interval
+        self.event_dispatcher = OutboundHttpDispatcher(
+            max_retries=config.event_batch_retries,
+            retry_delay=config.event_batch_retry_delay,
+            retry_codes=self.event_batch_retry_codes,
+            pool=self.http_pool, clock=self.clock)
+        # Events waiting to be relayed, keyed by where and how to relay
+        # them, since that may differ between messages.
+        self._event_batches = {}
+        self._event_batch_call = None
+        self._event_batch_requests = set()
+        self.events_failed = 0
+        self.metrics = None
+        self.events_failed_metric = None
+        if config.metrics_prefix is not None:
+            self.metrics = yield self.start_publisher(
+                MetricManager, config.metrics_prefix)
+            self.events_failed_metric = self.metrics.register(
+                Count('event_batch.failed'))
+        if self.http_pool is not None:
+            yield self.http_pool.start_metrics(self)
+
+    @inlineCallbacks
+    def teardown_application(self):
+        self.flush_event_batches()
+        if self._event_batch_requests:
+            yield DeferredList(list(self._event_batch_requests))
+        if self.metrics is not None:
+            self.metrics.stop()
+        if self.http_pool is not None:
+            yield self.http_pool.closeCachedConnections()
+
     def generate_basic_auth_headers(self, username, password):
         credentials = ':'.join([username, password])
         auth_string = b64encode(credentials.encode('utf-8'))
@@ -69,7 +139,8 @@ class HTTPRelayApplication(ApplicationWorker):
         config = yield self.get_config(message)
         headers = self.get_auth_headers(config)
         response = yield http_request_full(config.url.geturl(),
-                            message.to_json(), headers, config.http_method)
+                            message.to_json(), headers, config.http_method,
+                            pool=self.http_pool)
         headers = response.headers
         if response.code == http.OK:
             if headers.hasHeader(self.reply_header):
@@ -84,9 +155,90 @@ class HTTPRelayApplication(ApplicationWorker):
     @inlineCallbacks
     def relay_event(self, event):
         config = yield self.get_config(event)
+        if self.event_batch_size > 1:
+            self.add_to_event_batch(config, event)
+            return
         headers = self.get_auth_headers(config)
         yield http_request_full(config.event_url.geturl(),
-            event.to_json(), headers, config.http_method)
+            event.to_json(), headers, config.http_method,
+            pool=self.http_pool)
+
+    def add_to_event_batch(self, config, event):
+        key = (config.event_url.geturl(), config.http_method,
+               config.username, config.password)
+        _config, events = self._event_batches.setdefault(key, (config, []))
+        events.append(event)
+        if len(events) >= self.event_batch_size:
+            del self._event_batches[key]
+            self.send_event_batch(config, events)
+        elif self._event_batch_call is None:
+            self._event_batch_call = self.clock.callLater(
+                self.event_batch_interval, self.flush_event_batches)
+
+    def flush_event_batches(self):
+        if self._event_batch_call is not None:
+            if self._event_batch_call.active():
+                self._event_batch_call.cancel()
+            self._event_batch_call = None
+        batches, self._event_batches = self._event_batches, {}
+        for config, events in batches.itervalues():
+            self.send_event_batch(config, events)
+
+    def send_event_batch(self, config, events):
+        """POST a batch of events to the event URL as a JSON list.
+
+        If the response is a JSON list, it's taken to hold a result for
+        each event in the batch, in order, and any result that is an object
+        with an `error` field is logged.
+
+        Batches are retried on a 429 or 5xx response. Events in batches
+        that still fail, and events the response reports errors for, are
+        counted in :attr:`events_failed` (and the `event_batch.failed`
+        metric if `metrics_prefix` is set).
+        """
+        url = config.event_url.geturl()
+        headers = self.get_auth_headers(config)
+        headers['Content-Type'] = ['application/json']
+        body = '[%s]' % (','.join(event.to_json() for event in events),)
+        d = self.event_dispatcher.request(url, body, headers,
+                                          config.http_method)
+        d.addCallback(self.check_event_batch_response, url, events)
+        d.addErrback(self._event_batch_failed, url, events)
+        self._event_batch_requests.add(d)
+        d.addBoth(self._event_batch_done, d)
+        return d
+
+    def _event_batch_done(self, result, d):
+        self._event_batch_requests.discard(d)
+        return result
+
+    def _event_batch_failed(self, failure, url, events):
+        log.err(failure, 'Failed to relay %d events to %s' % (
+            len(events), url))
+        self.count_failed_events(len(events))
+
+    def count_failed_events(self, count):
+        self.events_failed += count
+        if self.events_failed_metric is not None:
+            self.events_failed_metric.set(count)
+
+    def check_event_batch_response(self, response, url, events):
+        if response.code != http.OK:
+            log.err('%s responded with %s to a batch of %d events' % (
+                url, response.code, len(events)))
+            self.count_failed_events(len(events))
+            return
+        try:
+            results = from_json(response.delivered_body)
+        except ValueError:
+            return
+        if not isinstance(results, list):
+            return
+        for event, result in zip(events, results):
+            if isinstance(result, dict) and result.get('error'):
+                log.err('%s failed to process event %s: %s' % (
+                    url, event['event_id'], result['error']))
+                self.count_failed_events(1)
 
     @inlineCallbacks
     def consume_ack(self, event):
@@ -24,7 +24,8 @@ from vumi.application.base import ApplicationWorker
 from vumi.message import Message
 from vumi.errors import ConfigError
 from vumi.persist.txredis_manager import TxRedisManager
-from vumi.utils import load_class_by_string, http_request_full
+from vumi.utils import (
+    load_class_by_string, http_request_full, HttpConnectionPool)
 from vumi import log
 
 
@@ -360,6 +361,7 @@ class RedisResource(SandboxResource):
         self.r_config = self.config.get('redis_manager', {})
         self.keys_per_user = self.config.get('keys_per_user', 100)
         self.redis = yield TxRedisManager.from_config(self.r_config)
+        yield self.redis.start_metrics(self.app_worker)
 
     def teardown(self):
         return self.redis.close_manager()
@@ -475,7 +477,12 @@ class LoggingResource(SandboxResource):
 
 
 class HttpClientResource(SandboxResource):
-    """Resource that allows making HTTP calls to outside services."""
+    """Resource that allows making HTTP calls to outside services.
+
+    If the resource's config has an ``http_connection_pool`` dict, requests
+    are made over a :class:`vumi.utils.HttpConnectionPool` built from it
+    and shared by all the sandboxes using the resource.
+    """
 
     DEFAULT_TIMEOUT = 30  # seconds
     DEFAULT_DATA_LIMIT = 128 * 1024  # 128 KB
@@ -484,6 +491,14 @@ class HttpClientResource(SandboxResource):
         self.timeout = self.config.get('timeout', self.DEFAULT_TIMEOUT)
         self.data_limit = self.config.get('data_limit',
                                           self.DEFAULT_DATA_LIMIT)
+        self.pool = HttpConnectionPool.from_config(
+            self.config.get('http_connection_pool'))
+        if self.pool is not None:
+            return self.pool.start_metrics(self.app_worker)
+
+    def teardown(self):
+        if self.pool is not None:
+            return self.pool.closeCachedConnections()
 
     def _make_request_from_command(self, method, command):
         url = command.get('url', None)
@@ -499,7 +514,7 @@ class HttpClientResource(SandboxResource):
             data = data.encode("utf-8")
         d = http_request_full(url, data=data, headers=headers,
                               method=method, timeout=self.timeout,
-                              data_limit=self.data_limit)
+                              data_limit=self.data_limit, pool=self.pool)
         d.addCallback(self._make_success_reply, command)
         d.addErrback(self._make_failure_reply, command)
         return d
@@ -548,11 +563,11 @@ class SandboxApi(object):
     def sandbox_inbound_message(self, msg):
         self._inbound_messages[msg['message_id']] = msg
         self.sandbox_send(SandboxCommand(cmd="inbound-message",
-                                         msg=msg.payload))
+                                         msg=dict(msg.payload)))
 
     def sandbox_inbound_event(self, event):
         self.sandbox_send(SandboxCommand(cmd="inbound-event",
-                                         msg=event.payload))
+                                         msg=dict(event.payload)))
 
     def sandbox_send(self, msg):
         self._sandbox.send(msg)
@@ -40,24 +40,31 @@ class SessionManager(object):
         if self.gc.running:
             return self.gc.stop()
 
-    def active_sessions(self):
+    def active_sessions(self, chunk_size=100):
         """
         Return a list of active user_ids and associated sessions. Loops over
         known active_sessions, some of which might have auto expired.
         Implements lazy garbage collection, for each entry it checks if
         the user's session still exists, if not it is removed from the set.
+
+        Sessions are loaded ``chunk_size`` at a time in a single pipeline.
         """
         skey = self.r_key('active_sessions')
+        user_ids = list(self.r_server.smembers(skey))
         sessions_to_expire = []
-        for user_id in self.r_server.smembers(skey):
-            ukey = self.r_key('session', user_id)
-            if self.r_server.exists(ukey):
-                yield user_id, self.load_session(user_id)
-            else:
-                sessions_to_expire.append(user_id)
+        for i in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[i:i + chunk_size]
+            pipe = self.r_server.pipeline(transaction=False)
+            for user_id in chunk:
+                pipe.hgetall(self.r_key('session', user_id))
+            for user_id, session in zip(chunk, pipe.execute()):
+                if session:
+                    yield user_id, session
+                else:
+                    sessions_to_expire.append(user_id)
 
         # clear empty ones
-        for user_ids in sessions_to_expire:
+        for user_id in sessions_to_expire:
             self.r_server.srem(skey, user_id)
 
     def r_key(self, *args):
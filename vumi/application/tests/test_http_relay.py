@@ -1,10 +1,13 @@
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, DeferredList)
+from twisted.internet.task import Clock
 from twisted.web import http
 from vumi.application.tests.utils import ApplicationTestCase
-from vumi.tests.utils import TestResourceWorker, get_stubbed_worker
+from vumi.tests.utils import (
+    TestResourceWorker, get_stubbed_worker, LogCatcher)
 from vumi.application.tests.test_http_relay_stubs import TestResource
 from vumi.application.http_relay import HTTPRelayApplication
-from vumi.message import TransportEvent
+from vumi.message import TransportEvent, from_json, to_json
 from base64 import b64decode
 
 
@@ -19,9 +22,9 @@ class HTTPRelayTestCase(ApplicationTestCase):
         self.path = '/path'
 
     @inlineCallbacks
-    def setup_resource_with_callback(self, callback):
+    def setup_resource_with_callback(self, callback, **config):
         self.resource = yield self.make_resource_worker(callback=callback)
-        self.app = yield self.setup_app(self.path, self.resource)
+        self.app = yield self.setup_app(self.path, self.resource, **config)
 
     @inlineCallbacks
     def setup_resource(self, code, content, headers):
@@ -30,14 +33,15 @@ class HTTPRelayTestCase(ApplicationTestCase):
         self.app = yield self.setup_app(self.path, self.resource)
 
     @inlineCallbacks
-    def setup_app(self, path, resource):
-        app = yield self.get_application({
+    def setup_app(self, path, resource, **config):
+        config.update({
             'url': 'http://localhost:%s%s' % (
                 resource.port,
                 path),
             'username': 'username',
             'password': 'password',
         })
+        app = yield self.get_application(config)
         returnValue(app)
 
     @inlineCallbacks
@@ -129,3 +133,123 @@ class HTTPRelayTestCase(ApplicationTestCase):
         yield self.dispatch(delivery_report, rkey=self.rkey('event'))
         self.assertEqual([], self.get_dispatched_messages())
         self.assertEqual([delivery_report], events)
+
+    @inlineCallbacks
+    def setup_batching(self, content='', **config):
+        self.clock = Clock()
+        self.patch(HTTPRelayApplication, 'clock', self.clock)
+        self.batches = []
+        self.batch_received = Deferred()
+
+        def cb(request):
+            self.batches.append((
+                request.requestHeaders.getRawHeaders('Content-Type'),
+                [TransportEvent.from_json(to_json(item))
+                 for item in from_json(request.content.getvalue())]))
+            self.batch_received.callback(None)
+            return content
+
+        yield self.setup_resource_with_callback(cb, **config)
+
+    @inlineCallbacks
+    def test_http_relay_of_batched_events(self):
+        yield self.setup_batching(event_batch_size=2)
+        ack = self.mkmsg_ack()
+        delivery_report = self.mkmsg_delivery()
+        yield self.dispatch(ack, rkey=self.rkey('event'))
+        self.assertEqual(self.batches, [])
+        yield self.dispatch(delivery_report, rkey=self.rkey('event'))
+        yield self.batch_received
+        self.assertEqual(self.batches, [
+            (['application/json'], [ack, delivery_report])])
+
+    @inlineCallbacks
+    def test_http_relay_of_batched_events_after_interval(self):
+        yield self.setup_batching(event_batch_size=10,
+                                  event_batch_interval=5)
+        ack = self.mkmsg_ack()
+        yield self.dispatch(ack, rkey=self.rkey('event'))
+        self.clock.advance(4)
+        self.assertEqual(self.batches, [])
+        self.clock.advance(1)
+        yield self.batch_received
+        self.assertEqual(self.batches, [(['application/json'], [ack])])
+
+    @inlineCallbacks
+    def test_http_relay_of_batched_events_on_teardown(self):
+        yield self.setup_batching(event_batch_size=10)
+        ack = self.mkmsg_ack()
+        yield self.dispatch(ack, rkey=self.rkey('event'))
+        yield self.app.teardown_application()
+        self.assertEqual(self.batches, [(['application/json'], [ack])])
+
+    @inlineCallbacks
+    def test_http_relay_of_batched_events_per_event_url(self):
+        yield self.setup_batching(event_batch_size=10)
+        sent = []
+        self.app.send_event_batch = lambda config, events: sent.append(
+            (config.event_url.geturl(), events))
+        ack = self.mkmsg_ack()
+        delivery_report = self.mkmsg_delivery()
+        config = yield self.app.get_config(ack)
+        other_config = self.app.CONFIG_CLASS(
+            dict(self.app.config, event_url='http://localhost/other'))
+        self.app.add_to_event_batch(config, ack)
+        self.app.add_to_event_batch(other_config, delivery_report)
+        self.app.flush_event_batches()
+        self.assertEqual(sorted(sent), sorted([
+            (config.event_url.geturl(), [ack]),
+            ('http://localhost/other', [delivery_report])]))
+
+    @inlineCallbacks
+    def test_http_relay_of_batched_events_with_item_errors(self):
+        yield self.setup_batching(
+            content='[{"status": "ok"}, {"error": "unknown message"}]',
+            event_batch_size=2)
+        ack = self.mkmsg_ack()
+        delivery_report = self.mkmsg_delivery()
+        with LogCatcher() as lc:
+            yield self.dispatch(ack, rkey=self.rkey('event'))
+            yield self.dispatch(delivery_report, rkey=self.rkey('event'))
+            yield self.batch_received
+            yield self.app.teardown_application()
+        [error] = [' '.join(ev['message']) for ev in lc.errors]
+        self.assertTrue(delivery_report['event_id'] in error)
+        self.assertTrue('unknown message' in error)
+
+    @inlineCallbacks
+    def relay_batch(self, codes, **config):
+        def cb(request):
+            request.setResponseCode(codes.pop(0))
+            return ''
+
+        yield self.setup_resource_with_callback(
+            cb, event_batch_size=2, event_batch_retry_delay=0, **config)
+        yield self.dispatch(self.mkmsg_ack(), rkey=self.rkey('event'))
+        yield self.dispatch(self.mkmsg_delivery(), rkey=self.rkey('event'))
+        yield DeferredList(list(self.app._event_batch_requests))
+
+    @inlineCallbacks
+    def test_http_relay_of_batched_events_retries_server_errors(self):
+        codes = [http.INTERNAL_SERVER_ERROR, http.OK]
+        yield self.relay_batch(codes, event_batch_retries=1)
+        self.assertEqual(codes, [])
+        self.assertEqual(self.app.events_failed, 0)
+
+    @inlineCallbacks
+    def test_http_relay_of_batched_events_counts_failures(self):
+        codes = [http.SERVICE_UNAVAILABLE, http.BAD_GATEWAY]
+        with LogCatcher() as lc:
+            yield self.relay_batch(codes, event_batch_retries=1)
+        self.assertEqual(codes, [])
+        self.assertEqual(self.app.events_failed, 2)
+        self.assertEqual(len(lc.errors), 1)
+
+    @inlineCallbacks
+    def test_http_relay_of_batched_events_failure_metric(self):
+        with LogCatcher():
+            yield self.relay_batch([http.BAD_REQUEST],
+                                   metrics_prefix='vumi.test.')
+        metric = self.app.metrics['event_batch.failed']
+        self.assertEqual(metric.name, 'vumi.test.event_batch.failed')
+        self.assertEqual([value for _, value in metric.poll()], [2])
@@ -644,7 +644,8 @@ class TestHttpClientResource(ResourceTestCaseBase):
                       else self.resource.data_limit)
         args = (url,)
         kw = dict(method=method, headers=headers, data=data,
-                  timeout=timeout, data_limit=data_limit)
+                  timeout=timeout, data_limit=data_limit,
+                  pool=self.resource.pool)
         [(actual_args, actual_kw)] = self._http_requests
         self.assertEqual((actual_args, actual_kw), (args, kw))
 
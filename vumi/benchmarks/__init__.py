@@ -0,0 +1,7 @@
+"""
+Benchmarks for vumi's message handling hot paths.
+
+Run the suite with ``python -m vumi.benchmarks`` (or
+``python -m vumi.benchmarks.runner`` on Python 2.6). Use ``--json`` to write
+the results to a file so they can be compared between releases.
+"""
@@ -0,0 +1,3 @@
+from vumi.benchmarks.runner import run
+
+run()
@@ -0,0 +1,102 @@
+# -*- test-case-name: vumi.benchmarks.tests.test_runner -*-
+
+"""Base classes for benchmarks."""
+
+import time
+
+from twisted.internet.defer import (Deferred, inlineCallbacks, returnValue,
+                                    maybeDeferred)
+
+
+class SkipBenchmark(Exception):
+    """Raised by :meth:`Benchmark.setup` if a benchmark can't run here."""
+
+
+def percentile(sorted_values, fraction):
+    """Return the value ``fraction`` of the way through ``sorted_values``."""
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+class Benchmark(object):
+    """
+    A single timed operation.
+
+    Subclasses set :attr:`name` and implement :meth:`run_once`, which may
+    return a deferred. :meth:`run_once` is called with whatever
+    :meth:`prepare` returns (or its deferred fires with) for the
+    iteration. :meth:`setup`,
+    :meth:`prepare` and :meth:`teardown` are not timed.
+
+    Measurements other than time (e.g. memory used) can be reported by
+    :meth:`get_stats`, which is called after the last iteration.
+    """
+
+    name = None
+    iterations = 1000
+
+    def setup(self):
+        pass
+
+    def teardown(self):
+        pass
+
+    def prepare(self, i):
+        return i
+
+    def run_once(self, i):
+        raise NotImplementedError()
+
+    def get_stats(self):
+        return {}
+
+
+class BenchmarkResult(object):
+    """The timings from running a benchmark."""
+
+    def __init__(self, name, latencies, stats=None):
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.elapsed = sum(latencies)
+        self.stats = stats or {}
+
+    def as_dict(self):
+        latencies = self.latencies
+        return {
+            'name': self.name,
+            'iterations': len(latencies),
+            'elapsed': self.elapsed,
+            'ops_per_sec': (len(latencies) / self.elapsed
+                            if self.elapsed else None),
+            'p50_ms': 1000 * percentile(latencies, 0.5),
+            'p99_ms': 1000 * percentile(latencies, 0.99),
+            'max_ms': 1000 * latencies[-1],
+            'stats': self.stats,
+        }
+
+
+@inlineCallbacks
+def run_benchmark(benchmark, iterations=None):
+    """
+    Run ``benchmark`` and return a deferred that fires with a
+    :class:`BenchmarkResult`.
+    """
+    if iterations is None:
+        iterations = benchmark.iterations
+    yield maybeDeferred(benchmark.setup)
+    try:
+        latencies = []
+        timer = time.time
+        for i in xrange(iterations):
+            arg = benchmark.prepare(i)
+            if isinstance(arg, Deferred):
+                arg = yield arg
+            start = timer()
+            d = benchmark.run_once(arg)
+            if isinstance(d, Deferred):
+                yield d
+            latencies.append(timer() - start)
+        stats = benchmark.get_stats()
+    finally:
+        yield maybeDeferred(benchmark.teardown)
+    returnValue(BenchmarkResult(benchmark.name, latencies, stats))
@@ -0,0 +1,134 @@
+"""Benchmarks for the Redis backed components."""
+
+from datetime import datetime
+
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.benchmarks.base import Benchmark
+from vumi.benchmarks.messages import make_user_message
+from vumi.components.message_store_cache import MessageStoreCache
+from vumi.components.session import SessionManager
+from vumi.components.tagpool import TagpoolManager
+from vumi.components.window_manager import WindowManager
+from vumi.message import TransportEvent
+from vumi.persist.txredis_manager import TxRedisManager
+
+
+class RedisBenchmark(Benchmark):
+    """A benchmark that needs a Redis manager."""
+
+    def __init__(self, redis_config):
+        self.redis_config = redis_config
+
+    @inlineCallbacks
+    def setup(self):
+        redis = yield TxRedisManager.from_config(self.redis_config)
+        self.redis = redis.sub_manager('vumi_benchmarks')
+        yield self.redis._purge_all()
+        yield self.setup_component()
+
+    @inlineCallbacks
+    def teardown(self):
+        yield self.teardown_component()
+        yield self.redis._purge_all()
+        yield self.redis._close()
+
+    def setup_component(self):
+        pass
+
+    def teardown_component(self):
+        pass
+
+
+class MessageStoreCacheInboundBenchmark(RedisBenchmark):
+    name = "message_store_cache.add_inbound_message"
+
+    def setup_component(self):
+        self.cache = MessageStoreCache(self.redis)
+        self.timestamp = datetime.utcnow()
+        return self.cache.batch_start('batch')
+
+    def prepare(self, i):
+        msg = make_user_message(i)
+        msg['timestamp'] = self.timestamp
+        return msg
+
+    def run_once(self, msg):
+        return self.cache.add_inbound_message('batch', msg)
+
+
+class MessageStoreCacheEventBenchmark(RedisBenchmark):
+    name = "message_store_cache.add_event"
+
+    def setup_component(self):
+        self.cache = MessageStoreCache(self.redis)
+        return self.cache.batch_start('batch')
+
+    def prepare(self, i):
+        return TransportEvent(
+            event_type='delivery_report', user_message_id='msg%d' % (i,),
+            delivery_status='delivered', sent_message_id='msg%d' % (i,))
+
+    def run_once(self, event):
+        return self.cache.add_event('batch', event)
+
+
+class WindowManagerBenchmark(RedisBenchmark):
+    """Add an item to a window, take it out and remove it."""
+
+    name = "window_manager.add_and_remove"
+
+    def setup_component(self):
+        self.wm = WindowManager(self.redis, window_size=100)
+        return self.wm.create_window('window')
+
+    def teardown_component(self):
+        self.wm.stop()
+
+    @inlineCallbacks
+    def run_once(self, i):
+        yield self.wm.add('window', {'i': i})
+        key = yield self.wm.get_next_key('window')
+        yield self.wm.get_data('window', key)
+        yield self.wm.remove_key('window', key)
+
+
+class SessionManagerBenchmark(RedisBenchmark):
+    """Create a session and load it again."""
+
+    name = "session_manager.create_and_load"
+
+    def setup_component(self):
+        self.sm = SessionManager(self.redis, max_session_length=600)
+
+    @inlineCallbacks
+    def run_once(self, i):
+        user_id = "2783123%04d" % (i,)
+        yield self.sm.create_session(user_id, state='start')
+        yield self.sm.load_session(user_id)
+
+
+class TagpoolManagerBenchmark(RedisBenchmark):
+    """Acquire a tag and release it again."""
+
+    name = "tagpool_manager.acquire_and_release"
+
+    def setup_component(self):
+        self.tpm = TagpoolManager(self.redis)
+        return self.tpm.declare_tags([('pool', 'tag%d' % (i,))
+                                      for i in range(100)])
+
+    @inlineCallbacks
+    def run_once(self, i):
+        tag = yield self.tpm.acquire_tag('pool')
+        yield self.tpm.release_tag(tag)
+
+
+def get_benchmarks(redis_config):
+    return [
+        MessageStoreCacheInboundBenchmark(redis_config),
+        MessageStoreCacheEventBenchmark(redis_config),
+        WindowManagerBenchmark(redis_config),
+        SessionManagerBenchmark(redis_config),
+        TagpoolManagerBenchmark(redis_config),
+    ]
@@ -0,0 +1,58 @@
+"""Benchmarks for outbound HTTP requests."""
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from vumi.benchmarks.base import Benchmark
+from vumi.utils import http_request_full, HttpConnectionPool
+
+
+class StubResource(Resource):
+    isLeaf = True
+
+    def render(self, request):
+        return "OK"
+
+
+class HttpRequestBenchmark(Benchmark):
+    """
+    POST a message to a local HTTP stub, the way the HTTP transports and
+    the HTTP relay do.
+    """
+
+    name = "http_request_full.new_connection"
+    iterations = 1000
+
+    def make_pool(self):
+        return None
+
+    @inlineCallbacks
+    def setup(self):
+        self.server = yield reactor.listenTCP(
+            0, Site(StubResource()), interface='127.0.0.1')
+        addr = self.server.getHost()
+        self.url = "http://127.0.0.1:%s/" % (addr.port,)
+        self.pool = self.make_pool()
+
+    @inlineCallbacks
+    def teardown(self):
+        if self.pool is not None:
+            yield self.pool.closeCachedConnections()
+        yield self.server.stopListening()
+
+    def run_once(self, i):
+        return http_request_full(self.url, '{"message_id": "%d"}' % (i,),
+                                 pool=self.pool)
+
+
+class PooledHttpRequestBenchmark(HttpRequestBenchmark):
+    name = "http_request_full.pooled"
+
+    def make_pool(self):
+        return HttpConnectionPool()
+
+
+def get_benchmarks():
+    return [HttpRequestBenchmark(), PooledHttpRequestBenchmark()]
@@ -0,0 +1,148 @@
+"""Benchmarks for encoding, decoding, copying and storing messages."""
+
+import gc
+import sys
+import types
+
+from vumi.benchmarks.base import Benchmark, SkipBenchmark
+from vumi.message import (TransportUserMessage, TransportEvent,
+                          CompactTransportUserMessage, CompactTransportEvent,
+                          MESSAGE_CODECS, get_message_codec,
+                          MessageCodecError)
+
+
+def make_user_message(i, msg_class=TransportUserMessage):
+    return msg_class(
+        to_addr="27831234567", from_addr="12345",
+        transport_name="bench", transport_type="sms",
+        content="Message %d" % (i,),
+        transport_metadata={'network': 'bench'},
+        helper_metadata={'tag': {'tag': ['pool', 'tag%d' % (i,)]}})
+
+
+def make_event(i, msg_class=TransportEvent):
+    return msg_class(
+        event_type='ack', user_message_id='%032x' % (i,),
+        sent_message_id='remote-%d' % (i,))
+
+
+def total_size(objects):
+    """
+    Return the number of bytes used by ``objects`` and everything they
+    reference. Objects shared between several messages are only counted
+    once and classes and modules are not counted at all.
+    """
+    seen = set()
+    pending = list(objects)
+    size = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, (type, types.ModuleType)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return size
+
+
+class CodecBenchmark(Benchmark):
+    """Encode or decode a user message with one of the message codecs."""
+
+    sample_size = 100
+
+    def __init__(self, codec_name, operation):
+        self.codec_name = codec_name
+        self.operation = operation
+        self.name = "codec.%s.%s" % (codec_name, operation)
+
+    def setup(self):
+        try:
+            self.codec = get_message_codec(self.codec_name)
+        except MessageCodecError, e:
+            raise SkipBenchmark(str(e))
+        self.messages = [make_user_message(i)
+                         for i in range(self.sample_size)]
+        self.encoded = [msg.encode(self.codec) for msg in self.messages]
+
+    def run_once(self, i):
+        i = i % self.sample_size
+        if self.operation == 'encode':
+            self.messages[i].encode(self.codec)
+        else:
+            TransportUserMessage.decode(self.encoded[i], self.codec)
+
+
+class CodecSizeBenchmark(CodecBenchmark):
+    """Encode a user message and report the encoded size."""
+
+    def __init__(self, codec_name):
+        super(CodecSizeBenchmark, self).__init__(codec_name, 'encode')
+        self.name = "codec.%s.size" % (codec_name,)
+
+    def get_stats(self):
+        sizes = [len(data) for data in self.encoded]
+        return {'bytes_per_message': sum(sizes) / float(len(sizes))}
+
+
+class MessageCopyBenchmark(Benchmark):
+    """Copy a user message and its ack, with Message.copy() or JSON."""
+
+    sample_size = 100
+
+    def __init__(self, method):
+        self.method = method
+        self.name = "message.copy.%s" % (method,)
+
+    def setup(self):
+        self.messages = []
+        for i in range(self.sample_size):
+            self.messages.append(make_user_message(i))
+            self.messages.append(make_event(i))
+
+    def run_once(self, i):
+        msg = self.messages[i % len(self.messages)]
+        if self.method == 'json':
+            msg.from_json(msg.to_json())
+        else:
+            msg.copy()
+
+
+class MessageMemoryBenchmark(Benchmark):
+    """
+    Build messages of one class, keeping them all, and report the memory
+    used per message.
+    """
+
+    iterations = 10000
+
+    def __init__(self, msg_class, make_message):
+        self.msg_class = msg_class
+        self.make_message = make_message
+        self.name = "message.memory.%s" % (msg_class.__name__,)
+
+    def setup(self):
+        self.messages = []
+
+    def teardown(self):
+        self.messages = None
+
+    def run_once(self, i):
+        self.messages.append(self.make_message(i, msg_class=self.msg_class))
+
+    def get_stats(self):
+        size = total_size(self.messages) - sys.getsizeof(self.messages)
+        return {'bytes_per_message': size / float(len(self.messages))}
+
+
+def get_benchmarks():
+    return ([CodecBenchmark(name, operation)
+             for name in sorted(MESSAGE_CODECS)
+             for operation in ('encode', 'decode')] +
+            [CodecSizeBenchmark(name) for name in sorted(MESSAGE_CODECS)] +
+            [MessageCopyBenchmark('copy'), MessageCopyBenchmark('json')] +
+            [MessageMemoryBenchmark(msg_class, make_message)
+             for msg_class, make_message in [
+                 (TransportUserMessage, make_user_message),
+                 (CompactTransportUserMessage, make_user_message),
+                 (TransportEvent, make_event),
+                 (CompactTransportEvent, make_event)]])
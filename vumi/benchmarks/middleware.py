@@ -0,0 +1,47 @@
+"""Benchmarks for passing messages through a middleware stack."""
+
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.benchmarks.base import Benchmark
+from vumi.benchmarks.messages import make_user_message
+from vumi.middleware import MiddlewareStack, setup_middlewares_from_config
+
+
+class MiddlewareStackBenchmark(Benchmark):
+    """
+    Pass a message through a stack of address translation and no-op
+    middleware.
+    """
+
+    stack_size = 5
+
+    def __init__(self, direction):
+        self.direction = direction
+        self.name = "middleware.%s" % (direction,)
+
+    @inlineCallbacks
+    def setup(self):
+        config = {
+            'middleware': [{'translator': 'vumi.middleware.address_translator'
+                            '.AddressTranslationMiddleware'}],
+            'translator': {'outbound_map': {'12345': '54321'}},
+        }
+        for i in range(self.stack_size - 1):
+            config['middleware'].append(
+                {'noop%d' % (i,): 'vumi.middleware.BaseMiddleware'})
+        middlewares = yield setup_middlewares_from_config(None, config)
+        self.stack = MiddlewareStack(middlewares)
+        self.message = make_user_message(0)
+
+    def teardown(self):
+        return self.stack.teardown()
+
+    def run_once(self, i):
+        if self.direction == 'inbound':
+            return self.stack.apply_consume('inbound', self.message, 'bench')
+        return self.stack.apply_publish('outbound', self.message, 'bench')
+
+
+def get_benchmarks():
+    return [MiddlewareStackBenchmark('inbound'),
+            MiddlewareStackBenchmark('outbound')]
@@ -0,0 +1,56 @@
+"""Benchmarks for the persistence models."""
+
+import json
+
+from vumi.benchmarks.base import Benchmark, SkipBenchmark
+from vumi.benchmarks.messages import make_user_message
+
+
+class ModelLoadBenchmark(Benchmark):
+    """
+    Build stored outbound messages from their Riak data and read a few of
+    their fields, the way message store scans do. Nothing is sent to Riak.
+    """
+
+    name = "persist.load_message_fields"
+    iterations = 100000
+    sample_size = 1000
+
+    def setup(self):
+        try:
+            from vumi.components.message_store import OutboundMessage
+            from vumi.persist.txriak_manager import TxRiakManager
+        except ImportError, e:
+            raise SkipBenchmark(str(e))
+        self.model = OutboundMessage
+        self.manager = TxRiakManager.from_config({'bucket_prefix': 'bench.'})
+        self.results = []
+        for i in range(self.sample_size):
+            msg = make_user_message(i)
+            obj = OutboundMessage(self.manager, msg['message_id'], msg=msg,
+                                  batch=None)
+            riak_object = obj._riak_object
+            self.results.append((obj.key, {
+                'metadata': {
+                    'content-type': riak_object.get_content_type(),
+                    'index': [],
+                },
+                'data': json.dumps(riak_object.get_data()).decode('utf-8'),
+            }))
+
+    def prepare(self, i):
+        return self.results[i % self.sample_size]
+
+    def run_once(self, stored):
+        key, result = stored
+        d = self.manager.load(self.model, key, result)
+        d.addCallback(self.read_fields)
+        return d
+
+    def read_fields(self, obj):
+        return (obj.msg['to_addr'], obj.msg['from_addr'],
+                obj.msg['timestamp'])
+
+
+def get_benchmarks():
+    return [ModelLoadBenchmark()]
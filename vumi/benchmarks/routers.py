@@ -0,0 +1,105 @@
+"""Benchmarks for the dispatcher routers."""
+
+from twisted.internet.defer import inlineCallbacks, maybeDeferred
+
+from vumi.benchmarks.base import Benchmark
+from vumi.dispatchers.base import (SimpleDispatchRouter, ContentKeywordRouter,
+                                   UserGroupingRouter)
+from vumi.dispatchers.load_balancer import LoadBalancingRouter
+from vumi.message import TransportUserMessage
+
+
+class StubDispatcher(object):
+    """Stands in for a dispatcher and counts what is published."""
+
+    def __init__(self, transport_names, exposed_names):
+        self.transport_names = transport_names
+        self.exposed_names = exposed_names
+        self.published = 0
+
+    def publish_inbound_message(self, name, msg):
+        self.published += 1
+
+    def publish_inbound_event(self, name, msg):
+        self.published += 1
+
+    def publish_outbound_message(self, name, msg):
+        self.published += 1
+
+
+class RouterBenchmark(Benchmark):
+    """Dispatch messages in one direction through a router."""
+
+    transport_names = ['transport1', 'transport2']
+    exposed_names = ['app1']
+    sample_size = 100
+
+    def __init__(self, router_class, direction, config=None):
+        self.router_class = router_class
+        self.direction = direction
+        self.config = config or {}
+        self.name = "router.%s.%s" % (router_class.__name__, direction)
+
+    @inlineCallbacks
+    def setup(self):
+        self.dispatcher = StubDispatcher(self.transport_names,
+                                         self.exposed_names)
+        self.router = self.router_class(self.dispatcher, self.config)
+        yield maybeDeferred(self.router.setup_routing)
+        # Some routers connect to Redis in the background.
+        redis_d = getattr(self.router, '_redis_d', None)
+        if redis_d is not None:
+            yield redis_d
+        self.messages = [self.make_message(i)
+                         for i in range(self.sample_size)]
+
+    def teardown(self):
+        return maybeDeferred(self.router.teardown_routing)
+
+    def make_message(self, i):
+        if self.direction == 'inbound':
+            return TransportUserMessage(
+                to_addr="12345", from_addr="2783123%04d" % (i,),
+                transport_name=self.transport_names[0],
+                transport_type="sms", content="keyword%d hello" % (i % 10,))
+        return TransportUserMessage(
+            to_addr="2783123%04d" % (i,), from_addr="12345",
+            transport_name=self.exposed_names[0], transport_type="sms",
+            content="hello")
+
+    def prepare(self, i):
+        # Routers may modify the messages they dispatch.
+        return self.messages[i % self.sample_size].copy()
+
+    def run_once(self, msg):
+        if self.direction == 'inbound':
+            return self.router.dispatch_inbound_message(msg)
+        return self.router.dispatch_outbound_message(msg)
+
+
+def get_benchmarks(redis_config):
+    simple_config = {
+        'route_mappings': {'transport1': ['app1']},
+    }
+    keyword_config = {
+        'dispatcher_name': 'bench_keyword',
+        'redis_manager': redis_config,
+        'keyword_mappings': {'app1': 'keyword0'},
+        'rules': [{'app': 'app1', 'keyword': 'keyword%d' % (i,),
+                   'to_addr': '12345'} for i in range(1, 10)],
+        'transport_mappings': {'12345': 'transport1'},
+    }
+    grouping_config = {
+        'dispatcher_name': 'bench_grouping',
+        'redis_manager': redis_config,
+        'group_mappings': {'group1': 'app1', 'group2': 'app1'},
+    }
+    return [
+        RouterBenchmark(SimpleDispatchRouter, 'inbound', simple_config),
+        RouterBenchmark(SimpleDispatchRouter, 'outbound', simple_config),
+        RouterBenchmark(ContentKeywordRouter, 'inbound', keyword_config),
+        RouterBenchmark(ContentKeywordRouter, 'outbound', keyword_config),
+        RouterBenchmark(LoadBalancingRouter, 'inbound'),
+        RouterBenchmark(LoadBalancingRouter, 'outbound'),
+        RouterBenchmark(UserGroupingRouter, 'inbound', grouping_config),
+    ]
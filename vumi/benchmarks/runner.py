@@ -0,0 +1,143 @@
+# -*- test-case-name: vumi.benchmarks.tests.test_runner -*-
+
+"""Command line entry point for the benchmark suite."""
+
+import sys
+import json
+import platform
+import time
+
+import yaml
+from twisted.python import usage
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from vumi.benchmarks import (messages, middleware, routers, components,
+                             persist, http_client, workers)
+from vumi.benchmarks.base import run_benchmark, SkipBenchmark
+
+
+def get_benchmarks(redis_config=None):
+    """Return every benchmark in the suite."""
+    if redis_config is None:
+        redis_config = {'FAKE_REDIS': 'yes'}
+    return (messages.get_benchmarks() +
+            middleware.get_benchmarks() +
+            routers.get_benchmarks(redis_config) +
+            components.get_benchmarks(redis_config) +
+            persist.get_benchmarks() +
+            http_client.get_benchmarks() +
+            workers.get_benchmarks())
+
+
+def get_vumi_version():
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('vumi').version
+    except Exception:
+        return None
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["iterations", "n", None,
+         "Number of iterations per benchmark (default: per benchmark)."],
+        ["filter", "f", None,
+         "Only run benchmarks whose names start with this prefix."],
+        ["json", "j", None,
+         "Write the results as JSON to this file ('-' for stdout)."],
+        ["redis-config", "r", None,
+         "Redis config (YAML) for the Redis benchmarks. Defaults to an"
+         " in-process fake Redis."],
+    ]
+    optFlags = [
+        ["list", "l", "List the benchmarks and exit."],
+    ]
+
+    longdesc = """Runs vumi's benchmark suite and reports throughput and
+    latency percentiles for each benchmark."""
+
+    def postOptions(self):
+        if self['iterations'] is not None:
+            self['iterations'] = int(self['iterations'])
+        if self['redis-config'] is not None:
+            self['redis-config'] = yaml.safe_load(self['redis-config'])
+
+
+@inlineCallbacks
+def run_suite(benchmarks, iterations=None, report=None):
+    """
+    Run ``benchmarks`` one after the other and return a deferred that
+    fires with the suite results as a JSON-serialisable dict.
+    """
+    results = []
+    skipped = []
+    for benchmark in benchmarks:
+        try:
+            result = yield run_benchmark(benchmark, iterations)
+        except SkipBenchmark, e:
+            skipped.append({'name': benchmark.name, 'reason': str(e)})
+            continue
+        results.append(result.as_dict())
+        if report is not None:
+            report(results[-1])
+    returnValue({
+        'vumi_version': get_vumi_version(),
+        'python_version': platform.python_version(),
+        'timestamp': time.time(),
+        'results': results,
+        'skipped': skipped,
+    })
+
+
+def print_result(result):
+    print "%-50s %12.1f ops/s  p50 %8.3f ms  p99 %8.3f ms" % (
+        result['name'], result['ops_per_sec'] or 0, result['p50_ms'],
+        result['p99_ms'])
+    for key, value in sorted(result['stats'].items()):
+        print "%-50s %s: %s" % ('', key, value)
+
+
+@inlineCallbacks
+def main(options):
+    benchmarks = get_benchmarks(options['redis-config'])
+    if options['filter']:
+        benchmarks = [b for b in benchmarks
+                      if b.name.startswith(options['filter'])]
+    if options['list']:
+        for benchmark in benchmarks:
+            print benchmark.name
+        return
+
+    report = print_result if options['json'] != '-' else None
+    suite = yield run_suite(benchmarks, options['iterations'], report)
+    for skip in suite['skipped']:
+        if report is not None:
+            print "%-50s skipped: %s" % (skip['name'], skip['reason'])
+
+    if options['json'] == '-':
+        json.dump(suite, sys.stdout, indent=2)
+    elif options['json']:
+        with open(options['json'], 'w') as f:
+            json.dump(suite, f, indent=2)
+
+
+def run(argv=None):
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    def _run():
+        d = main(options)
+        d.addErrback(lambda f: f.printTraceback())
+        d.addBoth(lambda _: reactor.stop())
+    reactor.callWhenRunning(_run)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    run()
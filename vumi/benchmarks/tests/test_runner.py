@@ -0,0 +1,93 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks, succeed
+
+from vumi.benchmarks.base import (Benchmark, BenchmarkResult, SkipBenchmark,
+                                  run_benchmark, percentile)
+from vumi.benchmarks.runner import get_benchmarks, run_suite
+
+
+class CountingBenchmark(Benchmark):
+    name = "counting"
+    iterations = 7
+
+    def setup(self):
+        self.calls = []
+        self.torn_down = False
+
+    def teardown(self):
+        self.torn_down = True
+
+    def prepare(self, i):
+        return i * 2
+
+    def run_once(self, i):
+        self.calls.append(i)
+
+
+class StatsBenchmark(CountingBenchmark):
+    name = "stats"
+
+    def prepare(self, i):
+        return succeed(i)
+
+    def get_stats(self):
+        return {'calls': len(self.calls)}
+
+
+class SkippedBenchmark(Benchmark):
+    name = "skipped"
+
+    def setup(self):
+        raise SkipBenchmark("not here")
+
+
+class BenchmarkTestCase(TestCase):
+
+    def test_percentile(self):
+        values = range(100)
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile(values, 1.0), 99)
+        self.assertEqual(percentile([3], 0.99), 3)
+
+    def test_result_as_dict(self):
+        result = BenchmarkResult("foo", [0.002, 0.001, 0.001, 0.004])
+        data = result.as_dict()
+        self.assertEqual(data['name'], "foo")
+        self.assertEqual(data['iterations'], 4)
+        self.assertAlmostEqual(data['elapsed'], 0.008)
+        self.assertAlmostEqual(data['ops_per_sec'], 500)
+        self.assertAlmostEqual(data['p50_ms'], 2)
+        self.assertAlmostEqual(data['max_ms'], 4)
+
+    @inlineCallbacks
+    def test_run_benchmark(self):
+        benchmark = CountingBenchmark()
+        result = yield run_benchmark(benchmark)
+        self.assertEqual(benchmark.calls, [0, 2, 4, 6, 8, 10, 12])
+        self.assertTrue(benchmark.torn_down)
+        self.assertEqual(len(result.latencies), 7)
+
+    @inlineCallbacks
+    def test_run_benchmark_stats(self):
+        benchmark = StatsBenchmark()
+        result = yield run_benchmark(benchmark)
+        self.assertEqual(benchmark.calls, range(7))
+        self.assertEqual(result.as_dict()['stats'], {'calls': 7})
+
+    @inlineCallbacks
+    def test_run_suite_skips(self):
+        suite = yield run_suite([SkippedBenchmark(), CountingBenchmark()], 3)
+        self.assertEqual([r['name'] for r in suite['results']], ['counting'])
+        self.assertEqual(suite['skipped'],
+                         [{'name': 'skipped', 'reason': 'not here'}])
+
+    @inlineCallbacks
+    def test_full_suite(self):
+        benchmarks = get_benchmarks()
+        suite = yield run_suite(benchmarks, 3)
+        names = [r['name'] for r in suite['results']]
+        names.extend(s['name'] for s in suite['skipped'])
+        self.assertEqual(sorted(names), sorted(b.name for b in benchmarks))
+        for result in suite['results']:
+            self.assertEqual(result['iterations'], 3)
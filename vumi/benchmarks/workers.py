@@ -0,0 +1,160 @@
+"""Benchmarks for workers connected to an in-process AMQP broker."""
+
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+
+from vumi.application.base import ApplicationWorker
+from vumi.benchmarks.base import Benchmark
+from vumi.dispatchers.base import BaseDispatchWorker
+from vumi.local_amqp import LocalAMQPBroker, LocalAMQClient
+from vumi.transports.base import Transport
+
+
+@inlineCallbacks
+def start_worker(broker, worker_class, config):
+    worker = worker_class({}, config)
+    yield worker._amqp_connected(LocalAMQClient(broker))
+    returnValue(worker)
+
+
+class DispatcherStartupBenchmark(Benchmark):
+    """
+    Start a dispatcher with many endpoints, with or without publisher
+    channel sharing, and report the channels it opened.
+    """
+
+    iterations = 20
+    endpoints = 200
+
+    def __init__(self, share_channels):
+        self.share_channels = share_channels
+        self.name = "dispatcher.startup.%s_channels" % (
+            'shared' if share_channels else 'unshared',)
+        self.worker = None
+
+    def setup(self):
+        self.worker = None
+        self.channels = None
+
+    @inlineCallbacks
+    def teardown(self):
+        yield self.stop_worker()
+
+    @inlineCallbacks
+    def stop_worker(self):
+        if self.worker is not None:
+            yield self.worker.stopWorker()
+            self.worker = None
+
+    @inlineCallbacks
+    def prepare(self, i):
+        yield self.stop_worker()
+        half = self.endpoints // 2
+        config = {
+            'transport_names': ['transport%d' % (n,) for n in range(half)],
+            'exposed_names': ['app%d' % (n,)
+                              for n in range(self.endpoints - half)],
+            'router_class': 'vumi.dispatchers.base.TransportToTransportRouter',
+            'route_mappings': {},
+            'amqp_share_publisher_channels': self.share_channels,
+        }
+        self.worker = BaseDispatchWorker({}, config)
+        returnValue(LocalAMQClient(LocalAMQPBroker()))
+
+    @inlineCallbacks
+    def run_once(self, client):
+        yield self.worker._amqp_connected(client)
+        self.channels = len(client.channels)
+
+    def get_stats(self):
+        return {'channels': self.channels}
+
+
+class BenchTransport(Transport):
+    """
+    Transport that sends an inbound message and waits for the reply.
+    """
+
+    def setup_transport(self):
+        self.waiting = {}
+
+    def teardown_transport(self):
+        pass
+
+    def handle_outbound_message(self, message):
+        d = self.publish_ack(message['message_id'], message['message_id'])
+        self.waiting.pop(message['in_reply_to']).callback(None)
+        return d
+
+    def send(self, i):
+        message_id = "bench-%d" % (i,)
+        d = self.waiting[message_id] = Deferred()
+        self.publish_message(
+            message_id=message_id, to_addr="12345",
+            from_addr="27831234567", content="ping", transport_type="sms")
+        return d
+
+
+class BenchApplication(ApplicationWorker):
+    """
+    Application that answers every message.
+    """
+
+    def consume_user_message(self, message):
+        return self.reply_to(message, "pong")
+
+
+class PipelineBenchmark(Benchmark):
+    """
+    Send a message from a transport to an application, optionally through
+    a dispatcher, and wait for the reply. All the workers share a local
+    broker.
+    """
+
+    def __init__(self, use_dispatcher):
+        self.use_dispatcher = use_dispatcher
+        self.name = "pipeline.round_trip%s" % (
+            '' if use_dispatcher else '.no_dispatcher',)
+
+    @inlineCallbacks
+    def setup(self):
+        self.broker = LocalAMQPBroker()
+        self.workers = []
+        app_name = 'bench_transport'
+        if self.use_dispatcher:
+            app_name = 'bench_app'
+            yield self.start_worker(BaseDispatchWorker, {
+                'transport_names': ['bench_transport'],
+                'exposed_names': ['bench_app'],
+                'router_class': 'vumi.dispatchers.base.SimpleDispatchRouter',
+                'route_mappings': {'bench_transport': ['bench_app']},
+                'transport_mappings': {'bench_app': 'bench_transport'},
+            })
+        yield self.start_worker(BenchApplication, {
+            'transport_name': app_name})
+        self.transport = yield self.start_worker(BenchTransport, {
+            'transport_name': 'bench_transport'})
+
+    @inlineCallbacks
+    def start_worker(self, worker_class, config):
+        worker = yield start_worker(self.broker, worker_class, config)
+        self.workers.append(worker)
+        returnValue(worker)
+
+    @inlineCallbacks
+    def teardown(self):
+        for worker in reversed(self.workers):
+            yield worker.stopWorker()
+
+    def run_once(self, i):
+        return self.transport.send(i)
+
+    def get_stats(self):
+        return {'published': self.broker.published,
+                'delivered': self.broker.delivered}
+
+
+def get_benchmarks():
+    return [DispatcherStartupBenchmark(True),
+            DispatcherStartupBenchmark(False),
+            PipelineBenchmark(True),
+            PipelineBenchmark(False)]
@@ -36,7 +36,8 @@ class TestMetricManager(TestCase):
             return
         content = msgs[-1]
         name = metric.name
-        self.assertEqual(content.properties, {"delivery mode": 2})
+        self.assertEqual(content.properties, {
+            "delivery mode": 2, "content type": "application/json"})
         msg = Message.from_json(content.body)
         [datapoint] = msg.payload["datapoints"]
         self.assertEqual(datapoint[0], name)
@@ -59,6 +59,8 @@ class CurrentTag(Model):
 
 class OutboundMessage(Model):
     # key is message_id
+    # Every event for a message loads it, so keep it around.
+    CACHE_LOADS = True
     msg = VumiMessage(TransportUserMessage)
     batch = ForeignKey(Batch, null=True)
 
@@ -82,11 +84,17 @@ class MessageStore(object):
     information about which batch a tag is currently associated with is
     stored in Riak.
 
+    Reconciling the cache for a batch walks the batch's messages in pages
+    of :attr:`RECONCILE_PAGE_SIZE` keys, so only one page of keys is held
+    in memory at a time.
+
     A small amount of information about the state of a batch (i.e. number
     of messages in the batch, messages sent, acknowledgements and delivery
     reports received) is stored in Redis.
     """
 
+    RECONCILE_PAGE_SIZE = 1000
+
     def __init__(self, manager, redis):
         self.manager = manager
         self.batches = manager.proxy(Batch)
@@ -131,33 +139,49 @@ class MessageStore(object):
 
     @Manager.calls_manager
     def reconcile_inbound_cache(self, batch_id):
-        # FIXME: We're loading messages one at a time here, which is stupid.
-        inbound_keys = yield self.batch_inbound_keys(batch_id)
-        for key in inbound_keys:
-            try:
-                msg = yield self.get_inbound_message(key)
-                yield self.cache.add_inbound_message(batch_id, msg)
-            except Exception:
-                log.err()
+        continuation = None
+        while True:
+            keys, continuation = yield self.batch_inbound_keys_page(
+                batch_id, self.RECONCILE_PAGE_SIZE, continuation)
+            for bunch in self.manager.load_all_bunches(InboundMessage, keys):
+                for msg_record in (yield bunch):
+                    try:
+                        yield self.cache.add_inbound_message(
+                            batch_id, msg_record.msg)
+                    except Exception:
+                        log.err()
+            if continuation is None:
+                break
 
     @Manager.calls_manager
     def reconcile_outbound_cache(self, batch_id):
-        # FIXME: We're loading messages one at a time here, which is stupid.
-        outbound_keys = yield self.batch_outbound_keys(batch_id)
-        for key in outbound_keys:
-            try:
-                msg = yield self.get_outbound_message(key)
-                yield self.cache.add_outbound_message(batch_id, msg)
-                yield self.reconcile_event_cache(batch_id, key)
-            except Exception:
-                log.err()
+        continuation = None
+        while True:
+            keys, continuation = yield self.batch_outbound_keys_page(
+                batch_id, self.RECONCILE_PAGE_SIZE, continuation)
+            for bunch in self.manager.load_all_bunches(OutboundMessage, keys):
+                for msg_record in (yield bunch):
+                    try:
+                        yield self.cache.add_outbound_message(
+                            batch_id, msg_record.msg)
+                        yield self.reconcile_event_cache(
+                            batch_id, msg_record.key)
+                    except Exception:
+                        log.err()
+            if continuation is None:
+                break
 
     @Manager.calls_manager
     def reconcile_event_cache(self, batch_id, message_id):
-        event_keys = yield self.message_event_keys(message_id)
-        for event_key in event_keys:
-            event = yield self.get_event(event_key)
-            yield self.cache.add_event(batch_id, event)
+        continuation = None
+        while True:
+            keys, continuation = yield self.message_event_keys_page(
+                message_id, self.RECONCILE_PAGE_SIZE, continuation)
+            for bunch in self.manager.load_all_bunches(Event, keys):
+                for event_record in (yield bunch):
+                    yield self.cache.add_event(batch_id, event_record.event)
+            if continuation is None:
+                break
 
     @Manager.calls_manager
     def batch_start(self, tags, **metadata):
@@ -263,6 +287,15 @@ class MessageStore(object):
         mr = self.manager.mr_from_field(OutboundMessage, 'batch', batch_id)
         return mr.get_keys()
 
+    def batch_outbound_keys_page(self, batch_id, max_results=None,
+                                 continuation=None):
+        """Return a (possibly deferred) tuple of ``(keys, continuation)``
+        for a page of the batch's outbound message keys.
+        """
+        return self.outbound_messages.index_keys_page(
+            'batch', batch_id, max_results=max_results,
+            continuation=continuation)
+
     def batch_outbound_keys_matching(self, batch_id, query):
         mr = self.outbound_messages.index_match(query, 'batch', batch_id)
         return mr.get_keys()
@@ -271,6 +304,15 @@ class MessageStore(object):
         mr = self.manager.mr_from_field(InboundMessage, 'batch', batch_id)
         return mr.get_keys()
 
+    def batch_inbound_keys_page(self, batch_id, max_results=None,
+                                continuation=None):
+        """Return a (possibly deferred) tuple of ``(keys, continuation)``
+        for a page of the batch's inbound message keys.
+        """
+        return self.inbound_messages.index_keys_page(
+            'batch', batch_id, max_results=max_results,
+            continuation=continuation)
+
     def batch_inbound_keys_matching(self, batch_id, query):
         mr = self.inbound_messages.index_match(query, 'batch', batch_id)
         return mr.get_keys()
@@ -279,6 +321,15 @@ class MessageStore(object):
         mr = self.manager.mr_from_field(Event, 'message', msg_id)
         return mr.get_keys()
 
+    def message_event_keys_page(self, msg_id, max_results=None,
+                                continuation=None):
+        """Return a (possibly deferred) tuple of ``(keys, continuation)``
+        for a page of the message's event keys.
+        """
+        return self.events.index_keys_page(
+            'message', msg_id, max_results=max_results,
+            continuation=continuation)
+
     def batch_inbound_count(self, batch_id):
         return self.inbound_messages.index_lookup(
             'batch', batch_id).get_count()
@@ -14,6 +14,50 @@ from vumi.persist.txriak_manager import TxRiakManager
 from vumi.persist.txredis_manager import TxRedisManager
 
 
+class JSONListWriter(object):
+    """
+    Writes items to a request as a JSON list, a few at a time, so that the
+    whole list never has to be held in memory.
+    """
+
+    content_type = 'application/json; charset=utf-8'
+
+    def __init__(self, request):
+        self.request = request
+        self._separator = '['
+
+    def write_items(self, items):
+        if not items:
+            return
+        self.request.write(self._separator + ', '.join(
+            json.dumps(item, cls=JSONMessageEncoder) for item in items))
+        self._separator = ', '
+
+    def close(self):
+        self.request.write('[]' if self._separator == '[' else ']')
+
+
+class NDJSONWriter(object):
+    """
+    Writes items to a request as newline-delimited JSON, one item per line.
+    """
+
+    content_type = 'application/x-ndjson; charset=utf-8'
+
+    def __init__(self, request):
+        self.request = request
+
+    def write_items(self, items):
+        if not items:
+            return
+        self.request.write(''.join(
+            json.dumps(item, cls=JSONMessageEncoder) + '\n'
+            for item in items))
+
+    def close(self):
+        pass
+
+
 class MatchResource(resource.Resource):
     """
     A Resource that accepts a query as JSON via HTTP POST and issues a match
@@ -29,6 +73,11 @@ class MatchResource(resource.Resource):
     RESP_TOKEN_HEADER = 'X-VMS-Result-Token'
     RESP_IN_PROGRESS_HEADER = 'X-VMS-Match-In-Progress'
 
+    RESULT_WRITERS = {
+        'json': JSONListWriter,
+        'ndjson': NDJSONWriter,
+    }
+
     def __init__(self, direction, message_store, batch_id):
         """
         :param str direction:
@@ -96,30 +145,45 @@ class MatchResource(resource.Resource):
         return NOT_DONE_YET
 
     @inlineCallbacks
-    def _render_results(self, request, token, start, stop, keys_only, asc):
+    def _render_results(self, request, token, start, stop, keys_only, asc,
+                        writer_class):
         in_progress = yield self._in_progress_cb(token)
         count = yield self._count_cb(token)
         keys = yield self._results_cb(token, start, stop, asc)
         self._add_resp_header(request, self.RESP_IN_PROGRESS_HEADER,
             str(int(in_progress)))
         self._add_resp_header(request, self.RESP_COUNT_HEADER, str(count))
+        self._add_resp_header(request, 'Content-Type',
+            writer_class.content_type)
+        writer = writer_class(request)
         if keys_only:
-            request.write(json.dumps(keys))
+            writer.write_items(keys)
         else:
-            messages = []
+            # Stop loading messages if the client goes away.
+            disconnected = []
+            request.notifyFinish().addErrback(disconnected.append)
+            positions = dict((key, i) for i, key in enumerate(keys))
             for bunch in self._load_bunches_cb(keys):
                 # inbound & outbound messages have a `.msg` attribute which
                 # is the actual message stored, they share the same message_id
                 # as the key.
-                messages.extend([msg.msg.payload for msg in (yield bunch)
-                                    if msg.msg])
-
-            # sort the results in the order that the keys specified
-            messages.sort(key=lambda msg: keys.index(msg['message_id']))
-            request.write(json.dumps(messages, cls=JSONMessageEncoder))
+                messages = [msg.msg.payload for msg in (yield bunch)
+                            if msg.msg]
+                if disconnected:
+                    return
+                # Bunches are loaded in key order, so sorting each one in
+                # the order that the keys specified sorts the results.
+                messages.sort(key=lambda msg: positions[msg['message_id']])
+                writer.write_items(messages)
+        writer.close()
         request.finish()
 
     def render_GET(self, request):
+        """
+        Return a page of the results of a match operation. Messages are
+        written as they're loaded, as a JSON list or, if the `format`
+        argument is `ndjson`, as newline-delimited JSON.
+        """
         token = request.args['token'][0]
         start = int(request.args['start'][0] if 'start' in request.args else 0)
         stop = int(request.args['stop'][0] if 'stop' in request.args
@@ -128,7 +192,14 @@ class MatchResource(resource.Resource):
                     else False)
         keys_only = bool(int(request.args['keys'][0]) if 'keys' in request.args
                             else False)
-        self._render_results(request, token, start, stop, keys_only, asc)
+        result_format = (request.args['format'][0]
+                         if 'format' in request.args else 'json')
+        writer_class = self.RESULT_WRITERS.get(result_format)
+        if writer_class is None:
+            request.setResponseCode(400)
+            return 'Unsupported result format: %r' % (result_format,)
+        self._render_results(request, token, start, stop, keys_only, asc,
+                             writer_class)
         return NOT_DONE_YET
 
     def getChild(self, name, request):
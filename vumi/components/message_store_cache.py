@@ -386,16 +386,20 @@ class MessageStoreCache(object):
 
         # populate the results set weighted according to the timestamps
         # that are already known in the cache.
+        pipe = self.redis.pipeline()
         for key in keys:
-            timestamp = yield self.redis.zscore(score_set_key, key)
-            yield self.redis.zadd(result_key, **{
+            pipe.zscore(score_set_key, key)
+        timestamps = yield pipe.execute()
+
+        for key, timestamp in zip(keys, timestamps):
+            pipe.zadd(result_key, **{
                 key.encode('utf-8'): timestamp,
                 })
-
         # Auto expire after TTL
-        yield self.redis.expire(result_key, ttl)
+        pipe.expire(result_key, ttl)
         # Remove from the list of in progress search operations.
-        yield self.redis.srem(self.search_token_key(batch_id), token)
+        pipe.srem(self.search_token_key(batch_id), token)
+        yield pipe.execute()
 
     def is_query_in_progress(self, batch_id, token):
         """
@@ -43,19 +43,51 @@ class SessionManager(object):
         return d.addCallback(lambda m: cls(m, max_session_length, gc_period))
 
     @inlineCallbacks
-    def active_sessions(self):
+    def active_sessions(self, count=100):
         """Return a list of active user_ids and associated sessions.
 
-        Queries redis for keys starting with the session key prefix. This is
-        O(n) over the total number of keys in redis, but this is still pretty
-        quick even for millions of keys. Try not to hit this too often, though.
+        Walks the session keys with SCAN, so redis isn't blocked while it
+        does so. This is still O(n) over the total number of keys in redis,
+        so try not to hit this too often.
         """
-        keys = yield self.redis.keys('session:*')
-        sessions = []
-        for user_id in [key.split(':', 1)[1] for key in keys]:
-            sessions.append((user_id, (yield self.load_session(user_id))))
+        sessions = {}
 
-        returnValue(sessions)
+        def load_sessions(keys):
+            d = self._load_sessions(keys)
+            return d.addCallback(sessions.update)
+
+        yield self.redis.scan_iter(
+            load_sessions, match='session:*', count=count)
+        returnValue(sessions.items())
+
+    @inlineCallbacks
+    def scan_active_sessions(self, cursor=0, count=100):
+        """Return one chunk of active user_ids and associated sessions.
+
+        :param int cursor:
+            Where to continue from. Use ``0`` to start from the beginning.
+        :param int count:
+            Roughly how many keys to look at.
+
+        Returns a deferred that fires with ``(next_cursor, sessions)``,
+        where ``sessions`` is a list of ``(user_id, session)`` pairs. A
+        ``next_cursor`` of ``0`` means there are no more sessions. As with
+        redis's SCAN command, a session may be returned more than once.
+        """
+        cursor, keys = yield self.redis.scan(
+            cursor, match='session:*', count=count)
+        sessions = yield self._load_sessions(keys)
+        returnValue((cursor, sessions))
+
+    @inlineCallbacks
+    def _load_sessions(self, keys):
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.hgetall(key)
+        sessions = yield pipe.execute()
+        returnValue([
+            (key.split(':', 1)[1], session)
+            for key, session in zip(keys, sessions) if session])
 
     def load_session(self, user_id):
         """
@@ -112,6 +144,8 @@ class SessionManager(object):
 
         """
         ukey = "%s:%s" % ('session', user_id)
+        pipe = self.redis.pipeline()
         for s_key, s_value in session.items():
-            yield self.redis.hset(ukey, s_key, s_value)
+            pipe.hset(ukey, s_key, s_value)
+        yield pipe.execute()
         returnValue(session)
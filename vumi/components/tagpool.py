@@ -8,13 +8,32 @@ import json
 from twisted.internet.defer import returnValue
 
 from vumi.errors import VumiError
-from vumi.persist.redis_base import Manager
+from vumi.persist.redis_base import Manager, RedisScript
 
 
 class TagpoolError(VumiError):
     """An error occurred during an operation on a tag pool."""
 
 
+def _acquire_tag_emulation(redis, keys, args):
+    free_list_key, free_set_key, inuse_set_key = keys
+    tag = redis.lpop(free_list_key)
+    if tag is not None:
+        redis.smove(free_set_key, inuse_set_key, tag)
+    return tag
+
+
+# Pops a free tag and marks it as in use in one step. The keys are the
+# free list, the free set and the in-use set.
+ACQUIRE_TAG_SCRIPT = RedisScript("""
+local tag = redis.call('LPOP', KEYS[1])
+if tag then
+    redis.call('SMOVE', KEYS[2], KEYS[3], tag)
+end
+return tag
+""", _acquire_tag_emulation)
+
+
 class TagpoolManager(object):
     """Manage a set of tag pools.
 
@@ -122,13 +141,9 @@ class TagpoolManager(object):
     def _tag_pool_metadata_key(self, pool):
         return ":".join(["tagpools", pool, "metadata"])
 
-    @Manager.calls_manager
     def _acquire_tag(self, pool):
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        tag = yield self.redis.lpop(free_list_key)
-        if tag is not None:
-            yield self.redis.smove(free_set_key, inuse_set_key, tag)
-        returnValue(tag)
+        return self.redis.run_script(
+            ACQUIRE_TAG_SCRIPT, self._tag_pool_keys(pool))
 
     @Manager.calls_manager
     def _acquire_specific_tag(self, pool, local_tag):
@@ -151,6 +166,8 @@ class TagpoolManager(object):
         new_tags = set(local_tags)
         old_tags = yield self.redis.sunion(free_set_key, inuse_set_key)
         old_tags = set(old_tags)
+        pipe = self.redis.pipeline()
         for tag in sorted(new_tags - old_tags):
-            yield self.redis.sadd(free_set_key, tag)
-            yield self.redis.rpush(free_list_key, tag)
+            pipe.sadd(free_set_key, tag)
+            pipe.rpush(free_list_key, tag)
+        yield pipe.execute()
@@ -440,6 +440,77 @@ class TestMessageStoreCache(TestMessageStoreBase):
         self.assertEqual(batch_status['ack'], 10)
         self.assertEqual(batch_status['sent'], 10)
 
+    @inlineCallbacks
+    def test_reconcile_cache_in_pages(self):
+        self.store.RECONCILE_PAGE_SIZE = 3
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        yield self.create_inbound_messages(batch_id, 5)
+        messages = yield self.create_outbound_messages(batch_id, 7)
+        for msg in messages:
+            ack = self.mkmsg_ack(user_message_id=msg['message_id'],
+                sent_message_id=msg['message_id'])
+            yield self.store.add_event(ack)
+            # More events than fit in a page.
+            for status in TransportEvent.DELIVERY_STATUSES:
+                dr = self.mkmsg_delivery(user_message_id=msg['message_id'],
+                                         status=status)
+                yield self.store.add_event(dr)
+
+        self.clear_cache(self.store)
+        yield self.store.reconcile_cache(batch_id)
+        self.assertFalse((yield self.store.needs_reconciliation(batch_id,
+            delta=0)))
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status['ack'], 7)
+        self.assertEqual(batch_status['delivery_report'],
+                         7 * len(TransportEvent.DELIVERY_STATUSES))
+        self.assertEqual(batch_status['sent'], 7)
+
+    @inlineCallbacks
+    def test_batch_outbound_keys_page(self):
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        messages = yield self.create_outbound_messages(batch_id, 5)
+
+        keys, continuation = yield self.store.batch_outbound_keys_page(
+            batch_id, 3)
+        self.assertEqual(len(keys), 3)
+        self.assertNotEqual(continuation, None)
+        more_keys, continuation = yield self.store.batch_outbound_keys_page(
+            batch_id, 3, continuation)
+        self.assertEqual(len(more_keys), 2)
+        self.assertEqual(continuation, None)
+        self.assertEqual(sorted(keys + more_keys),
+                         sorted(msg['message_id'] for msg in messages))
+
+    @inlineCallbacks
+    def test_message_event_keys_page(self):
+        msg_id, msg, batch_id = yield self._create_outbound()
+        event_ids = []
+        for status in TransportEvent.DELIVERY_STATUSES:
+            dr = self.mkmsg_delivery(user_message_id=msg_id, status=status)
+            event_ids.append(dr['event_id'])
+            yield self.store.add_event(dr)
+
+        keys, continuation = yield self.store.message_event_keys_page(
+            msg_id, 2)
+        self.assertEqual(len(keys), 2)
+        self.assertNotEqual(continuation, None)
+        more_keys, continuation = yield self.store.message_event_keys_page(
+            msg_id, 2, continuation)
+        self.assertEqual(continuation, None)
+        self.assertEqual(sorted(keys + more_keys), sorted(event_ids))
+
+    @inlineCallbacks
+    def test_batch_inbound_keys_page(self):
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        messages = yield self.create_inbound_messages(batch_id, 2)
+
+        keys, continuation = yield self.store.batch_inbound_keys_page(
+            batch_id)
+        self.assertEqual(sorted(keys),
+                         sorted(msg['message_id'] for msg in messages))
+        self.assertEqual(continuation, None)
+
     @inlineCallbacks
     def test_find_inbound_keys_matching(self):
         batch_id = yield self.store.batch_start([("pool", "tag")])
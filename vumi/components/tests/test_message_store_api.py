@@ -254,3 +254,65 @@ class MessageStoreAPITestCase(VumiWorkerTestCase, PersistenceMixin):
         self.assertResultCount(response, 0)
         self.assertEqual(json.loads(response.delivered_body), [])
         self.assertEqual(response.code, 200)
+
+    @inlineCallbacks
+    def test_match_resource_results_in_key_order_across_bunches(self):
+        self.store.manager.load_bunch_size = 3
+        messages = yield self.create_inbound(self.batch_id, 22,
+                                                'hello world {0}')
+        token = yield self.do_query('inbound', self.batch_id, '.*',
+                                                wait=True)
+        response = yield self.do_get('batch/%s/inbound/match/?token=%s' % (
+            self.batch_id, token))
+        current_page = messages[:MatchResource.DEFAULT_RESULT_SIZE]
+        self.assertJSONResultEqual(response.delivered_body, current_page)
+        self.assertEqual(response.headers.getRawHeaders('Content-Type'),
+                         ['application/json; charset=utf-8'])
+
+    @inlineCallbacks
+    def test_ndjson_inbound_match_resource(self):
+        self.store.manager.load_bunch_size = 3
+        messages = yield self.create_inbound(self.batch_id, 22,
+                                                'hello world {0}')
+        token = yield self.do_query('inbound', self.batch_id, '.*',
+                                                wait=True)
+        response = yield self.do_get(
+            'batch/%s/inbound/match/?token=%s&format=ndjson' % (
+                self.batch_id, token))
+        self.assertResultCount(response, 22)
+        self.assertEqual(response.headers.getRawHeaders('Content-Type'),
+                         ['application/x-ndjson; charset=utf-8'])
+        lines = response.delivered_body.splitlines()
+        current_page = messages[:MatchResource.DEFAULT_RESULT_SIZE]
+        self.assertJSONResultEqual('[%s]' % (','.join(lines),), current_page)
+
+    @inlineCallbacks
+    def test_ndjson_keys_inbound_match_resource(self):
+        messages = yield self.create_inbound(self.batch_id, 3,
+                                                'hello world {0}')
+        token = yield self.do_query('inbound', self.batch_id, '.*',
+                                                wait=True)
+        response = yield self.do_get(
+            'batch/%s/inbound/match/?token=%s&keys=1&format=ndjson' % (
+                self.batch_id, token))
+        self.assertEqual(
+            [json.loads(line)
+             for line in response.delivered_body.splitlines()],
+            [msg['message_id'] for msg in messages])
+
+    @inlineCallbacks
+    def test_empty_ndjson_inbound_match_resource(self):
+        token = yield self.do_query('inbound', self.batch_id, '.*')
+        response = yield self.do_get(
+            'batch/%s/inbound/match/?token=%s&format=ndjson' % (
+                self.batch_id, token))
+        self.assertEqual(response.delivered_body, '')
+        self.assertEqual(response.code, 200)
+
+    @inlineCallbacks
+    def test_unsupported_result_format(self):
+        token = yield self.do_query('inbound', self.batch_id, '.*')
+        response = yield self.do_get(
+            'batch/%s/inbound/match/?token=%s&format=xml' % (
+                self.batch_id, token))
+        self.assertEqual(response.code, 400)
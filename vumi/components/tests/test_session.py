@@ -42,6 +42,20 @@ class SessionManagerTestCase(TestCase, PersistenceMixin):
         s1, s2 = yield get_sessions()
         self.assertTrue(s1[1]['created_at'] < s2[1]['created_at'])
 
+    @inlineCallbacks
+    def test_scan_active_sessions(self):
+        for i in range(5):
+            yield self.sm.create_session("u%d" % (i,))
+        yield self.manager.set("not_a_session", "foo")
+        user_ids = []
+        cursor = None
+        while cursor != 0:
+            cursor, sessions = yield self.sm.scan_active_sessions(
+                cursor or 0, count=2)
+            self.assertTrue(len(sessions) <= 2)
+            user_ids.extend(user_id for user_id, _ in sessions)
+        self.assertEqual(["u%d" % (i,) for i in range(5)], sorted(user_ids))
+
     @inlineCallbacks
     def test_schedule_session_expiry(self):
         self.sm.max_session_length = 60.0
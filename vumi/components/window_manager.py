@@ -6,11 +6,42 @@ from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.task import LoopingCall
 
+from vumi.persist.redis_base import RedisScript
+
 
 class WindowException(Exception):
     pass
 
 
+def _get_next_key_emulation(redis, keys, args):
+    window_key, inflight_key, stats_key = keys
+    window_size, clock_time = int(args[0]), float(args[1])
+    if redis.llen(window_key) == 0:
+        return None
+    if window_size - redis.llen(inflight_key) <= 0:
+        return None
+    next_key = redis.rpoplpush(window_key, inflight_key)
+    redis.zadd(stats_key, **{next_key: clock_time})
+    return next_key
+
+
+# Moves the next waiting key into flight if there's room in the window and
+# records when it was sent. The keys are the window list, the in-flight list
+# and the flight stats set. The arguments are the window size and the
+# current time.
+GET_NEXT_KEY_SCRIPT = RedisScript("""
+if redis.call('LLEN', KEYS[1]) == 0 then
+    return nil
+end
+if tonumber(ARGV[1]) - redis.call('LLEN', KEYS[2]) <= 0 then
+    return nil
+end
+local next_key = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+redis.call('ZADD', KEYS[3], ARGV[2], next_key)
+return next_key
+""", _get_next_key_emulation)
+
+
 class WindowManager(object):
 
     WINDOW_KEY = 'windows'
@@ -92,28 +123,12 @@ class WindowManager(object):
             json.dumps(data))
         returnValue(key)
 
-    @inlineCallbacks
     def get_next_key(self, window_id):
-
-        window_key = self.window_key(window_id)
-        inflight_key = self.flight_key(window_id)
-
-        waiting_list = yield self.count_waiting(window_id)
-        if waiting_list == 0:
-            return
-
-        flight_size = yield self.count_in_flight(window_id)
-        room_available = self.window_size - flight_size
-
-        if room_available:
-            next_key = yield self.redis.rpoplpush(window_key, inflight_key)
-            yield self._set_timestamp(window_id, next_key)
-            returnValue(next_key)
-
-    def _set_timestamp(self, window_id, flight_key):
-        return self.redis.zadd(self.stats_key(window_id), **{
-                flight_key: self.get_clocktime(),
-        })
+        return self.redis.run_script(GET_NEXT_KEY_SCRIPT, [
+            self.window_key(window_id),
+            self.flight_key(window_id),
+            self.stats_key(window_id),
+        ], [self.window_size, repr(self.get_clocktime())])
 
     def _clear_timestamp(self, window_id, flight_key):
         return self.redis.zrem(self.stats_key(window_id), flight_key)
@@ -0,0 +1,495 @@
+# -*- test-case-name: vumi.tests.test_local_amqp -*-
+
+"""
+An in-process stand-in for an AMQP broker.
+
+This lets a set of workers talk to each other inside a single process
+without a RabbitMQ server, which is useful for benchmarking whole
+transport -> dispatcher -> application pipelines. Exchanges (direct, topic
+and fanout), routing keys, prefetch limits, acknowledgements, channel flow
+and publisher confirms behave as they do on RabbitMQ. Durability, message
+expiry and the other server-side extras do not.
+
+Workers are connected to a broker by :class:`LocalWorkerCreator`::
+
+    creator = LocalWorkerCreator({})
+    creator.create_worker('vumi.demos.words.EchoWorker', config)
+"""
+
+import re
+from collections import deque
+from itertools import count
+from uuid import uuid4
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+
+from vumi import log
+from vumi.service import (WorkerAMQClient, WorkerDelegate, WorkerCreator,
+                          BindingCache, get_spec)
+from vumi.utils import vumi_resource_path
+
+
+class LocalAMQPError(Exception):
+    """Raised when a broker operation refers to something that isn't there
+    or is used incorrectly."""
+
+
+class LocalReply(object):
+    """A method reply from the broker. Fields are attributes."""
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+class LocalContent(object):
+    """The body and properties of a delivered message."""
+
+    def __init__(self, body, properties):
+        self.body = body
+        self.properties = properties
+        self.children = []
+
+    def __getitem__(self, name):
+        return self.properties[name]
+
+
+class LocalMessage(object):
+    """A message sitting in a queue on the broker."""
+
+    __slots__ = ('exchange', 'routing_key', 'body', 'properties',
+                 'redelivered')
+
+    def __init__(self, exchange, routing_key, body, properties):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.body = body
+        self.properties = properties
+        self.redelivered = False
+
+
+class LocalExchange(object):
+    """An exchange, routing messages to queues by routing key."""
+
+    def __init__(self, name, exchange_type):
+        if exchange_type not in ('direct', 'topic', 'fanout'):
+            raise LocalAMQPError(
+                "Unsupported exchange type: %r" % (exchange_type,))
+        self.name = name
+        self.exchange_type = exchange_type
+        self.bindings = {}
+        self._patterns = {}
+
+    def bind(self, queue, routing_key):
+        self.bindings.setdefault(routing_key, set()).add(queue)
+        if self.exchange_type == 'topic':
+            self._patterns[routing_key] = self._topic_regex(routing_key)
+
+    def _topic_regex(self, binding):
+        # '*' matches exactly one word and '#' matches zero or more.
+        pattern = re.escape(binding).replace(r'\*', r'[^.]+')
+        for hash_word, regex in [(r'\.\#', r'(?:\.[^.]+)*'),
+                                 (r'\#\.', r'(?:[^.]+\.)*'),
+                                 (r'\#', r'.*')]:
+            pattern = pattern.replace(hash_word, regex)
+        return re.compile('^%s$' % (pattern,))
+
+    def route(self, routing_key):
+        if self.exchange_type == 'direct':
+            return self.bindings.get(routing_key, ())
+        queues = set()
+        for binding, bound in self.bindings.iteritems():
+            if (self.exchange_type == 'fanout' or
+                    self._patterns[binding].match(routing_key)):
+                queues.update(bound)
+        return queues
+
+
+class LocalQueue(object):
+    """A queue of messages and the consumers reading from it."""
+
+    def __init__(self, name):
+        self.name = name
+        self.messages = deque()
+        # (channel, consumer_tag) pairs, rotated for round robin delivery.
+        self.consumers = deque()
+
+    def remove_consumer(self, channel, consumer_tag):
+        try:
+            self.consumers.remove((channel, consumer_tag))
+        except ValueError:
+            pass
+
+
+class LocalAMQPBroker(object):
+    """
+    Exchanges, queues and message delivery for :class:`LocalAMQPChannel`.
+
+    Messages are delivered to consumers in batches from a reactor call
+    scheduled whenever something becomes deliverable, so publishing never
+    delivers synchronously to the publisher's own consumers.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock if clock is not None else reactor
+        self.exchanges = {}
+        self.queues = {}
+        self.channels = set()
+        self.published = 0
+        self.delivered = 0
+        self._pending_queues = set()
+        self._delivery_call = None
+
+    def _get_exchange(self, name):
+        try:
+            return self.exchanges[name]
+        except KeyError:
+            raise LocalAMQPError("No exchange named %r" % (name,))
+
+    def _get_queue(self, name):
+        try:
+            return self.queues[name]
+        except KeyError:
+            raise LocalAMQPError("No queue named %r" % (name,))
+
+    def exchange_declare(self, name, exchange_type):
+        exchange = self.exchanges.get(name)
+        if exchange is None:
+            exchange = self.exchanges[name] = LocalExchange(name,
+                                                            exchange_type)
+        elif exchange.exchange_type != exchange_type:
+            raise LocalAMQPError(
+                "Exchange %r already declared as %r, not %r" % (
+                    name, exchange.exchange_type, exchange_type))
+        return exchange
+
+    def queue_declare(self, name):
+        if not name:
+            name = 'amq.gen-%s' % (uuid4().hex,)
+        queue = self.queues.get(name)
+        if queue is None:
+            queue = self.queues[name] = LocalQueue(name)
+        return queue
+
+    def queue_bind(self, queue_name, exchange_name, routing_key):
+        self._get_exchange(exchange_name).bind(
+            self._get_queue(queue_name), routing_key)
+
+    def list_bindings(self, exchange_name):
+        """
+        Return a dict mapping routing keys bound on an exchange to lists of
+        queue names, like :meth:`vumi.service.BindingCache.list_bindings`.
+        """
+        exchange = self.exchanges.get(exchange_name)
+        if exchange is None:
+            return {}
+        return dict((key, [queue.name for queue in queues])
+                    for key, queues in exchange.bindings.iteritems())
+
+    def publish(self, exchange_name, routing_key, body, properties):
+        self.published += 1
+        for queue in self._get_exchange(exchange_name).route(routing_key):
+            queue.messages.append(LocalMessage(
+                exchange_name, routing_key, body, properties))
+            self.schedule_delivery(queue)
+
+    def get(self, queue_name):
+        queue = self._get_queue(queue_name)
+        if queue.messages:
+            return queue.messages.popleft()
+        return None
+
+    def requeue(self, queue, messages):
+        for msg in reversed(messages):
+            msg.redelivered = True
+            queue.messages.appendleft(msg)
+        self.schedule_delivery(queue)
+
+    def add_consumer(self, channel, queue_name, consumer_tag):
+        queue = self._get_queue(queue_name)
+        queue.consumers.append((channel, consumer_tag))
+        self.schedule_delivery(queue)
+
+    def remove_consumer(self, channel, queue_name, consumer_tag):
+        queue = self.queues.get(queue_name)
+        if queue is not None:
+            queue.remove_consumer(channel, consumer_tag)
+
+    def schedule_delivery(self, queue):
+        self._pending_queues.add(queue)
+        if self._delivery_call is None:
+            self._delivery_call = self.clock.callLater(0, self.deliver)
+
+    def deliver(self):
+        """Deliver as many waiting messages as consumers can accept."""
+        self._delivery_call = None
+        pending, self._pending_queues = self._pending_queues, set()
+        for queue in pending:
+            self._deliver_queue(queue)
+
+    def _deliver_queue(self, queue):
+        consumers = queue.consumers
+        messages = queue.messages
+        while messages and consumers:
+            # Find the next consumer in round robin order that can take a
+            # message. If none can, we wait for an ack or a flow change.
+            for _ in xrange(len(consumers)):
+                channel, consumer_tag = consumers[0]
+                consumers.rotate(-1)
+                if channel.deliverable():
+                    break
+            else:
+                return
+            self.delivered += 1
+            channel.deliver(queue, consumer_tag, messages.popleft())
+
+
+class LocalAMQPChannel(object):
+    """
+    A channel on a :class:`LocalAMQPBroker`, with the subset of the txAMQP
+    channel interface that vumi workers use.
+    """
+
+    def __init__(self, id, broker, delegate):
+        self.id = id
+        self.broker = broker
+        self.delegate = delegate
+        self.closed = False
+        self.flow_active = True
+        self.prefetch_count = 0
+        self.confirm_mode = False
+        self.consumers = {}
+        self._publish_seq = 0
+        self._delivery_tags = count(1)
+        # delivery_tag -> (queue, message), in delivery order
+        self._unacked = {}
+        self._unacked_order = deque()
+
+    def __repr__(self):
+        return '<LocalAMQPChannel: id=%s flow=%s>' % (
+            self.id, self.flow_active)
+
+    def _check_open(self):
+        if self.closed:
+            raise LocalAMQPError("Channel %s is closed" % (self.id,))
+
+    def _kick_consumers(self):
+        for queue_name in self.consumers.itervalues():
+            queue = self.broker.queues.get(queue_name)
+            if queue is not None:
+                self.broker.schedule_delivery(queue)
+
+    def deliverable(self):
+        if self.closed or not self.flow_active:
+            return False
+        return (self.prefetch_count < 1 or
+                len(self._unacked) < self.prefetch_count)
+
+    def deliver(self, queue, consumer_tag, msg):
+        delivery_tag = next(self._delivery_tags)
+        self._unacked[delivery_tag] = (queue, msg)
+        self._unacked_order.append(delivery_tag)
+        self.delegate.basic_deliver(self, LocalReply(
+            consumer_tag=consumer_tag, delivery_tag=delivery_tag,
+            redelivered=msg.redelivered, exchange=msg.exchange,
+            routing_key=msg.routing_key,
+            content=LocalContent(msg.body, msg.properties)))
+
+    def channel_open(self):
+        self.broker.channels.add(self)
+        return succeed(LocalReply())
+
+    def channel_close(self, reply_code=200, reply_text='', class_id=0,
+                      method_id=0):
+        if not self.closed:
+            self.closed = True
+            self.broker.channels.discard(self)
+            for consumer_tag, queue_name in self.consumers.items():
+                self.broker.remove_consumer(self, queue_name, consumer_tag)
+            self.consumers.clear()
+            # Unacknowledged messages go back on their queues.
+            requeued = {}
+            for delivery_tag in self._unacked_order:
+                if delivery_tag in self._unacked:
+                    queue, msg = self._unacked[delivery_tag]
+                    requeued.setdefault(queue, []).append(msg)
+            self._unacked.clear()
+            self._unacked_order.clear()
+            for queue, messages in requeued.iteritems():
+                self.broker.requeue(queue, messages)
+        return succeed(LocalReply())
+
+    def close(self, reason):
+        """Mark the channel closed on the client side."""
+        self.closed = True
+
+    def channel_flow(self, active):
+        self.flow_active = active
+        if active:
+            self._kick_consumers()
+        return succeed(LocalReply(active=active))
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, global_=False):
+        self.prefetch_count = prefetch_count
+        self._kick_consumers()
+        return succeed(LocalReply())
+
+    def exchange_declare(self, exchange, type='direct', durable=False,
+                         **kw):
+        self._check_open()
+        self.broker.exchange_declare(exchange, type)
+        return succeed(LocalReply())
+
+    def queue_declare(self, queue='', durable=False, **kw):
+        self._check_open()
+        queue = self.broker.queue_declare(queue)
+        return succeed(LocalReply(
+            queue=queue.name, message_count=len(queue.messages),
+            consumer_count=len(queue.consumers)))
+
+    def queue_bind(self, queue, exchange, routing_key='', **kw):
+        self._check_open()
+        self.broker.queue_bind(queue, exchange, routing_key)
+        return succeed(LocalReply())
+
+    def basic_consume(self, queue, consumer_tag='', **kw):
+        self._check_open()
+        if not consumer_tag:
+            consumer_tag = 'amq.ctag-%s' % (uuid4().hex,)
+        self.consumers[consumer_tag] = queue
+        self.broker.add_consumer(self, queue, consumer_tag)
+        return succeed(LocalReply(consumer_tag=consumer_tag))
+
+    def basic_cancel(self, consumer_tag, **kw):
+        queue = self.consumers.pop(consumer_tag, None)
+        if queue is not None:
+            self.broker.remove_consumer(self, queue, consumer_tag)
+        return succeed(LocalReply(consumer_tag=consumer_tag))
+
+    def basic_publish(self, exchange='', routing_key='', content=None, **kw):
+        self._check_open()
+        self.broker.publish(exchange, routing_key, content.body,
+                            dict(content.properties))
+        if self.confirm_mode:
+            self._publish_seq += 1
+            self.delegate.basic_ack(self, LocalReply(
+                delivery_tag=self._publish_seq, multiple=False))
+        return succeed(None)
+
+    def confirm_select(self, nowait=False):
+        self.confirm_mode = True
+        return succeed(LocalReply())
+
+    def basic_get(self, queue, no_ack=False, **kw):
+        self._check_open()
+        msg = self.broker.get(queue)
+        if msg is None:
+            return succeed(LocalReply(method_name='get-empty'))
+        delivery_tag = next(self._delivery_tags)
+        if not no_ack:
+            self._unacked[delivery_tag] = (self.broker.queues[queue], msg)
+            self._unacked_order.append(delivery_tag)
+        return succeed(LocalReply(
+            method_name='get-ok', delivery_tag=delivery_tag,
+            redelivered=msg.redelivered, exchange=msg.exchange,
+            routing_key=msg.routing_key,
+            message_count=len(self.broker.queues[queue].messages),
+            content=LocalContent(msg.body, msg.properties)))
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        if delivery_tag not in self._unacked:
+            raise LocalAMQPError(
+                "Unknown delivery tag %r on channel %s" % (
+                    delivery_tag, self.id))
+        if multiple:
+            order = self._unacked_order
+            while order:
+                tag = order.popleft()
+                self._unacked.pop(tag, None)
+                if tag == delivery_tag:
+                    break
+        else:
+            del self._unacked[delivery_tag]
+            # Individually acked tags are dropped from the order lazily.
+            order = self._unacked_order
+            while order and order[0] not in self._unacked:
+                order.popleft()
+        self._kick_consumers()
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        if delivery_tag not in self._unacked:
+            raise LocalAMQPError(
+                "Unknown delivery tag %r on channel %s" % (
+                    delivery_tag, self.id))
+        queue, msg = self._unacked.pop(delivery_tag)
+        order = self._unacked_order
+        while order and order[0] not in self._unacked:
+            order.popleft()
+        if requeue:
+            self.broker.requeue(queue, [msg])
+        self._kick_consumers()
+
+
+class LocalBindingCache(BindingCache):
+    """
+    Binding cache that reads bindings straight from a local broker.
+    """
+
+    def __init__(self, vumi_options, exchange_name, broker):
+        super(LocalBindingCache, self).__init__(vumi_options, exchange_name)
+        self.broker = broker
+
+    def list_bindings(self):
+        return succeed(self.broker.list_bindings(self.exchange_name))
+
+
+class LocalAMQClient(WorkerAMQClient):
+    """
+    AMQP client for a worker connected to a :class:`LocalAMQPBroker`.
+    """
+
+    def __init__(self, broker, vumi_options=None):
+        if vumi_options is None:
+            vumi_options = {}
+        spec = get_spec(vumi_resource_path(
+            vumi_options.get('specfile', 'amqp-spec-0-8.xml')))
+        WorkerAMQClient.__init__(self, WorkerDelegate(),
+                                 vumi_options.get('vhost', '/'), spec)
+        self.vumi_options = vumi_options
+        self.broker = broker
+
+    @inlineCallbacks
+    def channel(self, id):
+        yield self.channelLock.acquire()
+        try:
+            ch = self.channels.get(id)
+            if ch is None:
+                ch = LocalAMQPChannel(id, self.broker, self.delegate)
+                self.channels[id] = ch
+        finally:
+            self.channelLock.release()
+        returnValue(ch)
+
+    def get_binding_cache(self, exchange_name):
+        if exchange_name not in self.binding_caches:
+            self.binding_caches[exchange_name] = LocalBindingCache(
+                self.vumi_options, exchange_name, self.broker)
+        return self.binding_caches[exchange_name]
+
+
+class LocalWorkerCreator(WorkerCreator):
+    """
+    Creates workers connected to a shared in-process broker instead of a
+    RabbitMQ server.
+    """
+
+    def __init__(self, vumi_options, broker=None):
+        super(LocalWorkerCreator, self).__init__(vumi_options)
+        if broker is None:
+            broker = LocalAMQPBroker()
+        self.broker = broker
+
+    def _connect(self, worker, timeout, bindAddress):
+        amq_client = LocalAMQClient(self.broker, self.options)
+        log.msg("Connecting %r to the local AMQP broker" % (worker,))
+        reactor.callLater(0, worker._amqp_connected, amq_client)
@@ -1,35 +1,72 @@
 # -*- test-case-name: vumi.tests.test_message -*-
 
+import re
 import json
+from copy import deepcopy
+from collections import Mapping, MutableMapping
 from uuid import uuid4
 from datetime import datetime
 
-from errors import MissingMessageField, InvalidMessageField
+from errors import MissingMessageField, InvalidMessageField, VumiError
 
 from vumi.utils import to_kwargs
 
+try:
+    # simplejson ships C speedups for both encoding and decoding.
+    import simplejson as fast_json
+except ImportError:
+    fast_json = json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 
 # This is the date format we work with internally
 VUMI_DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
 
+# Every string that can be parsed with VUMI_DATE_FORMAT starts like this, so
+# we can cheaply skip strptime() for the vast majority of values.
+VUMI_DATE_PREFIX_RE = re.compile(r'\d{4}-')
 
-def date_time_decoder(json_object):
-    for key, value in json_object.items():
+
+def decode_date_time(value):
+    """
+    Return ``value`` as a :class:`datetime` if it is a string in
+    :data:`VUMI_DATE_FORMAT`, otherwise return it unchanged.
+    """
+    if isinstance(value, basestring) and VUMI_DATE_PREFIX_RE.match(value):
         try:
-            json_object[key] = datetime.strptime(value,
-                    VUMI_DATE_FORMAT)
+            return datetime.strptime(value, VUMI_DATE_FORMAT)
         except ValueError:
-            continue
-        except TypeError:
-            continue
+            pass
+    return value
+
+
+def date_time_decoder(json_object):
+    for key, value in json_object.items():
+        json_object[key] = decode_date_time(value)
     return json_object
 
 
+def date_time_encoder(obj):
+    if isinstance(obj, datetime):
+        return obj.strftime(VUMI_DATE_FORMAT)
+    if isinstance(obj, Mapping):
+        # e.g. the payload of a compact message.
+        return dict(obj)
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+
 class JSONMessageEncoder(json.JSONEncoder):
-    """A JSON encoder that is able to serialize datetime"""
+    """A JSON encoder that is able to serialize datetime and mappings
+    that aren't dicts (such as compact message payloads)"""
     def default(self, obj):
         if isinstance(obj, datetime):
             return obj.strftime(VUMI_DATE_FORMAT)
+        if isinstance(obj, Mapping):
+            return dict(obj)
         return super(JSONMessageEncoder, self).default(obj)
 
 
@@ -41,6 +78,192 @@ def to_json(obj):
     return json.dumps(obj, cls=JSONMessageEncoder)
 
 
+# Payload values of these types are immutable and can be shared by copies.
+IMMUTABLE_TYPES = frozenset([
+    str, unicode, int, long, float, bool, type(None), datetime])
+
+
+def copy_payload(value):
+    """
+    Return a structural copy of a message payload (or part of one).
+
+    Dictionaries and lists are copied recursively, immutable values are
+    shared and anything else is deep-copied. This gives the same result as
+    an encode/decode round trip for everything that survives one, at a
+    fraction of the cost.
+    """
+    value_type = type(value)
+    if value_type in IMMUTABLE_TYPES:
+        return value
+    if value_type is dict:
+        return dict((k, copy_payload(v)) for k, v in value.iteritems())
+    if value_type is list:
+        return [copy_payload(v) for v in value]
+    return deepcopy(value)
+
+
+class MessageCodecError(VumiError):
+    pass
+
+
+class MessageCodec(object):
+    """
+    Base class for message codecs.
+
+    A codec converts message payloads to and from the bytes we put on the
+    wire. The :attr:`content_type` is sent as the AMQP ``content type``
+    property so that consumers can pick the right codec for each message.
+
+    :param bool decode_all_dates:
+        If ``True``, every string value in the decoded payload (including
+        those in nested dictionaries) that parses as a
+        :data:`VUMI_DATE_FORMAT` timestamp is converted to a
+        :class:`datetime`. This is the historical behaviour. If ``False``,
+        only the top-level fields named in the message class's
+        ``DATE_TIME_FIELDS`` are converted.
+    """
+
+    content_type = None
+
+    def __init__(self, decode_all_dates=True):
+        self.decode_all_dates = decode_all_dates
+
+    def encode(self, payload):
+        raise NotImplementedError("Subclasses should implement this.")
+
+    def decode(self, data, date_time_fields=()):
+        raise NotImplementedError("Subclasses should implement this.")
+
+    def decode_fields(self, payload, date_time_fields):
+        for field in date_time_fields:
+            if field in payload:
+                payload[field] = decode_date_time(payload[field])
+        return payload
+
+    def encode_message(self, message):
+        return self.encode(message.payload)
+
+    def decode_message(self, message_class, data):
+        payload = self.decode(data, message_class.DATE_TIME_FIELDS)
+        return message_class(_process_fields=False, **to_kwargs(payload))
+
+
+class JSONMessageCodec(MessageCodec):
+    """
+    Message codec for JSON.
+
+    :param json_module:
+        Module providing ``dumps()`` and ``loads()``. Defaults to the
+        standard library :mod:`json` module.
+    """
+
+    content_type = 'application/json'
+
+    def __init__(self, decode_all_dates=True, json_module=json):
+        super(JSONMessageCodec, self).__init__(decode_all_dates)
+        self.json = json_module
+
+    def encode(self, payload):
+        return self.json.dumps(payload, default=date_time_encoder)
+
+    def decode(self, data, date_time_fields=()):
+        if self.decode_all_dates:
+            return self.json.loads(data, object_hook=date_time_decoder)
+        return self.decode_fields(self.json.loads(data), date_time_fields)
+
+
+class MsgpackMessageCodec(MessageCodec):
+    """
+    Message codec for msgpack, a compact binary encoding.
+
+    Requires the optional ``msgpack`` package.
+    """
+
+    content_type = 'application/x-msgpack'
+
+    def __init__(self, decode_all_dates=True):
+        if msgpack is None:
+            raise MessageCodecError(
+                "The msgpack codec requires the msgpack package.")
+        super(MsgpackMessageCodec, self).__init__(decode_all_dates)
+
+    def encode(self, payload):
+        return msgpack.packb(payload, default=date_time_encoder,
+                             use_bin_type=True)
+
+    def decode(self, data, date_time_fields=()):
+        if self.decode_all_dates:
+            return msgpack.unpackb(data, raw=False,
+                                   object_hook=date_time_decoder)
+        return self.decode_fields(msgpack.unpackb(data, raw=False),
+                                  date_time_fields)
+
+
+class FastJSONMessageCodec(JSONMessageCodec):
+    """
+    JSON message codec that uses simplejson if it's available and only
+    decodes the timestamp fields the message class declares.
+    """
+
+    def __init__(self, decode_all_dates=False, json_module=fast_json):
+        super(FastJSONMessageCodec, self).__init__(decode_all_dates,
+                                                   json_module)
+
+
+class FastMsgpackMessageCodec(MsgpackMessageCodec):
+    """
+    Msgpack message codec that only decodes the timestamp fields the
+    message class declares.
+    """
+
+    def __init__(self, decode_all_dates=False):
+        super(FastMsgpackMessageCodec, self).__init__(decode_all_dates)
+
+
+MESSAGE_CODECS = {
+    'json': JSONMessageCodec,
+    'fast_json': FastJSONMessageCodec,
+    'msgpack': MsgpackMessageCodec,
+    'fast_msgpack': FastMsgpackMessageCodec,
+}
+
+DEFAULT_MESSAGE_CODEC = JSONMessageCodec()
+
+
+def get_message_codec(name):
+    """
+    Build a message codec by name.
+
+    :param str name:
+        One of the names in :data:`MESSAGE_CODECS`. ``None`` returns the
+        default JSON codec.
+    """
+    if name is None:
+        return DEFAULT_MESSAGE_CODEC
+    if name not in MESSAGE_CODECS:
+        raise MessageCodecError("Unknown message codec %r." % (name,))
+    return MESSAGE_CODECS[name]()
+
+
+def codec_for_content_type(content_type, preferred=None):
+    """
+    Return a codec able to decode messages of the given ``content_type``.
+
+    The ``preferred`` codec is used if it handles ``content_type``. Messages
+    without a content type, or with one we don't have a codec for, are
+    assumed to be JSON, since that's what every producer used to send.
+    """
+    if preferred is None:
+        preferred = DEFAULT_MESSAGE_CODEC
+    if content_type == MsgpackMessageCodec.content_type:
+        if preferred.content_type == content_type:
+            return preferred
+        return MsgpackMessageCodec(preferred.decode_all_dates)
+    if preferred.content_type == JSONMessageCodec.content_type:
+        return preferred
+    return JSONMessageCodec(preferred.decode_all_dates)
+
+
 class Message(object):
     """
     Start of a somewhat unified message object to be
@@ -51,6 +274,9 @@ class Message(object):
 
     """
 
+    # Top-level fields holding datetimes, for codecs that only decode those.
+    DATE_TIME_FIELDS = ()
+
     def __init__(self, _process_fields=True, **kwargs):
         if _process_fields:
             kwargs = self.process_fields(kwargs)
@@ -80,6 +306,17 @@ class Message(object):
     def from_json(cls, json_string):
         return cls(_process_fields=False, **to_kwargs(from_json(json_string)))
 
+    def encode(self, codec=None):
+        if codec is None:
+            codec = DEFAULT_MESSAGE_CODEC
+        return codec.encode_message(self)
+
+    @classmethod
+    def decode(cls, data, codec=None):
+        if codec is None:
+            codec = DEFAULT_MESSAGE_CODEC
+        return codec.decode_message(cls, data)
+
     def __str__(self):
         return u"<Message payload=\"%s\">" % repr(self.payload)
 
@@ -107,7 +344,8 @@ class Message(object):
         return self.payload.items()
 
     def copy(self):
-        return self.from_json(self.to_json())
+        return self.__class__(
+            _process_fields=False, **to_kwargs(copy_payload(self.payload)))
 
 
 class TransportMessage(Message):
@@ -116,6 +354,7 @@ class TransportMessage(Message):
     # sub-classes should set the message type
     MESSAGE_TYPE = None
     MESSAGE_VERSION = '20110921'
+    DATE_TIME_FIELDS = ('timestamp',)
 
     @staticmethod
     def generate_id():
@@ -318,3 +557,176 @@ class TransportEvent(TransportMessage):
             self.assert_field_present(extra_field)
             if not check(self[extra_field]):
                 raise InvalidMessageField(extra_field)
+
+
+class CompactPayload(MutableMapping):
+    """
+    Dictionary view of the fields of a compact message.
+
+    This is what :attr:`payload` returns on compact messages, so existing
+    code that reads or modifies ``msg.payload`` keeps working.
+    """
+
+    __slots__ = ('_message',)
+
+    def __init__(self, message):
+        self._message = message
+
+    def __getitem__(self, key):
+        return self._message[key]
+
+    def __setitem__(self, key, value):
+        self._message[key] = value
+
+    def __delitem__(self, key):
+        self._message._del_field(key)
+
+    def __iter__(self):
+        return self._message._iter_fields()
+
+    def __len__(self):
+        return len(list(self._message._iter_fields()))
+
+    def __contains__(self, key):
+        return key in self._message
+
+    def __repr__(self):
+        return repr(self._message.as_dict())
+
+
+class CompactMessageMixin(object):
+    """
+    Mixin that stores the standard fields of a message in slots.
+
+    Subclasses must list the standard fields in ``COMPACT_FIELDS`` and
+    declare ``__slots__`` using :func:`compact_slots`. Fields not listed
+    are kept in a dictionary that is only created when needed.
+
+    Compact messages are interchangeable with the ordinary message classes
+    they extend but use considerably less memory, which matters for workers
+    holding large numbers of messages in memory.
+    """
+
+    __slots__ = ()
+
+    COMPACT_FIELDS = ()
+
+    @classmethod
+    def from_message(cls, message):
+        """Build a compact copy of ``message``."""
+        return cls(_process_fields=False,
+                   **to_kwargs(copy_payload(message.payload)))
+
+    def _get_payload(self):
+        return CompactPayload(self)
+
+    def _set_payload(self, payload):
+        self._extras = None
+        for key, value in payload.iteritems():
+            self[key] = value
+
+    payload = property(_get_payload, _set_payload)
+
+    def _iter_fields(self):
+        for field in self.COMPACT_FIELDS:
+            if hasattr(self, '_f_' + field):
+                yield field
+        if self._extras is not None:
+            for key in self._extras.keys():
+                yield key
+
+    def _del_field(self, key):
+        if key in self.COMPACT_FIELDS:
+            try:
+                delattr(self, '_f_' + key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extras is not None:
+            del self._extras[key]
+        else:
+            raise KeyError(key)
+
+    def __getitem__(self, key):
+        if key in self.COMPACT_FIELDS:
+            try:
+                return getattr(self, '_f_' + key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extras is None:
+            raise KeyError(key)
+        return self._extras[key]
+
+    def __setitem__(self, key, value):
+        if key in self.COMPACT_FIELDS:
+            setattr(self, '_f_' + key, value)
+        else:
+            if self._extras is None:
+                self._extras = {}
+            self._extras[key] = value
+
+    def __contains__(self, key):
+        if key in self.COMPACT_FIELDS:
+            return hasattr(self, '_f_' + key)
+        return self._extras is not None and key in self._extras
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        return [(key, self[key]) for key in self._iter_fields()]
+
+    def as_dict(self):
+        """Return the message fields as an ordinary dictionary."""
+        return dict(self.items())
+
+    def to_json(self):
+        return to_json(self.as_dict())
+
+    def encode(self, codec=None):
+        if codec is None:
+            codec = DEFAULT_MESSAGE_CODEC
+        return codec.encode(self.as_dict())
+
+    def copy(self):
+        return self.__class__(
+            _process_fields=False, **to_kwargs(copy_payload(self.as_dict())))
+
+
+def compact_slots(fields):
+    """Return the ``__slots__`` for a compact message with these fields."""
+    return tuple('_f_' + field for field in fields) + ('_extras',)
+
+
+class CompactTransportUserMessage(CompactMessageMixin, TransportUserMessage):
+    """A :class:`TransportUserMessage` that stores its fields in slots."""
+
+    COMPACT_FIELDS = frozenset([
+        'message_version', 'message_type', 'timestamp', 'message_id',
+        'to_addr', 'from_addr', 'in_reply_to', 'session_event', 'content',
+        'transport_name', 'transport_type', 'transport_metadata',
+        'helper_metadata', 'group'])
+
+    __slots__ = compact_slots(COMPACT_FIELDS)
+
+
+class CompactTransportEvent(CompactMessageMixin, TransportEvent):
+    """A :class:`TransportEvent` that stores its fields in slots."""
+
+    COMPACT_FIELDS = frozenset([
+        'message_version', 'message_type', 'timestamp', 'event_id',
+        'event_type', 'user_message_id', 'sent_message_id', 'nack_reason',
+        'delivery_status', 'transport_name', 'transport_metadata',
+        'helper_metadata'])
+
+    __slots__ = compact_slots(COMPACT_FIELDS)
+
+
+# The compact classes to decode messages into when a worker's
+# `compact_messages` config option is set.
+COMPACT_MESSAGE_CLASSES = {
+    TransportUserMessage: CompactTransportUserMessage,
+    TransportEvent: CompactTransportEvent,
+}
@@ -0,0 +1,94 @@
+# -*- test-case-name: vumi.persist.tests.test_cache -*-
+
+"""An in-process LRU cache for persisted records."""
+
+from collections import OrderedDict
+
+from twisted.internet import reactor
+
+
+class LRUCache(object):
+    """A least-recently-used cache with optional expiry.
+
+    :param int max_size:
+        The maximum number of entries to hold. Once the cache is full the
+        least recently used entry is evicted to make room for a new one.
+    :param float ttl:
+        The number of seconds an entry stays valid for. If `None`, entries
+        only leave the cache when they're evicted or invalidated.
+    :param clock:
+        Anything with a ``seconds()`` method. Defaults to the reactor.
+    """
+
+    def __init__(self, max_size, ttl=None, clock=None):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1, not %r"
+                             % (max_size,))
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock if clock is not None else reactor
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Return the value for `key`, or `default` if it isn't cached or
+        has expired.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires, value = entry
+        if expires is not None and expires <= self.clock.seconds():
+            self.misses += 1
+            return default
+        # Re-inserting moves the key to the most recently used end.
+        self._entries[key] = entry
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Cache `value` under `key`, evicting old entries if necessary."""
+        self._entries.pop(key, None)
+        expires = None
+        if self.ttl is not None:
+            expires = self.clock.seconds() + self.ttl
+        self._entries[key] = (expires, value)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """Remove `key` from the cache if it's there."""
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove everything from the cache."""
+        self._entries.clear()
+
+    def hit_rate(self):
+        """Return the fraction of lookups that were hits, or `None` if
+        there haven't been any lookups yet.
+        """
+        lookups = self.hits + self.misses
+        if not lookups:
+            return None
+        return float(self.hits) / lookups
+
+    def get_stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate(),
+        }
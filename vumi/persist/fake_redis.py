@@ -1,6 +1,7 @@
 # -*- test-case-name: vumi.persist.tests.test_fake_redis -*-
 
 import fnmatch
+import hashlib
 from functools import wraps
 from itertools import takewhile, dropwhile
 
@@ -44,6 +45,7 @@ class FakeRedis(object):
         self.clock = Clock()
         self._charset = charset
         self._charset_errors = errors
+        self._scripts = {}
 
     def teardown(self):
         self._clean_up_expires()
@@ -91,6 +93,20 @@ class FakeRedis(object):
     def keys(self, pattern='*'):
         return fnmatch.filter(self._data.keys(), pattern)
 
+    @maybe_async
+    def scan(self, cursor, match=None, count=None):
+        # The cursor is an offset into the sorted keys. Like the real
+        # thing, we look at `count` keys and then filter them.
+        cursor = int(cursor)
+        count = 10 if count is None else int(count)
+        keys = sorted(self._data.keys())[cursor:cursor + count]
+        next_cursor = cursor + len(keys)
+        if next_cursor >= len(self._data):
+            next_cursor = 0
+        if match is not None:
+            keys = fnmatch.filter(keys, match)
+        return next_cursor, keys
+
     @maybe_async
     def flushdb(self):
         self._data = {}
@@ -396,6 +412,93 @@ class FakeRedis(object):
             return 1
         return 0
 
+    # Scripting operations
+
+    def register_script_emulation(self, lua_source, emulation):
+        """Provide a Python function to run in place of a Lua script.
+
+        The function is called with a synchronous client, the list of keys
+        and the list of other arguments. Since we can't run Lua, this also
+        loads the script.
+        """
+        self._scripts[hashlib.sha1(lua_source).hexdigest()] = emulation
+
+    @maybe_async
+    def script_load(self, script):
+        sha = hashlib.sha1(script).hexdigest()
+        if sha not in self._scripts:
+            raise Exception("No emulation registered for script: %r" % (
+                script,))
+        return sha
+
+    @maybe_async
+    def eval(self, script, numkeys, *keys_and_args):
+        sha = self.script_load.sync(self, script)
+        return self.evalsha.sync(self, sha, numkeys, *keys_and_args)
+
+    @maybe_async
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        if sha not in self._scripts:
+            raise Exception("NOSCRIPT No matching script.")
+        emulation = self._scripts[sha]
+        return emulation(SyncFakeRedis(self), list(keys_and_args[:numkeys]),
+                         list(keys_and_args[numkeys:]))
+
+    # Pipelines
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self, transaction)
+
+    @maybe_async
+    def _execute_pipeline(self, calls):
+        # Everything runs in one go, so it's atomic whether or not it was
+        # asked to be a transaction.
+        return [getattr(type(self), name).sync(self, *args, **kw)
+                for name, args, kw in calls]
+
+
+class SyncFakeRedis(object):
+    """Synchronous view of a :class:`FakeRedis` for script emulations."""
+
+    def __init__(self, redis):
+        self._redis = redis
+
+    def __getattr__(self, name):
+        func = getattr(type(self._redis), name).sync
+        return lambda *args, **kw: func(self._redis, *args, **kw)
+
+
+class FakePipeline(object):
+    """Queue of calls on a :class:`FakeRedis` executed together.
+
+    Like the redis module's pipelines, each queued call returns the pipeline
+    so calls can be chained.
+    """
+
+    def __init__(self, redis, transaction=True):
+        self._redis = redis
+        self._transaction = transaction
+        self._calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not hasattr(self._redis, name):
+            raise AttributeError(name)
+
+        def queue_call(*args, **kw):
+            self._calls.append((name, args, kw))
+            return self
+        return queue_call
+
+    def __len__(self):
+        return len(self._calls)
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return self._redis._execute_pipeline(calls)
+
+    def reset(self):
+        self._calls = []
+
 
 class Zset(object):
     """A Redis-like ordered set implementation."""
@@ -13,7 +13,16 @@ class ValidationError(Exception):
 
 
 class FieldDescriptor(object):
-    """Property for getting and setting fields."""
+    """Property for getting and setting fields.
+
+    Values are only decoded from the raw Riak data when they're first
+    accessed and are then remembered until the field is set or the
+    model's data is replaced. Descriptors that return proxies onto the
+    raw data or mutable values (which could be changed without being
+    saved) set :attr:`memoize` to `False`.
+    """
+
+    memoize = True
 
     def __init__(self, key, field):
         self.key = key
@@ -77,12 +86,18 @@ class FieldDescriptor(object):
     def __get__(self, instance, owner):
         if instance is None:
             return self.field
-        return self.get_value(instance)
+        if not self.memoize:
+            return self.get_value(instance)
+        decoded = instance._decoded_values()
+        if self.key not in decoded:
+            decoded[self.key] = self.get_value(instance)
+        return decoded[self.key]
 
     def __set__(self, instance, value):
         # instance can never be None here
         self.validate(value)
         self.set_value(instance, value)
+        instance._decoded_values().pop(self.key, None)
 
 
 class Field(object):
@@ -230,14 +245,24 @@ class Timestamp(Field):
         return datetime.strptime(value, VUMI_DATE_FORMAT)
 
 
+class JsonDescriptor(FieldDescriptor):
+    """Property for getting and setting JSON fields."""
+
+    # Decoded values are usually dicts or lists.
+    memoize = False
+
+
 class Json(Field):
     """Field that stores an object that can be serialized to/from JSON."""
-    pass
+    descriptor_class = JsonDescriptor
 
 
 class VumiMessageDescriptor(FieldDescriptor):
     """Property for getting and setting fields."""
 
+    # Messages are mutable.
+    memoize = False
+
     def setup(self, model_cls):
         super(VumiMessageDescriptor, self).setup(model_cls)
         if self.field.prefix is None:
@@ -336,6 +361,9 @@ class FieldWithSubtype(Field):
 
 class DynamicDescriptor(FieldDescriptor):
     """A field descriptor for dynamic fields."""
+
+    memoize = False
+
     def setup(self, model_cls):
         super(DynamicDescriptor, self).setup(model_cls)
         if self.field.prefix is None:
@@ -458,6 +486,8 @@ class Dynamic(FieldWithSubtype):
 class ListOfDescriptor(FieldDescriptor):
     """A field descriptor for ListOf fields."""
 
+    memoize = False
+
     def get_value(self, modelobj):
         return ListProxy(self, modelobj)
 
@@ -543,6 +573,8 @@ class ListOf(FieldWithSubtype):
 
 
 class ForeignKeyDescriptor(FieldDescriptor):
+    memoize = False
+
     def setup(self, model_cls):
         super(ForeignKeyDescriptor, self).setup(model_cls)
         self.other_model = self.field.other_model
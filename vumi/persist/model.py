@@ -2,9 +2,13 @@
 
 """Base classes for Vumi persistence models."""
 
+import json
+import urllib
+from copy import deepcopy
 from functools import wraps
 
-from vumi.errors import VumiError
+from vumi.errors import VumiError, ConfigError
+from vumi.persist.cache import LRUCache
 from vumi.persist.fields import Field, FieldDescriptor, ValidationError
 
 
@@ -179,6 +183,12 @@ class Model(object):
     VERSION = None
     MIGRATOR = ModelMigrator
 
+    # Set this to True to keep loaded instances in the manager's model
+    # cache (if it has one). Only do this for records that are read far
+    # more often than they're written and aren't modified by other
+    # processes, since cached loads won't see those changes.
+    CACHE_LOADS = False
+
     bucket = None
 
     # TODO: maybe replace .backlinks with a class-level .query
@@ -187,6 +197,8 @@ class Model(object):
     def __init__(self, manager, key, _riak_object=None, **field_values):
         self.manager = manager
         self.key = key
+        self._decoded = {}
+        self._decoded_data = None
         if _riak_object is not None:
             self._riak_object = _riak_object
         else:
@@ -210,6 +222,19 @@ class Model(object):
                         in sorted(self.get_data().items())]
         return "<%s %s>" % (self.__class__.__name__, " ".join(str_items))
 
+    def _decoded_values(self):
+        """Return the field values decoded from the current Riak data.
+
+        The field descriptors fill this in as fields are accessed. It's
+        emptied whenever the Riak object's data is replaced (e.g. by the
+        data returned from a store).
+        """
+        data = self._riak_object._data
+        if data is not self._decoded_data:
+            self._decoded = {}
+            self._decoded_data = data
+        return self._decoded
+
     def clean(self):
         for field_name, descriptor in self.field_descriptors.iteritems():
             descriptor.clean(self)
@@ -272,6 +297,26 @@ class Model(object):
         """
         return manager.mr_from_field(cls, field_name, value)
 
+    @classmethod
+    def index_keys_page(cls, manager, field_name, value, max_results=None,
+                        continuation=None):
+        """Find a page of object keys by index.
+
+        :param int max_results:
+            The most keys to return. If `None`, all the matching keys are
+            returned in a single page.
+        :param str continuation:
+            The continuation returned with the previous page, or `None`
+            for the first page.
+
+        :returns:
+            A (possibly deferred) tuple of ``(keys, continuation)``. The
+            continuation is `None` if there are no more pages.
+        """
+        return manager.index_keys_page(
+            cls, field_name, value, max_results=max_results,
+            continuation=continuation)
+
     @classmethod
     def index_match(cls, manager, query, field_name, value):
         """
@@ -326,6 +371,10 @@ class VumiMapReduceError(Exception):
     pass
 
 
+class VumiIndexError(Exception):
+    pass
+
+
 class VumiMapReduce(object):
     def __init__(self, mgr, riak_mapreduce_obj):
         self._has_run = False
@@ -481,18 +530,75 @@ class Manager(object):
     """A wrapper around a Riak client."""
 
     DEFAULT_LOAD_BUNCH_SIZE = 100
+    DEFAULT_MAX_PARALLEL_GETS = 10
+
+    TRANSPORTS = ('http', 'pbc')
+    DEFAULT_PBC_PORT = 8087
 
-    def __init__(self, client, bucket_prefix, load_bunch_size=None):
+    def __init__(self, client, bucket_prefix, load_bunch_size=None,
+                 parallel_gets=False, max_parallel_gets=None,
+                 model_cache_size=None, model_cache_ttl=None):
         self.client = client
         self.bucket_prefix = bucket_prefix
         self.load_bunch_size = load_bunch_size or self.DEFAULT_LOAD_BUNCH_SIZE
+        self.parallel_gets = parallel_gets
+        self.max_parallel_gets = (max_parallel_gets or
+                                  self.DEFAULT_MAX_PARALLEL_GETS)
+        self.model_cache = None
+        if model_cache_size:
+            self.model_cache = LRUCache(model_cache_size, model_cache_ttl)
         self._bucket_cache = {}
 
     def proxy(self, modelcls):
         return ModelProxy(self, modelcls)
 
     def sub_manager(self, sub_prefix):
-        return self.__class__(self.client, self.bucket_prefix + sub_prefix)
+        sub_manager = self.__class__(
+            self.client, self.bucket_prefix + sub_prefix,
+            load_bunch_size=self.load_bunch_size,
+            parallel_gets=self.parallel_gets,
+            max_parallel_gets=self.max_parallel_gets)
+        # Cache keys include the bucket name, so the cache can be shared.
+        sub_manager.model_cache = self.model_cache
+        return sub_manager
+
+    @classmethod
+    def _load_options_from_config(cls, config):
+        """Pop the loading and caching options out of a config dict."""
+        return {
+            'load_bunch_size': config.pop('load_bunch_size',
+                                          cls.DEFAULT_LOAD_BUNCH_SIZE),
+            'parallel_gets': config.pop('parallel_gets', False),
+            'max_parallel_gets': config.pop('max_parallel_gets',
+                                            cls.DEFAULT_MAX_PARALLEL_GETS),
+            'model_cache_size': config.pop('model_cache_size', None),
+            'model_cache_ttl': config.pop('model_cache_ttl', None),
+        }
+
+    @classmethod
+    def _transport_from_config(cls, config):
+        """Pop the transport name out of a config dict.
+
+        Riak listens for protocol buffers clients on a different port to
+        HTTP clients, so if the ``pbc`` transport is selected and no port
+        is given, the port is set to :attr:`DEFAULT_PBC_PORT`.
+        """
+        transport = config.pop('transport', 'http')
+        if transport not in cls.TRANSPORTS:
+            raise ConfigError("Unknown Riak transport %r (expected one of %s)"
+                              % (transport, ", ".join(cls.TRANSPORTS)))
+        if transport == 'pbc':
+            config.setdefault('port', cls.DEFAULT_PBC_PORT)
+        return transport
+
+    def close_manager(self):
+        """Close any connections the client is holding open.
+
+        The client is shared with sub-managers, so this closes their
+        connections too.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " .close_manager()")
 
     def bucket_name(self, modelcls_or_obj):
         return self.bucket_prefix + modelcls_or_obj.bucket
@@ -561,14 +667,74 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " .load(...)")
 
+    def _model_cache_key(self, modelcls, key):
+        return (self.bucket_name(modelcls), key)
+
+    def _load_cached(self, modelcls, key):
+        """Build a model instance from the model cache.
+
+        Each call returns a new instance with its own copy of the cached
+        data, so callers are free to modify it.
+
+        :returns:
+            The model instance, or `None` if there's no cached copy.
+        """
+        if self.model_cache is None or not modelcls.CACHE_LOADS:
+            return None
+        cached = self.model_cache.get(self._model_cache_key(modelcls, key))
+        if cached is None:
+            return None
+        data, metadata, vclock = cached
+        riak_object = self.riak_object(modelcls, key)
+        riak_object.set_metadata(deepcopy(metadata))
+        riak_object.set_data(deepcopy(data))
+        # Keep the vclock so that storing the object again doesn't create
+        # a sibling.
+        riak_object._vclock = vclock
+        return modelcls(self, key, _riak_object=riak_object)
+
+    def _cache_model_object(self, modelobj):
+        """Put a copy of a freshly loaded or stored object in the model
+        cache.
+        """
+        if self.model_cache is None or not modelobj.CACHE_LOADS:
+            return
+        riak_object = modelobj._riak_object
+        self.model_cache.put(
+            self._model_cache_key(type(modelobj), modelobj.key),
+            (deepcopy(riak_object.get_data()),
+             deepcopy(riak_object.get_metadata()),
+             riak_object.vclock()))
+
+    def _uncache_model_object(self, modelobj):
+        if self.model_cache is not None:
+            self.model_cache.invalidate(
+                self._model_cache_key(type(modelobj), modelobj.key))
+
+    def get_model_cache_stats(self):
+        """Return the model cache's hit and miss counts, or `None` if
+        there's no model cache.
+        """
+        if self.model_cache is None:
+            return None
+        return self.model_cache.get_stats()
+
     def _load_bunch(self, model, keys):
         """Load the model instances for a batch of keys from Riak.
 
-        If a key doesn't exist, no object will be returned for it.
+        If a key doesn't exist, no object will be returned for it. The
+        objects are fetched with a MapReduce job unless the manager was
+        created with ``parallel_gets`` set, in which case they're fetched
+        with individual GETs.
         """
         assert len(keys) <= self.load_bunch_size
         if not keys:
             return []
+        if self.parallel_gets:
+            return self._load_bunch_parallel(model, keys)
+        return self._load_bunch_mapreduce(model, keys)
+
+    def _load_bunch_mapreduce(self, model, keys):
         mr = self.mr_from_keys(model, keys)
         mr._riak_mapreduce_obj.map(function="""
                 function (v) {
@@ -578,6 +744,13 @@ class Manager(object):
         return self.run_map_reduce(
             mr._riak_mapreduce_obj, lambda mgr, obj: model.load(mgr, *obj))
 
+    def _load_bunch_parallel(self, model, keys):
+        """Load a batch of keys with at most ``max_parallel_gets`` GETs in
+        flight at a time.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " ._load_bunch_parallel(...)")
+
     def load_all_bunches(self, model, keys):
         """Load batches of model instances for a list of keys from Riak.
 
@@ -624,6 +797,52 @@ class Manager(object):
     def mr_from_keys(self, model, keys):
         return VumiMapReduce.from_keys(self, model, keys)
 
+    def index_keys_page(self, model, field_name, start_value, end_value=None,
+                        max_results=None, continuation=None):
+        """Fetch a page of keys from a secondary index query.
+
+        Pages are fetched using Riak's 2i pagination, so this needs Riak
+        1.4 or later if ``max_results`` is given.
+
+        :returns:
+            A (possibly deferred) tuple of ``(keys, continuation)``. The
+            continuation is `None` if there are no more pages.
+        """
+        index_name, sv, ev = VumiMapReduce._index_vals_for_field(
+            model, field_name, start_value, end_value)
+        return self.riak_index_page(
+            model, index_name, sv, ev, max_results, continuation)
+
+    def riak_index_page(self, model, index_name, start_value, end_value,
+                        max_results, continuation):
+        """Run a paginated secondary index query against Riak."""
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " .riak_index_page(...)")
+
+    def _index_page_request(self, model, index_name, start_value, end_value,
+                            max_results, continuation):
+        """Build the path and query parameters for a paginated secondary
+        index query over Riak's HTTP interface.
+        """
+        segments = ["buckets", self.bucket_name(model), "index", index_name,
+                    start_value]
+        if end_value is not None:
+            segments.append(end_value)
+        path = "/".join(urllib.quote(s, safe='') for s in segments)
+        params = {
+            'max_results': max_results,
+            'continuation': continuation,
+        }
+        return path, params
+
+    def _index_page_from_response(self, response):
+        headers, body = response
+        if headers['http_code'] != 200:
+            raise VumiIndexError("Error running index query. Headers: %r"
+                                 " Body: %r" % (headers, body))
+        result = json.loads(body)
+        return result['keys'], result.get('continuation')
+
     def riak_enable_search(self, model):
         """Enable search indexing for the model's bucket."""
         raise NotImplementedError("Sub-classes of Manager should implement"
@@ -657,6 +876,12 @@ class ModelProxy(object):
     def index_lookup(self, field_name, value):
         return self._modelcls.index_lookup(self._manager, field_name, value)
 
+    def index_keys_page(self, field_name, value, max_results=None,
+                        continuation=None):
+        return self._modelcls.index_keys_page(
+            self._manager, field_name, value, max_results=max_results,
+            continuation=continuation)
+
     def index_match(self, query, field_name, value):
         return self._modelcls.index_match(self._manager, query, field_name,
                                             value)
@@ -1,6 +1,7 @@
 # -*- test-case-name: vumi.persist.tests.test_redis_base -*-
 
 import os
+import hashlib
 from functools import wraps
 
 from vumi.persist.ast_magic import make_function
@@ -44,6 +45,24 @@ class RedisCall(object):
         self.key_args = key_args
 
 
+class RedisScript(object):
+    """A Lua script to be run on the redis server.
+
+    :param str lua_source:
+        The script itself. Keys are passed in ``KEYS`` and other arguments
+        in ``ARGV``, as for redis's ``EVAL`` command.
+    :param emulation:
+        A function taking ``(redis, keys, args)`` that does the same thing
+        as the script in Python. This is used with :class:`FakeRedis`,
+        which passes in a synchronous client to make calls on.
+    """
+
+    def __init__(self, lua_source, emulation=None):
+        self.lua_source = lua_source
+        self.sha = hashlib.sha1(lua_source).hexdigest()
+        self.emulation = emulation
+
+
 class CallMakerMetaclass(type):
     def __new__(meta, classname, bases, class_dict):
         new_class_dict = {}
@@ -151,6 +170,62 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " ._manager_from_config(...)")
 
+    def pipeline(self, transaction=False):
+        """Return a :class:`RedisPipeline` for batching calls.
+
+        Calls made on the pipeline are queued (with this manager's key
+        prefix applied) and sent together when its ``execute()`` method is
+        called. ``execute()`` returns (a deferred firing with, for async
+        managers) the list of results, in the order the calls were made.
+
+        :param bool transaction:
+            If ``True``, the calls are wrapped in MULTI/EXEC so they are
+            applied atomically. Not all managers support this.
+        """
+        return RedisPipeline(self, transaction)
+
+    def _execute_pipeline(self, calls, filters, transaction):
+        """Send queued pipeline calls to redis and return their results.
+
+        :param list calls:
+            ``(call_name, args, kwargs)`` tuples, in order.
+        :param dict filters:
+            Filter functions to apply, keyed by the index of the call whose
+            result they filter.
+        """
+        pipe = self._client.pipeline(transaction=transaction)
+        for call, args, kw in calls:
+            getattr(pipe, call)(*args, **kw)
+        return self._filter_redis_results(
+            lambda results: self._filter_pipeline_results(filters, results),
+            pipe.execute())
+
+    def _filter_pipeline_results(self, filters, results):
+        results = list(results)
+        for index, func in filters.iteritems():
+            results[index] = func(results[index])
+        return results
+
+    def run_script(self, script, keys=(), args=()):
+        """Run a :class:`RedisScript` on the server.
+
+        The script is run with ``EVALSHA``, falling back to ``EVAL`` (which
+        caches it on the server) if the server hasn't seen it yet.
+
+        :param RedisScript script:
+            The script to run.
+        :param list keys:
+            Keys the script accesses. These have the manager's key prefix
+            added.
+        :param list args:
+            Other arguments for the script.
+        """
+        if isinstance(self._client, FakeRedis):
+            self._client.register_script_emulation(
+                script.lua_source, script.emulation)
+        return self._run_script(
+            script, [self._key(key) for key in keys], list(args))
+
     def close_manager(self):
         return self._close()
 
@@ -179,6 +254,12 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " ._filter_redis_results()")
 
+    def _run_script(self, script, keys, args):
+        """Run a script with already prefixed keys.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " ._run_script()")
+
     def _key(self, key):
         """
         Generate a key using this manager's key prefix
@@ -199,12 +280,18 @@ class Manager(object):
     def _unkeys(self, keys):
         return [self._unkey(k) for k in keys]
 
+    def _unkey_scan(self, result):
+        cursor, keys = result
+        return cursor, self._unkeys(keys)
+
     # Global operations
 
     type = RedisCall(['key'])
     exists = RedisCall(['key'])
     keys = RedisCall(['pattern'], defaults=['*'], key_args=['pattern'],
                      filter_func='_unkeys')
+    scan = RedisCall(['cursor', 'match', 'count'], defaults=['*', None],
+                     key_args=['match'], filter_func='_unkey_scan')
 
     # String operations
 
@@ -274,3 +361,44 @@ class Manager(object):
     expire = RedisCall(['key', 'seconds'])
     persist = RedisCall(['key'])
     ttl = RedisCall(['key'])
+
+
+class RedisPipeline(Manager):
+    """Queue of redis calls to be sent to the server in one go.
+
+    Created by :meth:`Manager.pipeline`. It has the same redis call methods
+    as a manager, but they return the index of the call's result in the list
+    returned by :meth:`execute` instead of the result itself.
+    """
+
+    def __init__(self, manager, transaction=False):
+        Manager.__init__(self, manager._client, manager._key_prefix,
+                         manager._key_separator)
+        self._manager = manager
+        self._transaction = transaction
+        self._calls = []
+        self._filters = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def pipeline(self, transaction=False):
+        raise NotImplementedError("Pipelines can't be nested.")
+
+    def run_script(self, script, keys=(), args=()):
+        raise NotImplementedError("Scripts can't be run in pipelines.")
+
+    def execute(self):
+        """Send the queued calls and return their results."""
+        calls, self._calls = self._calls, []
+        filters, self._filters = self._filters, {}
+        return self._manager._execute_pipeline(
+            calls, filters, self._transaction)
+
+    def _make_redis_call(self, call, *args, **kw):
+        self._calls.append((call, args, kw))
+        return len(self._calls) - 1
+
+    def _filter_redis_results(self, func, index):
+        self._filters[index] = func
+        return index
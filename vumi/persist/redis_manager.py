@@ -1,12 +1,27 @@
 # -*- test-case-name: vumi.persist.tests.test_redis_manager -*-
 
 import redis
+from redis.exceptions import NoScriptError
 
 from vumi.persist.redis_base import Manager
 from vumi.persist.fake_redis import FakeRedis
 from vumi.utils import flatten_generator
 
 
+class VumiRedis(redis.Redis):
+    """Wrapper around redis.Redis adding the commands we need that it lacks.
+    """
+
+    def scan(self, cursor, match=None, count=None):
+        args = [cursor]
+        if match is not None:
+            args.extend(['MATCH', match])
+        if count is not None:
+            args.extend(['COUNT', count])
+        cursor, keys = self.execute_command('SCAN', *args)
+        return long(cursor), keys
+
+
 class RedisManager(Manager):
 
     call_decorator = staticmethod(flatten_generator)
@@ -30,7 +45,7 @@ class RedisManager(Manager):
             Key prefix for namespacing.
         """
 
-        return cls(redis.Redis(**config), key_prefix, key_separator)
+        return cls(VumiRedis(**config), key_prefix, key_separator)
 
     def _close(self):
         """Close redis connection."""
@@ -44,6 +59,19 @@ class RedisManager(Manager):
         for key in self.keys():
             self.delete(key)
 
+    def scan_iter(self, match='*', count=None):
+        """Iterate over the keys matching ``match`` using SCAN.
+
+        Unlike :meth:`keys`, this doesn't block the server while the whole
+        keyspace is searched. Keys may be returned more than once if they
+        are modified during the iteration.
+        """
+        cursor = None
+        while cursor != 0:
+            cursor, keys = self.scan(cursor or 0, match=match, count=count)
+            for key in keys:
+                yield key
+
     def _make_redis_call(self, call, *args, **kw):
         """Make a redis API call using the underlying client library.
         """
@@ -53,3 +81,12 @@ class RedisManager(Manager):
         """Filter results of a redis call.
         """
         return func(results)
+
+    def _run_script(self, script, keys, args):
+        """Run a script with already prefixed keys.
+        """
+        try:
+            return self._client.evalsha(script.sha, len(keys), *(keys + args))
+        except NoScriptError:
+            return self._client.eval(
+                script.lua_source, len(keys), *(keys + args))
@@ -2,7 +2,8 @@
 
 """A manager implementation on top of the riak Python package."""
 
-from riak import RiakClient, RiakObject, RiakMapReduce
+from riak import (RiakClient, RiakObject, RiakMapReduce, RiakHttpTransport,
+                  RiakPbcTransport)
 
 from vumi.persist.model import Manager
 from vumi.utils import flatten_generator
@@ -13,14 +14,28 @@ class RiakManager(Manager):
 
     call_decorator = staticmethod(flatten_generator)
 
+    TRANSPORT_CLASSES = {
+        'http': RiakHttpTransport,
+        'pbc': RiakPbcTransport,
+    }
+
     @classmethod
     def from_config(cls, config):
         config = config.copy()
         bucket_prefix = config.pop('bucket_prefix')
-        load_bunch_size = config.pop('load_bunch_size',
-                                     cls.DEFAULT_LOAD_BUNCH_SIZE)
-        client = RiakClient(**config)
-        return cls(client, bucket_prefix, load_bunch_size=load_bunch_size)
+        load_options = cls._load_options_from_config(config)
+        transport = cls._transport_from_config(config)
+        client = RiakClient(transport_class=cls.TRANSPORT_CLASSES[transport],
+                            **config)
+        return cls(client, bucket_prefix, **load_options)
+
+    def close_manager(self):
+        # Both transports keep idle connections in the client's
+        # connection manager.
+        cm = self.client._cm
+        if cm is not None:
+            while cm.conns:
+                cm.conns.pop().close()
 
     def riak_object(self, modelcls, key, result=None):
         bucket = self.bucket_for_modelcls(modelcls)
@@ -45,12 +60,19 @@ class RiakManager(Manager):
 
     def store(self, modelobj):
         modelobj._riak_object.store()
+        self._cache_model_object(modelobj)
         return modelobj
 
     def delete(self, modelobj):
+        self._uncache_model_object(modelobj)
         modelobj._riak_object.delete()
 
     def load(self, modelcls, key, result=None):
+        if not result:
+            modelobj = self._load_cached(modelcls, key)
+            if modelobj is not None:
+                return modelobj
+
         riak_object = self.riak_object(modelcls, key, result)
         if not result:
             riak_object.reload()
@@ -59,11 +81,18 @@ class RiakManager(Manager):
         while riak_object.get_data() is not None:
             data_version = riak_object.get_data().get('$VERSION', None)
             if data_version == modelcls.VERSION:
-                return modelcls(self, key, _riak_object=riak_object)
+                modelobj = modelcls(self, key, _riak_object=riak_object)
+                self._cache_model_object(modelobj)
+                return modelobj
             migrator = modelcls.MIGRATOR(modelcls, self, data_version)
             riak_object = migrator(riak_object).get_riak_object()
         return None
 
+    def _load_bunch_parallel(self, model, keys):
+        # This client is synchronous, so the GETs happen one at a time.
+        objs = [model.load(self, key) for key in keys]
+        return [obj for obj in objs if obj is not None]
+
     def riak_map_reduce(self):
         return RiakMapReduce(self.client)
 
@@ -75,6 +104,21 @@ class RiakManager(Manager):
             results = reducer_func(self, results)
         return results
 
+    def riak_index_page(self, model, index_name, start_value, end_value,
+                        max_results, continuation):
+        transport = self.client._transport
+        if not isinstance(transport, RiakHttpTransport):
+            # The riak package's protocol buffers transport can't page
+            # index queries, so we return all the keys as a single page.
+            keys = self.client.get_index(
+                self.bucket_name(model), index_name, start_value, end_value)
+            return keys, None
+        path, params = self._index_page_request(
+            model, index_name, start_value, end_value, max_results,
+            continuation)
+        return self._index_page_from_response(
+            transport.get_request(path, params))
+
     def riak_enable_search(self, modelcls):
         bucket_name = self.bucket_name(modelcls)
         bucket = self.client.bucket(bucket_name)
@@ -0,0 +1,92 @@
+"""Tests for vumi.persist.cache."""
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.task import Clock
+
+from vumi.persist.cache import LRUCache
+
+
+class TestLRUCache(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def mkcache(self, max_size=3, ttl=None):
+        return LRUCache(max_size, ttl=ttl, clock=self.clock)
+
+    def test_invalid_max_size(self):
+        self.assertRaises(ValueError, LRUCache, 0)
+
+    def test_get_and_put(self):
+        cache = self.mkcache()
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.get("a", "default"), "default")
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertTrue("a" in cache)
+        self.assertEqual(len(cache), 1)
+
+    def test_put_replaces(self):
+        cache = self.mkcache()
+        cache.put("a", 1)
+        cache.put("a", 2)
+        self.assertEqual(cache.get("a"), 2)
+        self.assertEqual(len(cache), 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = self.mkcache()
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.put("c", 3)
+        cache.get("a")
+        cache.put("d", 4)
+        self.assertEqual(sorted(cache._entries.keys()), ["a", "c", "d"])
+        self.assertEqual(cache.evictions, 1)
+
+    def test_ttl(self):
+        cache = self.mkcache(ttl=10)
+        cache.put("a", 1)
+        self.clock.advance(9)
+        self.assertEqual(cache.get("a"), 1)
+        self.clock.advance(1)
+        self.assertEqual(cache.get("a"), None)
+        self.assertFalse("a" in cache)
+
+    def test_invalidate(self):
+        cache = self.mkcache()
+        cache.put("a", 1)
+        cache.invalidate("a")
+        cache.invalidate("unknown")
+        self.assertEqual(cache.get("a"), None)
+
+    def test_clear(self):
+        cache = self.mkcache()
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_hit_rate(self):
+        cache = self.mkcache()
+        self.assertEqual(cache.hit_rate(), None)
+        cache.put("a", 1)
+        cache.get("a")
+        cache.get("a")
+        cache.get("a")
+        cache.get("b")
+        self.assertEqual(cache.hit_rate(), 0.75)
+
+    def test_get_stats(self):
+        cache = self.mkcache(max_size=1)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("b")
+        cache.get("a")
+        self.assertEqual(cache.get_stats(), {
+            'size': 1,
+            'max_size': 1,
+            'hits': 1,
+            'misses': 1,
+            'evictions': 1,
+            'hit_rate': 0.5,
+        })
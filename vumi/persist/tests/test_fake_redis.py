@@ -265,6 +265,36 @@ class FakeRedisTestCase(TestCase):
         yield self.assert_redis_op(None, 'ltrim', 'list', 1, 2)
         yield self.assert_redis_op(['2', '3'], 'lrange', 'list', 0, -1)
 
+    @inlineCallbacks
+    def test_scan(self):
+        for key in ['a1', 'a2', 'b1', 'b2', 'c1']:
+            yield self.redis.set(key, 'x')
+        yield self.assert_redis_op((2, ['a1', 'a2']), 'scan', 0, count=2)
+        yield self.assert_redis_op((4, ['b1']), 'scan', 2, '*1', 2)
+        yield self.assert_redis_op((0, ['c1']), 'scan', 4, count=2)
+        yield self.assert_redis_op((0, []), 'scan', 0, 'd*')
+
+    @inlineCallbacks
+    def test_eval(self):
+        lua = "return redis.call('GET', KEYS[1]) .. ARGV[1]"
+        self.redis.register_script_emulation(
+            lua, lambda redis, keys, args: redis.get(keys[0]) + args[0])
+        yield self.redis.set('foo', 'bar')
+        yield self.assert_redis_op('barbaz', 'eval', lua, 1, 'foo', 'baz')
+        sha = yield self.redis.script_load(lua)
+        yield self.assert_redis_op('barquux', 'evalsha', sha, 1, 'foo', 'quux')
+
+    @inlineCallbacks
+    def test_pipeline(self):
+        yield self.redis.set('foo', 'bar')
+        pipe = self.redis.pipeline()
+        self.assertEqual(pipe, pipe.get('foo').set('baz', 'quux'))
+        self.assertEqual(2, len(pipe))
+        yield self.assert_redis_op(None, 'get', 'baz')
+        self.assertEqual(['bar', None], (yield pipe.execute()))
+        yield self.assert_redis_op('quux', 'get', 'baz')
+        self.assertEqual([], (yield pipe.execute()))
+
     @inlineCallbacks
     def test_lrem_negative_num(self):
         for i in range(5):
@@ -1,5 +1,7 @@
 """Tests for vumi.persist.model."""
 
+from datetime import datetime
+
 from twisted.trial.unittest import TestCase
 from twisted.internet.defer import inlineCallbacks, returnValue
 
@@ -7,7 +9,7 @@ from vumi.persist.model import (
     Model, Manager, ModelMigrator, ModelMigrationError)
 from vumi.persist.fields import (
     ValidationError, Integer, Unicode, VumiMessage, Dynamic, ListOf,
-    ForeignKey, ManyToMany)
+    ForeignKey, ManyToMany, Timestamp, Json)
 from vumi.message import TransportUserMessage
 from vumi.tests.utils import import_skip
 
@@ -108,6 +110,97 @@ class UnknownVersionedModel(Model):
     d = Integer()
 
 
+class CountingUnicode(Unicode):
+    decoded = 0
+
+    def custom_from_riak(self, raw_value):
+        CountingUnicode.decoded += 1
+        return super(CountingUnicode, self).custom_from_riak(raw_value)
+
+
+class DecodingModel(Model):
+    a = CountingUnicode(null=True)
+    msg = VumiMessage(TransportUserMessage, null=True)
+    time = Timestamp(null=True)
+    items = ListOf(Integer())
+    data = Json(null=True)
+
+
+class TestFieldDecoding(TestCase):
+    """Tests for lazily decoding field values. These don't talk to Riak."""
+
+    def setUp(self):
+        try:
+            from vumi.persist.txriak_manager import TxRiakManager
+        except ImportError, e:
+            import_skip(e, 'riakasaurus', 'riakasaurus.riak')
+        self.manager = TxRiakManager.from_config({'bucket_prefix': 'test.'})
+        CountingUnicode.decoded = 0
+
+    def mkmsg(self):
+        return TransportUserMessage(
+            to_addr="1234", from_addr="5678", transport_name="sphex",
+            transport_type="sphex_type")
+
+    def load_copy(self, modelobj):
+        riak_object = self.manager.riak_object(DecodingModel, modelobj.key)
+        riak_object.set_data(modelobj._riak_object.get_data())
+        return DecodingModel(self.manager, modelobj.key,
+                             _riak_object=riak_object)
+
+    def test_decoded_on_first_access(self):
+        m = self.load_copy(DecodingModel(self.manager, "foo", a=u"a"))
+        self.assertEqual(CountingUnicode.decoded, 0)
+        self.assertEqual(m.a, u"a")
+        self.assertEqual(m.a, u"a")
+        self.assertEqual(CountingUnicode.decoded, 1)
+
+    def test_message_changes_isolated(self):
+        msg = self.mkmsg()
+        m = self.load_copy(DecodingModel(self.manager, "foo", msg=msg))
+        m.msg['content'] = u"changed"
+        self.assertEqual(m.msg, msg)
+        self.assertEqual(self.load_copy(m).msg, msg)
+
+    def test_json_changes_saved(self):
+        m = self.load_copy(DecodingModel(self.manager, "foo", data={'a': 1}))
+        m.data['a'] = 2
+        self.assertEqual(m.data, {'a': 2})
+        self.assertEqual(self.load_copy(m).data, {'a': 2})
+
+    def test_timestamp_memoized(self):
+        m = DecodingModel(self.manager, "foo")
+        m.time = datetime(2013, 1, 2, 3, 4, 5)
+        self.assertEqual(m.time, datetime(2013, 1, 2, 3, 4, 5))
+        self.assertTrue(m.time is m.time)
+
+    def test_set_invalidates(self):
+        m = DecodingModel(self.manager, "foo", a=u"a", msg=self.mkmsg())
+        self.assertEqual(m.a, u"a")
+        m.a = u"b"
+        self.assertEqual(m.a, u"b")
+        msg = self.mkmsg()
+        m.msg = msg
+        self.assertEqual(m.msg, msg)
+        m.msg = None
+        self.assertEqual(m.msg, None)
+
+    def test_new_data_invalidates(self):
+        m = DecodingModel(self.manager, "foo", a=u"a")
+        self.assertEqual(m.a, u"a")
+        data = m._riak_object.get_data().copy()
+        data['a'] = u"b"
+        m._riak_object.set_data(data)
+        self.assertEqual(m.a, u"b")
+
+    def test_proxies_not_memoized(self):
+        m = DecodingModel(self.manager, "foo")
+        m.items.append(1)
+        self.assertEqual(list(m.items), [1])
+        m.items = [2, 3]
+        self.assertEqual(list(m.items), [2, 3])
+
+
 class TestModelOnTxRiak(TestCase):
 
     # TODO: all copies of mkmsg must be unified!
@@ -321,6 +414,27 @@ class TestModelOnTxRiak(TestCase):
             ["foo1", "foo2"], lookup, 'b', u"one")
         yield self.assert_mapreduce_results(["foo3"], lookup, 'b', None)
 
+    @Manager.calls_manager
+    def test_index_keys_page(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        yield indexed_model("foo1", a=1, b=u"one").save()
+        yield indexed_model("foo2", a=2, b=u"one").save()
+        yield indexed_model("foo3", a=2, b=u"one").save()
+        yield indexed_model("foo4", a=2, b=None).save()
+
+        keys, continuation = yield indexed_model.index_keys_page(
+            'b', u"one", max_results=2)
+        self.assertEqual(len(keys), 2)
+        self.assertNotEqual(continuation, None)
+        more_keys, continuation = yield indexed_model.index_keys_page(
+            'b', u"one", max_results=2, continuation=continuation)
+        self.assertEqual(continuation, None)
+        self.assertEqual(sorted(keys + more_keys), ["foo1", "foo2", "foo3"])
+
+        keys, continuation = yield indexed_model.index_keys_page('b', None)
+        self.assertEqual(keys, ["foo4"])
+        self.assertEqual(continuation, None)
+
     @Manager.calls_manager
     def test_index_match(self):
         indexed_model = self.manager.proxy(IndexedModel)
@@ -34,3 +34,16 @@ class ManagerTestCase(TestCase):
         self.assertEqual(sub_manager._key_prefix, "foo")
         self.assertEqual(sub_manager._client, manager._client)
         self.assertEqual(sub_manager._key_separator, manager._key_separator)
+
+    def test_pipeline(self):
+        manager = self.mk_manager()
+        pipe = manager.pipeline()
+        self.assertEqual(manager._key_prefix, pipe._key_prefix)
+        self.assertEqual(0, pipe.get('foo'))
+        self.assertEqual(1, pipe.keys('b*'))
+        self.assertEqual([
+            ('get', ('test:foo',), {}),
+            ('keys', (), {'pattern': 'test:b*'}),
+        ], pipe._calls)
+        self.assertEqual([1], pipe._filters.keys())
+        self.assertEqual(2, len(pipe))
@@ -2,6 +2,7 @@
 
 from twisted.trial.unittest import TestCase
 
+from vumi.persist.redis_base import RedisScript
 from vumi.tests.utils import import_skip
 
 
@@ -38,3 +39,36 @@ class RedisManagerTestCase(TestCase):
         self.manager.set('foo', 'baz')
         self.assertEqual(['foo'], self.manager.keys())
         self.assertEqual('baz', self.manager.get('foo'))
+
+    def test_pipeline(self):
+        self.manager.set('foo', 'bar')
+        pipe = self.manager.pipeline()
+        self.assertEqual(0, pipe.get('foo'))
+        self.assertEqual(1, pipe.set('baz', 'quux'))
+        self.assertEqual(2, pipe.keys())
+        self.assertEqual(None, self.manager.get('baz'))
+        results = pipe.execute()
+        self.assertEqual('bar', results[0])
+        self.assertEqual(['baz', 'foo'], sorted(results[2]))
+        self.assertEqual('quux', self.manager._client.get('redistest:baz'))
+
+    def test_empty_pipeline(self):
+        self.assertEqual([], self.manager.pipeline().execute())
+
+    def test_run_script(self):
+        script = RedisScript(
+            "return redis.call('INCRBY', KEYS[1], ARGV[1])",
+            lambda redis, keys, args: redis.incr(keys[0], int(args[0])))
+        self.assertEqual(3, self.manager.run_script(script, ['foo'], [3]))
+        self.assertEqual(5, self.manager.run_script(script, ['foo'], [2]))
+        self.assertEqual('5', self.manager._client.get('redistest:foo'))
+
+    def test_scan_iter(self):
+        other = self.manager.sub_manager('other')
+        other.set('foo', 'bar')
+        for i in range(25):
+            self.manager.set('key%d' % (i,), i)
+        keys = list(self.manager.scan_iter('key*', count=3))
+        self.assertEqual(sorted('key%d' % (i,) for i in range(25)),
+                         sorted(keys))
+        self.assertEqual(['foo'], list(other.scan_iter()))
@@ -82,3 +82,57 @@ class TestRiakManager(CommonRiakManagerTests, TestCase):
         self.assertEqual([model.key for model in mr_results], expected_keys)
         self.assertEqual([model.get_data() for model in mr_results],
             expected_data)
+
+
+class TestRiakManagerPBC(TestRiakManager):
+    """Run the common tests over the protocol buffers transport."""
+
+    def setUp(self):
+        try:
+            from vumi.persist.riak_manager import (
+                RiakManager, flatten_generator)
+        except ImportError, e:
+            import_skip(e, 'riak')
+        self.call_decorator = flatten_generator
+        self.manager = RiakManager.from_config({
+            'bucket_prefix': 'test.',
+            'transport': 'pbc',
+        })
+        self.manager.purge_all()
+
+    def tearDown(self):
+        self.manager.purge_all()
+        self.manager.close_manager()
+
+
+class TestRiakManagerTransports(TestCase):
+
+    def setUp(self):
+        try:
+            from vumi.persist.riak_manager import RiakManager
+        except ImportError, e:
+            import_skip(e, 'riak')
+        self.manager_cls = RiakManager
+
+    def test_from_config_http(self):
+        from riak import RiakHttpTransport
+        manager = self.manager_cls.from_config({'bucket_prefix': 'test.'})
+        self.assertTrue(
+            isinstance(manager.client._transport, RiakHttpTransport))
+        self.assertEqual(manager.client._cm.hostports, [('127.0.0.1', 8098)])
+
+    def test_from_config_pbc(self):
+        from riak import RiakPbcTransport
+        manager = self.manager_cls.from_config({
+            'bucket_prefix': 'test.',
+            'transport': 'pbc',
+        })
+        self.assertTrue(
+            isinstance(manager.client._transport, RiakPbcTransport))
+        self.assertEqual(manager.client._cm.hostports, [('127.0.0.1', 8087)])
+
+    def test_close_manager(self):
+        manager = self.manager_cls.from_config({'bucket_prefix': 'test.'})
+        self.assertEqual(len(manager.client._cm.conns), 1)
+        manager.close_manager()
+        self.assertEqual(manager.client._cm.conns, [])
@@ -1,9 +1,14 @@
 """Tests for vumi.persist.txredis_manager."""
 
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, Deferred, succeed
+from twisted.internet.task import Clock, deferLater
 
-from vumi.persist.txredis_manager import TxRedisManager
+from vumi.persist.redis_base import RedisScript
+from vumi.persist.txredis_manager import (
+    TxRedisManager, RedisConnectionPool, PooledRedisClient,
+    RedisPoolClosedError)
 
 
 class RedisManagerTestCase(TestCase):
@@ -37,3 +42,298 @@ class RedisManagerTestCase(TestCase):
         yield self.manager.set('foo', 'baz')
         self.assertEqual(['foo'], (yield self.manager.keys()))
         self.assertEqual('baz', (yield self.manager.get('foo')))
+
+    @inlineCallbacks
+    def test_pipeline(self):
+        yield self.manager.set('foo', 'bar')
+        pipe = self.manager.pipeline()
+        self.assertEqual(0, pipe.get('foo'))
+        self.assertEqual(1, pipe.set('baz', 'quux'))
+        self.assertEqual(2, pipe.keys())
+        self.assertEqual(None, (yield self.manager.get('baz')))
+        results = yield pipe.execute()
+        self.assertEqual('bar', results[0])
+        self.assertEqual(['baz', 'foo'], sorted(results[2]))
+        self.assertEqual('quux', (
+            yield self.manager._client.get('redistest:baz')))
+
+    @inlineCallbacks
+    def test_empty_pipeline(self):
+        self.assertEqual([], (yield self.manager.pipeline().execute()))
+
+    @inlineCallbacks
+    def test_run_script(self):
+        script = RedisScript(
+            "return redis.call('INCRBY', KEYS[1], ARGV[1])",
+            lambda redis, keys, args: redis.incr(keys[0], int(args[0])))
+        self.assertEqual(3, (yield self.manager.run_script(
+            script, ['foo'], [3])))
+        self.assertEqual(5, (yield self.manager.run_script(
+            script, ['foo'], [2])))
+        self.assertEqual('5', (
+            yield self.manager._client.get('redistest:foo')))
+
+
+    @inlineCallbacks
+    def test_scan(self):
+        yield self.manager.set('foo', 'bar')
+        yield self.manager._client.set('other:key', 'baz')
+        cursor, keys = yield self.manager.scan(0)
+        self.assertEqual((0, ['foo']), (cursor, keys))
+
+    @inlineCallbacks
+    def test_scan_iter(self):
+        other = self.manager.sub_manager('other')
+        yield other.set('foo', 'bar')
+        for i in range(25):
+            yield self.manager.set('key%d' % (i,), i)
+        chunks = []
+        yield self.manager.scan_iter(chunks.append, 'key*', count=3)
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(sorted('key%d' % (i,) for i in range(25)),
+                         sorted(key for chunk in chunks for key in chunk))
+        other_chunks = []
+        yield other.scan_iter(other_chunks.append)
+        self.assertEqual([['foo']], other_chunks)
+
+    @inlineCallbacks
+    def test_scan_iter_waits_for_func(self):
+        for i in range(5):
+            yield self.manager.set('key%d' % (i,), i)
+        keys = []
+        busy = []
+
+        def func(chunk):
+            self.assertEqual([], busy)
+            busy.append(chunk)
+            keys.extend(chunk)
+            return deferLater(reactor, 0, busy.pop)
+
+        yield self.manager.scan_iter(func, count=2)
+        self.assertEqual(['key%d' % (i,) for i in range(5)], sorted(keys))
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.calls = []
+        self.stopped = False
+        self.lost = False
+        self.factory = self
+        self.transport = self
+
+    def stopTrying(self):
+        self.stopped = True
+
+    def loseConnection(self):
+        self.lost = True
+
+    def get(self, key):
+        d = Deferred()
+        self.calls.append((key, d))
+        return d
+
+
+class FakeConnectionPool(RedisConnectionPool):
+    def __init__(self, *args, **kw):
+        super(FakeConnectionPool, self).__init__(*args, **kw)
+        self.clock = Clock()
+        self.connecting = []
+
+    def _connect_client(self):
+        d = Deferred()
+        self.connecting.append(d)
+        return d
+
+    def finish_connecting(self):
+        connecting, self.connecting = self.connecting, []
+        for d in connecting:
+            d.callback(FakeConnection())
+
+
+class RedisConnectionPoolTestCase(TestCase):
+    def setUp(self):
+        self.pool = FakeConnectionPool('localhost', 6379, {}, size=2)
+        self.client = PooledRedisClient(self.pool)
+
+    def tearDown(self):
+        FakeConnectionPool._pools.clear()
+
+    def test_for_config_shares_pools(self):
+        pool = FakeConnectionPool.for_config('localhost', 6379, {'db': 1})
+        self.assertEqual(pool, FakeConnectionPool.for_config(
+            'localhost', 6379, {'db': 1}))
+        self.assertNotEqual(pool, FakeConnectionPool.for_config(
+            'localhost', 6379, {'db': 2}))
+        pool.remove_user()
+        self.assertEqual(pool, FakeConnectionPool.for_config(
+            'localhost', 6379, {'db': 1}))
+
+    def test_for_config_unshared(self):
+        pool = FakeConnectionPool.for_config('localhost', 6379, {})
+        unshared = FakeConnectionPool.for_config(
+            'localhost', 6379, {}, shared=False)
+        self.assertNotEqual(pool, unshared)
+        self.assertNotEqual(unshared, FakeConnectionPool.for_config(
+            'localhost', 6379, {}, shared=False))
+        self.assertEqual(pool, FakeConnectionPool.for_config(
+            'localhost', 6379, {}))
+        unshared.remove_user()
+        self.assertTrue(unshared.closed)
+        self.assertFalse(pool.closed)
+
+    def test_last_user_closes_pool(self):
+        pool = FakeConnectionPool.for_config('localhost', 6379, {})
+        FakeConnectionPool.for_config('localhost', 6379, {})
+        client = PooledRedisClient(pool)
+        client.connect()
+        pool.finish_connecting()
+        [connection] = pool._connections
+        pool.remove_user()
+        self.assertFalse(connection.lost)
+        pool.remove_user()
+        self.assertTrue(connection.stopped)
+        self.assertTrue(connection.lost)
+        self.assertNotEqual(pool, FakeConnectionPool.for_config(
+            'localhost', 6379, {}))
+
+    def test_idle_connection_reused(self):
+        self.client.connect()
+        self.pool.finish_connecting()
+        d1 = self.client.get('foo')
+        [connection] = self.pool._connections
+        connection.calls[0][1].callback('bar')
+        self.assertEqual('bar', self.successResultOf(d1))
+        self.client.get('baz')
+        self.assertEqual(1, len(self.pool._connections))
+        self.assertEqual(['foo', 'baz'], [k for k, _ in connection.calls])
+
+    def test_busy_connections_dispatch_concurrently(self):
+        client2 = PooledRedisClient(self.pool)
+        client3 = PooledRedisClient(self.pool)
+        self.client.connect()
+        self.pool.finish_connecting()
+        self.client.get('a')
+        # The only connection is busy, so we open another.
+        client2.get('b')
+        self.assertEqual(1, len(self.pool.connecting))
+        self.pool.finish_connecting()
+        # Both connections are busy and we're at the size limit.
+        client3.get('c')
+        self.assertEqual([], self.pool.connecting)
+        conn1, conn2 = self.pool._connections
+        self.assertEqual(['a', 'c'], [k for k, _ in conn1.calls])
+        self.assertEqual(['b'], [k for k, _ in conn2.calls])
+        self.assertEqual(3, self.pool.get_stats()['in_flight'])
+        conn1.calls[0][1].callback(None)
+        self.assertEqual(2, self.pool.get_stats()['in_flight'])
+
+    def test_client_commands_stay_in_order(self):
+        self.client.connect()
+        self.pool.finish_connecting()
+        [conn1] = self.pool._connections
+        self.client.get('a')
+        # Another client's command opens a second connection, but ours
+        # stay behind the one still in flight.
+        PooledRedisClient(self.pool).get('b')
+        self.pool.finish_connecting()
+        self.client.get('c')
+        self.assertEqual(['a', 'c'], [k for k, _ in conn1.calls])
+        # Once nothing is in flight the client may use any connection.
+        for _, d in conn1.calls:
+            d.callback(None)
+        self.assertEqual(0, self.client._pending)
+        self.assertEqual(None, self.client._connection)
+
+    def test_client_commands_wait_for_same_connection(self):
+        d1 = self.client.get('a')
+        d2 = self.client.get('b')
+        self.assertEqual(1, len(self.pool.connecting))
+        self.pool.finish_connecting()
+        [connection] = self.pool._connections
+        self.assertEqual(['a', 'b'], [k for k, _ in connection.calls])
+        self.assertEqual(2, self.pool.get_stats()['in_flight'])
+        for _, d in connection.calls:
+            d.callback('x')
+        self.assertEqual('x', self.successResultOf(d1))
+        self.assertEqual('x', self.successResultOf(d2))
+        self.assertEqual(0, self.pool.get_stats()['in_flight'])
+
+    def test_closed_client_raises(self):
+        self.client.connect()
+        self.pool.finish_connecting()
+        [connection] = self.pool._connections
+        self.client.close()
+        self.failureResultOf(self.client.get('a')).trap(RedisPoolClosedError)
+        self.assertEqual([], connection.calls)
+
+    def test_closed_pool_raises(self):
+        d = self.client.connect()
+        self.pool.close()
+        self.pool.finish_connecting()
+        self.failureResultOf(d).trap(RedisPoolClosedError)
+        self.assertEqual([], self.pool._connections)
+        self.failureResultOf(
+            PooledRedisClient(self.pool).get('a')).trap(RedisPoolClosedError)
+
+    def test_pipeline_command_failure(self):
+        manager = TxRedisManager(self.client, 'redistest')
+        pipe = manager.pipeline()
+        pipe.get('a')
+        pipe.get('b')
+        d = pipe.execute()
+        self.pool.finish_connecting()
+        [connection] = self.pool._connections
+        connection.calls[1][1].errback(ValueError("Bad reply"))
+        failure = self.failureResultOf(d)
+        failure.trap(ValueError)
+        self.assertEqual("Bad reply", str(failure.value))
+
+    def test_pipeline_on_closed_client(self):
+        manager = TxRedisManager(self.client, 'redistest')
+        self.client.close()
+        pipe = manager.pipeline()
+        pipe.get('a')
+        self.failureResultOf(pipe.execute()).trap(RedisPoolClosedError)
+
+    def test_wait_time(self):
+        d = self.client.connect()
+        self.pool.clock.advance(0.5)
+        self.pool.finish_connecting()
+        self.assertEqual(self.client, self.successResultOf(d))
+        self.client.connect()
+        stats = self.pool.get_stats()
+        self.assertEqual(2, stats['waits'])
+        self.assertEqual(0.5, stats['total_wait_time'])
+        self.assertEqual(0.5, stats['max_wait_time'])
+
+    def test_wait_time_metric(self):
+        pool = FakeConnectionPool(
+            'localhost', 6379, {}, metrics_prefix='vumi.test.')
+        metric_manager = self.successResultOf(pool.start_metrics(FakeWorker()))
+        self.assertEqual(
+            metric_manager, self.successResultOf(pool.start_metrics(None)))
+        client = PooledRedisClient(pool)
+        client.connect()
+        pool.clock.advance(0.5)
+        pool.finish_connecting()
+        client.connect()
+        metric = metric_manager['redis_pool.wait_time']
+        self.assertEqual(metric.name, 'vumi.test.redis_pool.wait_time')
+        self.assertEqual(metric.aggs, ('avg', 'max'))
+        self.assertEqual([value for _, value in metric.poll()], [0.5, 0.0])
+
+    def test_start_metrics_without_prefix(self):
+        self.assertEqual(
+            self.successResultOf(self.pool.start_metrics(FakeWorker())), None)
+        self.assertEqual(self.pool.metric_manager, None)
+
+    def test_connection_failure(self):
+        d = self.client.connect()
+        self.pool.connecting.pop().errback(Exception("No server"))
+        self.assertEqual("No server", str(self.failureResultOf(d).value))
+        self.assertEqual(0, self.pool.get_stats()['connecting'])
+
+
+class FakeWorker(object):
+    def start_publisher(self, publisher_class, *args, **kw):
+        return succeed(publisher_class(*args, **kw))
@@ -1,8 +1,11 @@
 """Tests for vumi.persist.txriak_manager."""
 
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, succeed
 
+from vumi.errors import ConfigError
+
+from vumi.persist.cache import LRUCache
 from vumi.persist.model import Manager
 from vumi.tests.utils import import_skip
 
@@ -13,6 +16,7 @@ class DummyModel(object):
 
     VERSION = None
     MIGRATORS = None
+    CACHE_LOADS = False
 
     def __init__(self, manager, key, _riak_object=None):
         self.manager = manager
@@ -36,6 +40,11 @@ class DummyModel(object):
         self._riak_object.add_index(index_name, key)
 
 
+class CachedDummyModel(DummyModel):
+
+    CACHE_LOADS = True
+
+
 class CommonRiakManagerTests(object):
     """Common tests for Riak managers.
 
@@ -64,11 +73,57 @@ class CommonRiakManagerTests(object):
                                            })
         self.assertEqual(manager.load_bunch_size, 10)
 
+    def test_from_config_with_parallel_gets(self):
+        manager_cls = self.manager.__class__
+        manager = manager_cls.from_config({'bucket_prefix': 'test.',
+                                           'parallel_gets': True,
+                                           'max_parallel_gets': 5,
+                                           })
+        self.assertEqual(manager.parallel_gets, True)
+        self.assertEqual(manager.max_parallel_gets, 5)
+
+    def test_from_config_with_unknown_transport(self):
+        manager_cls = self.manager.__class__
+        self.assertRaises(ConfigError, manager_cls.from_config,
+                          {'bucket_prefix': 'test.', 'transport': 'carrier'})
+
+    def test_from_config_with_model_cache(self):
+        manager_cls = self.manager.__class__
+        manager = manager_cls.from_config({'bucket_prefix': 'test.',
+                                           'model_cache_size': 100,
+                                           'model_cache_ttl': 60,
+                                           })
+        self.assertEqual(manager.model_cache.max_size, 100)
+        self.assertEqual(manager.model_cache.ttl, 60)
+
+    def test_no_model_cache_by_default(self):
+        self.assertEqual(self.manager.model_cache, None)
+        self.assertEqual(self.manager.get_model_cache_stats(), None)
+
     def test_sub_manager(self):
         sub_manager = self.manager.sub_manager("foo.")
         self.assertEqual(sub_manager.client, self.manager.client)
         self.assertEqual(sub_manager.bucket_prefix, 'test.foo.')
 
+    def test_sub_manager_load_options(self):
+        self.manager.load_bunch_size = 10
+        self.manager.parallel_gets = True
+        sub_manager = self.manager.sub_manager("foo.")
+        self.assertEqual(sub_manager.load_bunch_size, 10)
+        self.assertEqual(sub_manager.parallel_gets, True)
+        self.assertEqual(sub_manager.max_parallel_gets,
+                         self.manager.max_parallel_gets)
+
+    def test_sub_manager_shares_model_cache(self):
+        self.manager.model_cache = LRUCache(10)
+        sub_manager = self.manager.sub_manager("foo.")
+        self.assertTrue(sub_manager.model_cache is self.manager.model_cache)
+
+    def test_sub_manager_shares_get_semaphore(self):
+        sub_manager = self.manager.sub_manager("foo.")
+        self.assertTrue(
+            sub_manager._get_semaphore is self.manager._get_semaphore)
+
     def test_bucket_name_on_modelcls(self):
         dummy = self.mkdummy("bar")
         bucket_name = self.manager.bucket_name(type(dummy))
@@ -104,6 +159,19 @@ class CommonRiakManagerTests(object):
         dummy2 = yield self.manager.load(DummyModel, "foo")
         self.assertEqual(dummy2.get_data(), {"a": 1})
 
+    @Manager.calls_manager
+    def test_store_and_load_with_indexes(self):
+        dummy1 = self.mkdummy("foo", {"a": 1})
+        dummy1.add_index('test_index_bin', 'test_key')
+        dummy1.add_index('test_index_int', 5)
+        yield self.manager.store(dummy1)
+
+        dummy2 = yield self.manager.load(DummyModel, "foo")
+        indexes = dummy2._riak_object.get_indexes()
+        self.assertEqual(
+            sorted((i.get_field(), str(i.get_value())) for i in indexes),
+            [('test_index_bin', 'test_key'), ('test_index_int', '5')])
+
     @Manager.calls_manager
     def test_delete(self):
         dummy1 = self.mkdummy("foo", {"a": 1})
@@ -138,6 +206,72 @@ class CommonRiakManagerTests(object):
         result_data.sort(key=lambda d: d["a"])
         self.assertEqual(result_data, [{"a": 0}, {"a": 1}, {"a": 2}])
 
+    def test_load_all_bunches_parallel_gets(self):
+        self.manager.parallel_gets = True
+        return self.test_load_all_bunches()
+
+    def mkcached(self, key, data=None):
+        cached = CachedDummyModel(self.manager, key)
+        cached.set_riak(self.manager.riak_object(cached, key))
+        if data is not None:
+            cached.set_data(data)
+        return cached
+
+    @Manager.calls_manager
+    def test_load_cached(self):
+        self.manager.model_cache = LRUCache(10)
+        yield self.manager.store(self.mkcached("foo", {"a": 1}))
+        self.manager.model_cache.clear()
+
+        cached1 = yield self.manager.load(CachedDummyModel, "foo")
+        cached2 = yield self.manager.load(CachedDummyModel, "foo")
+        self.assertEqual(cached1.get_data(), {"a": 1})
+        self.assertEqual(cached2.get_data(), {"a": 1})
+        stats = self.manager.get_model_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+        # Each load gets its own copy of the data.
+        cached2.get_data()["a"] = 2
+        cached3 = yield self.manager.load(CachedDummyModel, "foo")
+        self.assertEqual(cached3.get_data(), {"a": 1})
+
+    @Manager.calls_manager
+    def test_load_uncached_model(self):
+        self.manager.model_cache = LRUCache(10)
+        yield self.manager.store(self.mkdummy("foo", {"a": 1}))
+        dummy = yield self.manager.load(DummyModel, "foo")
+        self.assertEqual(dummy.get_data(), {"a": 1})
+        self.assertEqual(len(self.manager.model_cache), 0)
+        self.assertEqual(self.manager.model_cache.hits, 0)
+
+    @Manager.calls_manager
+    def test_store_updates_cache(self):
+        self.manager.model_cache = LRUCache(10)
+        yield self.manager.store(self.mkcached("foo", {"a": 1}))
+        cached = yield self.manager.load(CachedDummyModel, "foo")
+        cached.set_data({"a": 2})
+        yield self.manager.store(cached)
+
+        cached = yield self.manager.load(CachedDummyModel, "foo")
+        self.assertEqual(cached.get_data(), {"a": 2})
+        self.assertEqual(self.manager.model_cache.misses, 0)
+
+        # Storing a cached copy again must not leave a stale value in
+        # Riak behind it.
+        self.manager.model_cache.clear()
+        cached = yield self.manager.load(CachedDummyModel, "foo")
+        self.assertEqual(cached.get_data(), {"a": 2})
+
+    @Manager.calls_manager
+    def test_delete_invalidates_cache(self):
+        self.manager.model_cache = LRUCache(10)
+        cached = self.mkcached("foo", {"a": 1})
+        yield self.manager.store(cached)
+        yield self.manager.delete(cached)
+        self.assertEqual(len(self.manager.model_cache), 0)
+        result = yield self.manager.load(CachedDummyModel, "foo")
+        self.assertEqual(result, None)
+
     @Manager.calls_manager
     def test_run_riak_map_reduce(self):
         dummies = [self.mkdummy(str(i), {"a": i}) for i in range(4)]
@@ -188,3 +322,89 @@ class TestTxRiakManager(CommonRiakManagerTests, TestCase):
 
     def test_call_decorator(self):
         self.assertEqual(type(self.manager).call_decorator, inlineCallbacks)
+
+
+class TestTxRiakManagerPBC(TestTxRiakManager):
+    """Run the common tests over the protocol buffers transport."""
+
+    @inlineCallbacks
+    def setUp(self):
+        try:
+            from vumi.persist.txriak_manager import TxRiakManager
+        except ImportError, e:
+            import_skip(e, 'riakasaurus', 'riakasaurus.riak')
+        self.manager = TxRiakManager.from_config({
+            'bucket_prefix': 'test.',
+            'transport': 'pbc',
+        })
+        self.addCleanup(self.manager.close_manager)
+        yield self.manager.purge_all()
+
+
+class FakePBCClient(object):
+    """Records the requests sent to riakasaurus' PBC client."""
+
+    def __init__(self):
+        self.puts = []
+        self.quit_calls = 0
+
+    def put(self, bucket, key, content, vclock=None, **kw):
+        self.puts.append((bucket, key, content, vclock, kw))
+        return succeed(True)
+
+    def quit(self):
+        self.quit_calls += 1
+        return succeed(None)
+
+
+class TestVumiPBCTransport(TestCase):
+
+    def setUp(self):
+        try:
+            from vumi.persist.txriak_manager import TxRiakManager
+            from riakasaurus.transport import StatefulTransport
+        except ImportError, e:
+            import_skip(e, 'riakasaurus', 'riakasaurus.riak')
+        self.manager = TxRiakManager.from_config({
+            'bucket_prefix': 'test.',
+            'transport': 'pbc',
+        })
+        self.addCleanup(self.manager.close_manager)
+        self.transport = self.manager.client.get_transport()
+        self.pbc_client = FakePBCClient()
+        stp = StatefulTransport(self.pbc_client)
+        self.transport._transports.append(stp)
+
+    def test_from_config(self):
+        from vumi.persist.txriak_manager import VumiPBCTransport
+        self.assertTrue(isinstance(self.transport, VumiPBCTransport))
+        self.assertEqual(self.manager.client._port, 8087)
+        self.assertEqual(self.manager.http_client._port, 8098)
+        self.assertNotEqual(self.manager.http_client, self.manager.client)
+
+    def test_sub_manager(self):
+        sub_manager = self.manager.sub_manager("foo.")
+        self.assertEqual(sub_manager.client, self.manager.client)
+        self.assertEqual(sub_manager.http_client, self.manager.http_client)
+
+    @inlineCallbacks
+    def test_put_includes_indexes(self):
+        dummy = DummyModel(self.manager, "foo")
+        dummy.set_riak(self.manager.riak_object(dummy, "foo"))
+        dummy.add_index('test_index_bin', 'test_key')
+        dummy.add_index('test_index_int', 5)
+        yield self.transport.put(dummy._riak_object, return_body=False)
+        [(bucket, key, content, vclock, kw)] = self.pbc_client.puts
+        self.assertEqual((bucket, key), ("test.dummy_model", "foo"))
+        self.assertEqual(content['content_type'], "application/json")
+        self.assertEqual(sorted(content['indexes']), [
+            ('test_index_bin', 'test_key'),
+            ('test_index_int', '5'),
+        ])
+        self.assertTrue(self.transport._transports[0].isIdle())
+
+    @inlineCallbacks
+    def test_quit_twice(self):
+        yield self.manager.close_manager()
+        yield self.manager.close_manager()
+        self.assertEqual(self.pbc_client.quit_calls, 1)
@@ -11,10 +11,14 @@ except ImportError:
     import txredis.protocol as txrp
     txr = txrp
 
+from collections import deque
+
 from twisted.internet import reactor
 from twisted.internet.defer import (
-    inlineCallbacks, DeferredList, succeed, Deferred)
+    inlineCallbacks, DeferredList, succeed, fail, Deferred, maybeDeferred,
+    FirstError)
 
+from vumi.errors import VumiError
 from vumi.persist.redis_base import Manager
 from vumi.persist.fake_redis import FakeRedis
 
@@ -85,6 +89,29 @@ class VumiRedis(txr.Redis):
                                             in results if success]))
         return d
 
+    def scan(self, cursor, match=None, count=None):
+        args = [cursor]
+        if match is not None:
+            args.extend(['MATCH', match])
+        if count is not None:
+            args.extend(['COUNT', count])
+        self._send('SCAN', *args)
+        d = self.getResponse()
+        d.addCallback(lambda r: (int(r[0]), r[1]))
+        return d
+
+    def eval(self, script, numkeys, *keys_and_args):
+        self._send('EVAL', script, numkeys, *keys_and_args)
+        return self.getResponse()
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        self._send('EVALSHA', sha, numkeys, *keys_and_args)
+        return self.getResponse()
+
+    def script_load(self, script):
+        self._send('SCRIPT', 'LOAD', script)
+        return self.getResponse()
+
     def zrange(self, key, start, end, desc=False, withscores=False):
         return super(VumiRedis, self).zrange(key, start, end,
                                              withscores=withscores,
@@ -103,6 +130,313 @@ class VumiRedisClientFactory(txr.RedisClientFactory):
     protocol = VumiRedis
 
 
+class RedisPoolClosedError(VumiError):
+    """Raised when a closed pool or client is used."""
+
+
+class RedisConnectionPool(object):
+    """A shared, size-bounded set of connections to one redis server.
+
+    Managers configured with a ``pool_size`` share a pool with every other
+    manager created from the same config (see :meth:`for_config`). Without
+    one, each manager gets a pool of one connection to itself, as it would
+    without pooling. Connections are handed out to the connection with the
+    fewest commands in flight. A new connection is only opened when
+    every open connection is busy and there are fewer than ``size`` of
+    them.
+
+    Redis only orders commands sent on the same connection, so each
+    :class:`PooledRedisClient` keeps its commands on one connection while
+    any of them are in flight. A larger pool spreads different clients
+    (and so different managers) over more connections; it doesn't reorder
+    the commands of any one of them.
+
+    Time spent waiting for a connection to be opened is recorded in
+    :attr:`total_wait_time` and :attr:`max_wait_time` and reported by
+    :meth:`get_stats`. If the pool has a ``metrics_prefix``,
+    :meth:`start_metrics` also publishes each wait.
+
+    :param str host:
+        Redis server host.
+    :param int port:
+        Redis server port.
+    :param dict factory_config:
+        Extra options for :class:`VumiRedisClientFactory`.
+    :param int size:
+        Maximum number of connections to open.
+    :param str metrics_prefix:
+        If set, :meth:`start_metrics` publishes the time spent waiting for
+        a connection as ``<metrics_prefix>redis_pool.wait_time``.
+    """
+
+    _pools = {}
+
+    clock = reactor
+
+    def __init__(self, host, port, factory_config, size=1,
+                 metrics_prefix=None):
+        self.host = host
+        self.port = port
+        self.factory_config = factory_config
+        self.size = size
+        self.metrics_prefix = metrics_prefix
+        self.closed = False
+        self.waits = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.metric_manager = None
+        self._wait_metric = None
+        self._key = None
+        self._users = 0
+        self._connections = []
+        self._in_flight = {}
+        self._connecting = 0
+        self._waiting = deque()
+
+    @classmethod
+    def for_config(cls, host, port, factory_config, size=1,
+                   metrics_prefix=None, shared=True):
+        """Return the shared pool for this config, creating it if needed.
+
+        If ``shared`` is ``False``, a new pool is returned that no other
+        caller will be given.
+
+        Each caller should call :meth:`remove_user` when it is finished with
+        the pool. The pool's connections are closed when the last user is
+        removed.
+        """
+        key = (host, port, size, tuple(sorted(factory_config.items())))
+        pool = cls._pools.get(key) if shared else None
+        if pool is None:
+            pool = cls(host, port, factory_config, size, metrics_prefix)
+            if shared:
+                pool._key = key
+                cls._pools[key] = pool
+        pool._users += 1
+        return pool
+
+    def start_metrics(self, worker):
+        """Start a metric manager on `worker` that publishes the time
+        spent waiting for a connection as
+        ``<metrics_prefix>redis_pool.wait_time``.
+
+        Does nothing if the pool has no `metrics_prefix` or its metrics
+        have already been started. The metric manager is stopped by
+        :meth:`close`.
+        """
+        if self.metrics_prefix is None or self.metric_manager is not None:
+            return succeed(self.metric_manager)
+        # Imported here so the managers don't depend on vumi.service.
+        from vumi.blinkenlights.metrics import MetricManager, Metric, AVG, MAX
+
+        def register(metric_manager):
+            self.metric_manager = metric_manager
+            self._wait_metric = metric_manager.register(
+                Metric('redis_pool.wait_time', [AVG, MAX]))
+            return metric_manager
+
+        d = worker.start_publisher(MetricManager, self.metrics_prefix)
+        return d.addCallback(register)
+
+    def remove_user(self):
+        self._users -= 1
+        if self._users <= 0:
+            if self._pools.get(self._key) is self:
+                del self._pools[self._key]
+            self.close()
+
+    def close(self):
+        self.closed = True
+        if self.metric_manager is not None:
+            self.metric_manager.stop()
+        connections, self._connections = self._connections, []
+        self._in_flight = {}
+        waiting, self._waiting = self._waiting, deque()
+        for d in waiting:
+            d.errback(RedisPoolClosedError("Connection pool closed."))
+        for connection in connections:
+            connection.factory.stopTrying()
+            if connection.transport is not None:
+                connection.transport.loseConnection()
+
+    def _connect_client(self):
+        factory = VumiRedisClientFactory(**self.factory_config)
+        d = factory.deferred.addCallback(lambda r: r.connected_d)
+        reactor.connectTCP(self.host, self.port, factory)
+        return d
+
+    def _open_connection(self):
+        self._connecting += 1
+        d = self._connect_client()
+        d.addCallbacks(self._connection_opened, self._connection_failed)
+        return d
+
+    def _connection_opened(self, connection):
+        self._connecting -= 1
+        if self.closed:
+            connection.factory.stopTrying()
+            if connection.transport is not None:
+                connection.transport.loseConnection()
+            raise RedisPoolClosedError("Connection pool closed.")
+        self._connections.append(connection)
+        self._in_flight[connection] = 0
+        waiting, self._waiting = self._waiting, deque()
+        for d in waiting:
+            d.callback(connection)
+        return connection
+
+    def _connection_failed(self, failure):
+        self._connecting -= 1
+        waiting, self._waiting = self._waiting, deque()
+        for d in waiting:
+            d.errback(failure)
+        return failure
+
+    def _get_connection(self):
+        if self._connections:
+            connection = min(self._connections, key=self._in_flight.get)
+            if (self._in_flight[connection] == 0 or
+                    len(self._connections) + self._connecting >= self.size):
+                return succeed(connection)
+        if len(self._connections) + self._connecting < self.size:
+            return self._open_connection()
+        # Everything we're allowed to open is still connecting.
+        d = Deferred()
+        self._waiting.append(d)
+        return d
+
+    def acquire(self):
+        """Return a deferred that fires with a connection to use.
+
+        The connection must be handed back to :meth:`release` once the
+        commands sent on it have completed.
+        """
+        if self.closed:
+            return fail(RedisPoolClosedError("Connection pool closed."))
+        start = self.clock.seconds()
+        d = self._get_connection()
+        return d.addCallback(self._acquired, start)
+
+    def _acquired(self, connection, start):
+        wait_time = self.clock.seconds() - start
+        self.waits += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        if self._wait_metric is not None:
+            self._wait_metric.set(wait_time)
+        return self.reuse(connection)
+
+    def reuse(self, connection):
+        """Count another command in flight on an acquired connection.
+
+        Each call must be matched by a call to :meth:`release`.
+        """
+        self._in_flight[connection] = self._in_flight.get(connection, 0) + 1
+        return connection
+
+    def release(self, connection):
+        if connection in self._in_flight:
+            self._in_flight[connection] -= 1
+
+    def get_stats(self):
+        return {
+            'connections': len(self._connections),
+            'connecting': self._connecting,
+            'in_flight': sum(self._in_flight.values()),
+            'waits': self.waits,
+            'total_wait_time': self.total_wait_time,
+            'max_wait_time': self.max_wait_time,
+        }
+
+
+class PooledRedisClient(object):
+    """A redis client that sends each command on a pooled connection.
+
+    Any redis command available on :class:`VumiRedis` may be called on this
+    client. Several handles may share a :class:`RedisConnectionPool`.
+
+    Commands are sent in the order they are called: while any command is
+    in flight, further commands go down the same connection. The client
+    can't be used once it has been closed.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._closed = False
+        self._connection = None
+        self._pending = 0
+        self._waiting = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kw):
+            return self.with_connection(
+                lambda connection: getattr(connection, name)(*args, **kw))
+        return call
+
+    def with_connection(self, func):
+        """Call ``func`` with a pooled connection.
+
+        The connection is released when the deferred returned by ``func``
+        fires.
+        """
+        def call_func(connection):
+            d = maybeDeferred(func, connection)
+            return d.addBoth(release, connection)
+
+        def release(result, connection):
+            self._release(connection)
+            return result
+
+        if self._closed:
+            return fail(RedisPoolClosedError("Redis client closed."))
+        return self._acquire().addCallback(call_func)
+
+    def _acquire(self):
+        self._pending += 1
+        if self._connection is not None:
+            return succeed(self.pool.reuse(self._connection))
+        d = Deferred()
+        self._waiting.append(d)
+        if len(self._waiting) == 1:
+            self.pool.acquire().addCallbacks(
+                self._acquired, self._acquire_failed)
+        return d
+
+    def _acquired(self, connection):
+        self._connection = connection
+        waiting, self._waiting = self._waiting, []
+        for i, d in enumerate(waiting):
+            # The pool counted the first of these when it handed us the
+            # connection.
+            if i > 0:
+                self.pool.reuse(connection)
+            d.callback(connection)
+
+    def _acquire_failed(self, failure):
+        waiting, self._waiting = self._waiting, []
+        self._pending -= len(waiting)
+        for d in waiting:
+            d.errback(failure)
+
+    def _release(self, connection):
+        self.pool.release(connection)
+        self._pending -= 1
+        if self._pending == 0:
+            self._connection = None
+
+    def connect(self):
+        """Return a deferred that fires once a connection is open."""
+        return self.with_connection(lambda connection: self)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.pool.remove_user()
+
+
 class TxRedisManager(Manager):
 
     call_decorator = staticmethod(inlineCallbacks)
@@ -121,25 +455,56 @@ class TxRedisManager(Manager):
         """Construct a manager from a dictionary of options.
 
         :param dict config:
-            Dictionary of options for the manager.
+            Dictionary of options for the manager. ``pool_size`` shares a
+            pool of up to that many connections between managers with the
+            same config and ``metrics_prefix`` is passed to the pool. Other
+            options are passed to :class:`VumiRedisClientFactory`.
         :param str key_prefix:
             Key prefix for namespacing.
         """
 
         host = config.pop('host', 'localhost')
         port = config.pop('port', 6379)
+        pool_size = config.pop('pool_size', None)
+        metrics_prefix = config.pop('metrics_prefix', None)
+
+        # Only managers that ask for a pool share their connections.
+        pool = RedisConnectionPool.for_config(
+            host, port, config, pool_size or 1, metrics_prefix,
+            shared=pool_size is not None)
+        client = PooledRedisClient(pool)
+
+        def close_client(failure):
+            client.close()
+            return failure
+
+        d = client.connect()
+        d.addCallbacks(lambda r: cls(r, key_prefix, key_separator),
+                       close_client)
+        return d
 
-        factory = VumiRedisClientFactory(**config)
-        d = factory.deferred.addCallback(lambda r: r.connected_d)
-        reactor.connectTCP(host, port, factory)
-        return d.addCallback(lambda r: cls(r, key_prefix, key_separator))
-
-    @inlineCallbacks
     def _close(self):
         """Close redis connection."""
-        yield self._client.factory.stopTrying()
-        if self._client.transport is not None:
-            yield self._client.transport.loseConnection()
+        self._client.close()
+
+    def start_metrics(self, worker):
+        """Start publishing this manager's connection pool metrics on
+        `worker`.
+
+        See :meth:`RedisConnectionPool.start_metrics`. Does nothing if the
+        manager isn't connected to a real server.
+        """
+        pool = self.get_connection_pool()
+        if pool is None:
+            return succeed(None)
+        return pool.start_metrics(worker)
+
+    def get_connection_pool(self):
+        """Return the :class:`RedisConnectionPool` this manager uses.
+
+        Returns ``None`` if the manager isn't connected to a real server.
+        """
+        return getattr(self._client, 'pool', None)
 
     @inlineCallbacks
     def _purge_all(self):
@@ -152,6 +517,57 @@ class TxRedisManager(Manager):
             deferreds.append(self.delete(key))
         yield DeferredList(deferreds)
 
+    @inlineCallbacks
+    def scan_iter(self, func, match='*', count=None):
+        """Call ``func`` with each chunk of keys matching ``match``.
+
+        The asynchronous counterpart of
+        :meth:`vumi.persist.redis_manager.RedisManager.scan_iter`. Keys are
+        fetched with SCAN, so the server isn't blocked while the whole
+        keyspace is searched, and the next chunk isn't fetched until the
+        deferred (if any) returned by ``func`` has fired. Keys may be seen
+        more than once if they are modified during the iteration.
+
+        Returns a deferred that fires once every chunk has been handled.
+        """
+        cursor = None
+        while cursor != 0:
+            cursor, keys = yield self.scan(
+                cursor or 0, match=match, count=count)
+            if keys:
+                yield func(keys)
+
+    def _execute_pipeline(self, calls, filters, transaction):
+        """Send queued pipeline calls to redis and return their results.
+
+        txredis writes each command as soon as it is called and matches
+        replies to requests in order, so sending all the calls before
+        waiting for any of them gives us a pipeline. MULTI/EXEC isn't
+        supported because txredis doesn't post-process EXEC replies.
+        """
+        if isinstance(self._client, FakeRedis):
+            return super(TxRedisManager, self)._execute_pipeline(
+                calls, filters, transaction)
+        if transaction:
+            raise NotImplementedError(
+                "TxRedisManager pipelines can't be transactions.")
+
+        def send_calls(connection):
+            return DeferredList([getattr(connection, call)(*args, **kw)
+                                 for call, args, kw in calls],
+                                fireOnOneErrback=True, consumeErrors=True)
+
+        # All the calls go down the same connection.
+        d = self._client.with_connection(send_calls)
+        d.addErrback(self._unwrap_first_error)
+        d.addCallback(lambda results: self._filter_pipeline_results(
+            filters, [result for _success, result in results]))
+        return d
+
+    def _unwrap_first_error(self, failure):
+        failure.trap(FirstError)
+        return failure.value.subFailure
+
     def _make_redis_call(self, call, *args, **kw):
         """Make a redis API call using the underlying client library.
         """
@@ -161,3 +577,15 @@ class TxRedisManager(Manager):
         """Filter results of a redis call.
         """
         return results.addCallback(func)
+
+    def _run_script(self, script, keys, args):
+        """Run a script with already prefixed keys.
+        """
+        def eval_if_not_loaded(failure):
+            if not str(failure.value).startswith('NOSCRIPT'):
+                return failure
+            return self._client.eval(
+                script.lua_source, len(keys), *(keys + args))
+
+        d = self._client.evalsha(script.sha, len(keys), *(keys + args))
+        return d.addErrback(eval_if_not_loaded)
@@ -3,25 +3,106 @@
 """A manager implementation on top of txriak."""
 
 from riakasaurus.riak import RiakClient, RiakObject, RiakMapReduce
+from riakasaurus.transport import PBCTransport
 from twisted.internet.defer import (
-    inlineCallbacks, gatherResults, maybeDeferred, succeed)
+    inlineCallbacks, gatherResults, maybeDeferred, succeed, DeferredSemaphore,
+    returnValue, FirstError)
 
 from vumi.persist.model import Manager
 
 
+class VumiPBCTransport(PBCTransport):
+    """riakasaurus' protocol buffers transport with fixes for storing
+    secondary indexes and quitting more than once.
+    """
+
+    _quit_d = None
+
+    def quit(self):
+        # The transport also quits when it's garbage collected, which
+        # fails if it has already been quit.
+        if self._quit_d is None:
+            self._quit_d = super(VumiPBCTransport, self).quit()
+        return self._quit_d
+
+    @inlineCallbacks
+    def put(self, robj, w=None, dw=None, pw=None, return_body=True,
+            if_none_match=False):
+        # The riakasaurus version of this leaves the indexes out.
+        payload = {
+            'value': robj.get_encoded_data(),
+            'content_type': robj.get_content_type(),
+        }
+        links = robj.get_links()
+        if links:
+            payload['links'] = [(l.get_bucket(), l.get_key(), l.get_tag())
+                                for l in links]
+        if robj.get_usermeta():
+            payload['usermeta'] = robj.get_usermeta().items()
+        indexes = robj.get_indexes()
+        if indexes:
+            payload['indexes'] = [(entry.get_field(), entry.get_value())
+                                  for entry in indexes]
+
+        stp = yield self._getFreeTransport()
+        try:
+            ret = yield stp.getTransport().put(
+                robj.get_bucket().get_name(), robj.get_key(), payload,
+                robj.vclock() or None, w=w, dw=dw, pw=pw,
+                return_body=return_body, if_none_match=if_none_match)
+        finally:
+            stp.setIdle()
+        if return_body:
+            returnValue(self.parseRpbGetResp(ret))
+
+
 class TxRiakManager(Manager):
-    """A persistence manager for txriak."""
+    """A persistence manager for txriak.
+
+    riakasaurus' protocol buffers transport only supports fetching,
+    storing and deleting objects, so a manager using it also has an HTTP
+    client for MapReduce, search and bucket listing.
+    """
 
     call_decorator = staticmethod(inlineCallbacks)
 
+    DEFAULT_HTTP_PORT = 8098
+
+    def __init__(self, client, bucket_prefix, http_client=None, **kw):
+        super(TxRiakManager, self).__init__(client, bucket_prefix, **kw)
+        self.http_client = http_client if http_client is not None else client
+        # Shared by all the bunches this manager and its sub-managers
+        # load, so the limit applies to them as a whole.
+        self._get_semaphore = DeferredSemaphore(self.max_parallel_gets)
+
     @classmethod
     def from_config(cls, config):
         config = config.copy()
         bucket_prefix = config.pop('bucket_prefix')
-        load_bunch_size = config.pop('load_bunch_size',
-                                     cls.DEFAULT_LOAD_BUNCH_SIZE)
-        client = RiakClient(**config)
-        return cls(client, bucket_prefix, load_bunch_size=load_bunch_size)
+        load_options = cls._load_options_from_config(config)
+        transport = cls._transport_from_config(config)
+        http_port = config.pop('http_port', cls.DEFAULT_HTTP_PORT)
+        if transport == 'pbc':
+            client = RiakClient(transport=VumiPBCTransport, **config)
+            http_config = dict(config, port=http_port)
+            http_client = RiakClient(**http_config)
+        else:
+            client = http_client = RiakClient(**config)
+        return cls(client, bucket_prefix, http_client=http_client,
+                   **load_options)
+
+    def sub_manager(self, sub_prefix):
+        sub_manager = super(TxRiakManager, self).sub_manager(sub_prefix)
+        sub_manager.http_client = self.http_client
+        sub_manager._get_semaphore = self._get_semaphore
+        return sub_manager
+
+    def close_manager(self):
+        transport = self.client.get_transport()
+        if isinstance(transport, PBCTransport):
+            return transport.quit()
+        # The HTTP transport doesn't keep connections of its own.
+        return succeed(None)
 
     def _encode_indexes(self, iterable, encoding='utf-8'):
         """
@@ -73,14 +154,27 @@ class TxRiakManager(Manager):
         return riak_object
 
     def store(self, modelobj):
+        # Anything cached is stale until the store completes.
+        self._uncache_model_object(modelobj)
+
+        def stored(result):
+            self._cache_model_object(modelobj)
+            return modelobj
+
         d = modelobj._riak_object.store()
-        d.addCallback(lambda result: modelobj)
+        d.addCallback(stored)
         return d
 
     def delete(self, modelobj):
+        self._uncache_model_object(modelobj)
         return modelobj._riak_object.delete()
 
     def load(self, modelcls, key, result=None):
+        if not result:
+            modelobj = self._load_cached(modelcls, key)
+            if modelobj is not None:
+                return succeed(modelobj)
+
         riak_object = self.riak_object(modelcls, key, result)
         d = succeed(riak_object) if result else riak_object.reload()
 
@@ -90,7 +184,9 @@ class TxRiakManager(Manager):
 
             data_version = riak_object.get_data().get('$VERSION', None)
             if data_version == modelcls.VERSION:
-                return modelcls(self, key, _riak_object=riak_object)
+                modelobj = modelcls(self, key, _riak_object=riak_object)
+                self._cache_model_object(modelobj)
+                return modelobj
 
             migrator = modelcls.MIGRATOR(modelcls, self, data_version)
             md = maybeDeferred(migrator, riak_object)
@@ -99,12 +195,34 @@ class TxRiakManager(Manager):
 
         return d.addCallback(build_model_object)
 
+    def _load_bunch_parallel(self, model, keys):
+        d = gatherResults([self._get_semaphore.run(model.load, self, key)
+                           for key in keys], consumeErrors=True)
+        d.addErrback(self._unwrap_first_error)
+        d.addCallback(lambda objs: [obj for obj in objs if obj is not None])
+        return d
+
+    def _unwrap_first_error(self, failure):
+        failure.trap(FirstError)
+        return failure.value.subFailure
+
     def riak_map_reduce(self):
-        return RiakMapReduce(self.client)
+        return RiakMapReduce(self.http_client)
+
+    def riak_index_page(self, model, index_name, start_value, end_value,
+                        max_results, continuation):
+        # riakasaurus doesn't support 2i pagination, so we make the
+        # request ourselves.
+        path, params = self._index_page_request(
+            model, index_name, start_value, end_value, max_results,
+            continuation)
+        d = self.http_client.get_transport().get_request(path, params)
+        d.addCallback(self._index_page_from_response)
+        return d
 
     def riak_enable_search(self, modelcls):
         bucket_name = self.bucket_name(modelcls)
-        bucket = self.client.bucket(bucket_name)
+        bucket = self.http_client.bucket(bucket_name)
         return bucket.enable_search()
 
     def run_map_reduce(self, mapreduce, mapper_func=None, reducer_func=None):
@@ -123,10 +241,10 @@ class TxRiakManager(Manager):
 
     @inlineCallbacks
     def purge_all(self):
-        buckets = yield self.client.list_buckets()
+        buckets = yield self.http_client.list_buckets()
         deferreds = []
         for bucket_name in buckets:
             if bucket_name.startswith(self.bucket_prefix):
-                bucket = self.client.bucket(bucket_name)
+                bucket = self.http_client.bucket(bucket_name)
                 deferreds.append(bucket.purge_keys())
         yield gatherResults(deferreds)
@@ -17,6 +17,13 @@ class Options(usage.Options):
          "Total number of messages to write and read back."],
         ["concurrent-messages", "c", "100",
          "Number of messages to read and write concurrently"],
+        ["bunch-sizes", "b", "10,50,100",
+         "Comma separated bunch sizes to compare bunch loading methods at."],
+        ["max-parallel-gets", "g", "10",
+         "Maximum number of GETs in flight when loading with parallel GETs."],
+        ["transports", "t", "http,pbc",
+         "Comma separated Riak transports to compare write and read"
+         " throughput over."],
     ]
 
     longdesc = """Benchmarks vumi.persist.model.Model"""
@@ -34,6 +41,10 @@ class WriteReadBenchmark(object):
     def __init__(self, options):
         self.messages = int(options['messages'])
         self.concurrent = int(options['concurrent-messages'])
+        self.bunch_sizes = [int(size)
+                            for size in options['bunch-sizes'].split(',')]
+        self.max_parallel_gets = int(options['max-parallel-gets'])
+        self.transports = options['transports'].split(',')
 
     def make_batches(self):
         num_batches, rem = divmod(self.messages, self.concurrent)
@@ -65,12 +76,43 @@ class WriteReadBenchmark(object):
         return DeferredList(deferreds)
 
     @inlineCallbacks
-    def run(self):
-        manager = TxRiakManager.from_config({'bucket_prefix': 'test.bench.'})
+    def load_bunches(self, bunch_size, parallel_gets, keys):
+        manager = TxRiakManager.from_config({
+            'bucket_prefix': 'test.bench.',
+            'load_bunch_size': bunch_size,
+            'parallel_gets': parallel_gets,
+            'max_parallel_gets': self.max_parallel_gets,
+        })
         model = manager.proxy(MessageModel)
-        yield manager.purge_all()
+        start = time.time()
+        loaded = 0
+        for bunch in model.load_all_bunches(keys):
+            loaded += len((yield bunch))
+        load_time = time.time() - start
+        if loaded != len(keys):
+            raise RuntimeError("Loaded %d of %d messages." % (
+                loaded, len(keys)))
+        print "  %-12s bunch size %4d: %.2f seconds (%.2f msgs/s)" % (
+            "parallel GET" if parallel_gets else "MapReduce", bunch_size,
+            load_time, len(keys) / load_time)
 
-        msg_batches = self.make_batches()
+    @inlineCallbacks
+    def compare_bunch_loading(self, msg_batches):
+        print "Loading bunches:"
+        keys = [msg['message_id'] for batch in msg_batches for msg in batch]
+        for bunch_size in self.bunch_sizes:
+            for parallel_gets in (False, True):
+                yield self.load_bunches(bunch_size, parallel_gets, keys)
+
+    @inlineCallbacks
+    def write_and_read(self, transport, msg_batches):
+        manager = TxRiakManager.from_config({
+            'bucket_prefix': 'test.bench.',
+            'transport': transport,
+        })
+        model = manager.proxy(MessageModel)
+        yield manager.purge_all()
+        print "Transport: %s" % (transport,)
 
         start = time.time()
 
@@ -102,6 +144,17 @@ class WriteReadBenchmark(object):
                                        " message %r" % (msg, stored_msg.msg))
 
         print "Messages retrieved successfully."
+        yield manager.close_manager()
+
+    @inlineCallbacks
+    def run(self):
+        manager = TxRiakManager.from_config({'bucket_prefix': 'test.bench.'})
+        msg_batches = self.make_batches()
+
+        for transport in self.transports:
+            yield self.write_and_read(transport, msg_batches)
+
+        yield self.compare_bunch_loading(msg_batches)
 
         yield manager.purge_all()
         print "Messages purged."
@@ -1,6 +1,7 @@
 # -*- test-case-name: vumi.scripts.tests.test_db_backup -*-
 import sys
 import json
+import gzip
 import pkg_resources
 import traceback
 import re
@@ -8,6 +9,9 @@ import time
 import calendar
 import copy
 from datetime import datetime
+from itertools import islice, groupby
+from threading import Thread, Lock
+from Queue import Queue
 
 import yaml
 from twisted.python import usage
@@ -21,6 +25,104 @@ def vumi_version():
     return str(vumi)
 
 
+def open_backup(filename):
+    """Open a backup file for reading, decompressing it if it is gzipped."""
+    with open(filename, "rb") as backup:
+        magic = backup.read(2)
+    if magic == '\x1f\x8b':
+        return gzip.open(filename, "rb")
+    return open(filename, "rb")
+
+
+def chunks(iterable, size):
+    """Split ``iterable`` into lists of at most ``size`` items."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def run_in_threads(func, items, workers):
+    """Call ``func`` on each item using ``workers`` threads.
+
+    Only a few items are read ahead of the workers, so ``items`` may be a
+    large iterator. The first exception raised by ``func`` is re-raised once
+    the workers have stopped.
+    """
+    if workers <= 1:
+        for item in items:
+            func(item)
+        return
+
+    stop = object()
+    queue = Queue(maxsize=2 * workers)
+    errors = []
+
+    def worker():
+        while True:
+            item = queue.get()
+            if item is stop:
+                return
+            try:
+                func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for item in items:
+            if errors:
+                break
+            queue.put(item)
+    finally:
+        for thread in threads:
+            queue.put(stop)
+        for thread in threads:
+            thread.join()
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+
+
+def unique_sorted(keys):
+    """Sort ``keys``, dropping any that are repeated."""
+    return (key for key, _ in groupby(sorted(keys)))
+
+
+class ProgressReporter(object):
+    """Counts items and emits a progress line every ``interval`` of them.
+
+    No progress lines are emitted if ``interval`` is ``None``. Items may be
+    added from several threads.
+    """
+
+    def __init__(self, emit, message, interval=None):
+        self.emit = emit
+        self.message = message
+        self.interval = interval
+        self.count = 0
+        self.start = time.time()
+        self._lock = Lock()
+
+    def add(self, count):
+        with self._lock:
+            before, self.count = self.count, self.count + count
+            if (self.interval and
+                    before // self.interval != self.count // self.interval):
+                self.report()
+
+    def rate(self):
+        elapsed = time.time() - self.start
+        return self.count / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        self.emit(self.message % {'count': self.count, 'rate': self.rate()})
+
+
 class KeyHandler(object):
 
     REDIS_TYPES = ('string', 'list', 'set', 'zset', 'hash')
@@ -32,24 +134,62 @@ class KeyHandler(object):
                                   for ktype in self.REDIS_TYPES)
 
     def dump_key(self, redis, key):
-        key_type = redis.type(key)
-        record = {
+        [record] = self.dump_keys(redis, [key])
+        return record
+
+    def dump_keys(self, redis, keys):
+        """Dump several keys in two pipelined round trips.
+
+        Keys that no longer exist by the time they're dumped are skipped.
+        """
+        pipe = redis.pipeline()
+        for key in keys:
+            pipe.type(key)
+            pipe.ttl(key)
+        results = pipe.execute()
+        found = [(key, key_type, ttl) for key, key_type, ttl
+                 in zip(keys, results[::2], results[1::2])
+                 if key_type in self._get_handlers]
+
+        for key, key_type, _ttl in found:
+            self._get_handlers[key_type](pipe, key)
+        values = pipe.execute()
+
+        return [{
             'type': key_type,
             'key': key,
-            'value': self._get_handlers[key_type](redis, key),
-            'ttl': redis.ttl(key),
-        }
-        return record
+            'value': self.clean_value(key_type, value),
+            'ttl': ttl,
+        } for (key, key_type, ttl), value in zip(found, values)]
+
+    def clean_value(self, key_type, value):
+        if key_type == 'set':
+            return sorted(value)
+        return value
 
     def restore_key(self, redis, record, ttl_offset=0):
-        key, key_type, ttl = record['key'], record['type'], record['ttl']
-        if ttl is not None:
-            ttl -= ttl_offset
-            if ttl <= 0:
-                return
-        self._set_handlers[key_type](redis, key, record['value'])
-        if ttl is not None:
-            redis.expire(key, int(round(ttl)))
+        self.restore_keys(redis, [record], ttl_offset)
+
+    def restore_keys(self, redis, records, ttl_offset=0):
+        """Restore several keys in one pipelined round trip.
+
+        Each key is replaced, so restoring a record twice (unsorted backups
+        may contain a key more than once) leaves a single copy. The pipeline
+        is a transaction so that batches restored in parallel can't
+        interleave their deletes and writes of the same key.
+        """
+        pipe = redis.pipeline(transaction=True)
+        for record in records:
+            key, key_type, ttl = record['key'], record['type'], record['ttl']
+            if ttl is not None:
+                ttl -= ttl_offset
+                if ttl <= 0:
+                    continue
+            pipe.delete(key)
+            self._set_handlers[key_type](pipe, key, record['value'])
+            if ttl is not None:
+                pipe.expire(key, int(round(ttl)))
+        pipe.execute()
 
     def record_okay(self, record):
         if not isinstance(record, dict):
@@ -73,7 +213,7 @@ class KeyHandler(object):
             redis.rpush(key, item)
 
     def set_get(self, redis, key):
-        return sorted(redis.smembers(key))
+        return redis.smembers(key)
 
     def set_set(self, redis, key, value):
         for item in value:
@@ -99,11 +239,20 @@ class BackupDbsCmd(usage.Options):
 
     optFlags = [
         ["not-sorted", None, "Don't sort keys when doing backup."],
+        ["gzip", "z", "Compress the backup with gzip."],
+    ]
+
+    optParameters = [
+        ["batch-size", None, 100, "Number of keys to fetch at a time.", int],
+        ["progress", None, None, "Report progress every N keys.", int],
     ]
 
     def parseArgs(self, db_config, db_backup):
         self.db_config = yaml.safe_load(open(db_config))
-        self.db_backup = open(db_backup, "wb")
+        if self['gzip']:
+            self.db_backup = gzip.open(db_backup, "wb")
+        else:
+            self.db_backup = open(db_backup, "wb")
         self.redis_config = self.db_config.get('redis_manager', {})
 
     def header(self, cfg):
@@ -124,15 +273,26 @@ class BackupDbsCmd(usage.Options):
         cfg.emit("Backing up dbs ...")
         redis = cfg.get_redis(self.redis_config)
         key_handler = KeyHandler()
-        keys = redis.keys()
+        progress = ProgressReporter(
+            cfg.emit, "Backed up %(count)d keys (%(rate).1f keys/s).",
+            self['progress'])
+        # SCAN rather than KEYS so we don't block redis. Unsorted backups
+        # are written as the keys come in, so a key SCAN returns more than
+        # once is written more than once. Restoring replaces keys, so that
+        # is harmless.
+        keys = redis.scan_iter(count=self['batch-size'])
         if not self.opts['not-sorted']:
-            keys = sorted(keys)
+            keys = unique_sorted(keys)
         self.write_line(self.header(cfg))
-        for key in keys:
-            record = key_handler.dump_key(redis, key)
-            self.write_line(record)
+        for chunk in chunks(keys, self['batch-size']):
+            records = key_handler.dump_keys(redis, chunk)
+            for record in records:
+                self.write_line(record)
+            progress.add(len(records))
         self.db_backup.close()
-        cfg.emit("Backed up %d keys." % (len(keys),))
+        cfg.emit("Backed up %d keys." % (progress.count,))
+        if self['progress']:
+            progress.report()
 
 
 class RestoreDbsCmd(usage.Options):
@@ -150,9 +310,15 @@ class RestoreDbsCmd(usage.Options):
                               "keys whose TTLs are then zero or negative."],
     ]
 
+    optParameters = [
+        ["batch-size", None, 100, "Number of keys to write at a time.", int],
+        ["workers", None, 1, "Number of batches to write in parallel.", int],
+        ["progress", None, None, "Report progress every N keys.", int],
+    ]
+
     def parseArgs(self, db_config, db_backup):
         self.db_config = yaml.safe_load(open(db_config))
-        self.db_backup = open(db_backup, "rb")
+        self.db_backup = open_backup(db_backup)
         self.redis_config = self.db_config.get('redis_manager', {})
 
     def check_header(self, header):
@@ -198,26 +364,40 @@ class RestoreDbsCmd(usage.Options):
         if self.opts['purge']:
             redis._purge_all()
         key_handler = KeyHandler()
-        keys, skipped = 0, 0
-        for i, line in enumerate(line_iter):
-            try:
-                record = json.loads(line)
-            except Exception:
-                excinfo = sys.exc_info()
-                for s in traceback.format_exception(*excinfo):
-                    cfg.emit(s)
-                skipped += 1
-                continue
-            if not key_handler.record_okay(record):
-                cfg.emit("Skipping bad backup record on line %d." % (i + 1,))
-                skipped += 1
-                continue
-            key_handler.restore_key(redis, record, ttl_offset)
-            keys += 1
-
-        cfg.emit("%d keys successfully restored." % keys)
-        if skipped != 0:
-            cfg.emit("WARNING: %d bad backup lines skipped." % skipped)
+        progress = ProgressReporter(
+            cfg.emit, "Restored %(count)d keys (%(rate).1f keys/s).",
+            self['progress'])
+        skipped = [0]
+
+        def records():
+            for i, line in enumerate(line_iter):
+                try:
+                    record = json.loads(line)
+                except Exception:
+                    excinfo = sys.exc_info()
+                    for s in traceback.format_exception(*excinfo):
+                        cfg.emit(s)
+                    skipped[0] += 1
+                    continue
+                if not key_handler.record_okay(record):
+                    cfg.emit("Skipping bad backup record on line %d." % (
+                        i + 1,))
+                    skipped[0] += 1
+                    continue
+                yield record
+
+        def restore_batch(batch):
+            key_handler.restore_keys(redis, batch, ttl_offset)
+            progress.add(len(batch))
+
+        run_in_threads(restore_batch, chunks(records(), self['batch-size']),
+                       self['workers'])
+
+        cfg.emit("%d keys successfully restored." % progress.count)
+        if skipped[0] != 0:
+            cfg.emit("WARNING: %d bad backup lines skipped." % skipped[0])
+        if self['progress']:
+            progress.report()
 
 
 class MigrateDbsCmd(usage.Options):
@@ -227,7 +407,7 @@ class MigrateDbsCmd(usage.Options):
 
     def parseArgs(self, migration_config, db_backup, migrated_backup):
         self.migration_config = yaml.safe_load(open(migration_config))
-        self.db_backup = open(db_backup, "rb")
+        self.db_backup = open_backup(db_backup)
         self.migrated_backup = open(migrated_backup, "wb")
 
     def postOptions(self):
@@ -358,7 +538,7 @@ class AnalyzeCmd(usage.Options):
     ]
 
     def parseArgs(self, db_backup):
-        self.db_backup = open(db_backup, "rb")
+        self.db_backup = open_backup(db_backup)
 
     def run(self, cfg):
         backup_lines = iter(self.db_backup)
@@ -1,6 +1,7 @@
 """Tests for vumi.scripts.db_backup."""
 
 import json
+import gzip
 import datetime
 
 import yaml
@@ -140,6 +141,49 @@ class BackupDbCmdTestCase(DbBackupBaseTestCase):
                                    'value': {"foo": "1", "baz": "2"},
                                    'ttl': None}])
 
+    def test_backup_in_batches(self):
+        for i in range(25):
+            self.redis.set("bar:key%02d" % (i,), i)
+        db_backup = self.mktemp()
+        cfg = self.make_cfg(["backup", "--batch-size", "4", "--progress",
+                             "10", self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        self.assertEqual(cfg.output[0], 'Backing up dbs ...')
+        self.assertEqual(
+            [line.split(' (')[0] for line in cfg.output[1:]], [
+                'Backed up 12 keys',
+                'Backed up 20 keys',
+                'Backed up 25 keys.',
+                'Backed up 25 keys',
+            ])
+        with open(db_backup) as backup:
+            records = [json.loads(x) for x in backup][1:]
+        self.assertEqual([record['key'] for record in records],
+                         ["key%02d" % (i,) for i in range(25)])
+
+    def test_backup_not_sorted(self):
+        for i in range(5):
+            self.redis.set("bar:key%d" % (i,), i)
+        db_backup = self.mktemp()
+        cfg = self.make_cfg(["backup", "--not-sorted", "--batch-size", "2",
+                             self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        with open(db_backup) as backup:
+            records = [json.loads(x) for x in backup]
+        self.assertEqual(False, records[0]['sorted'])
+        self.assertEqual(["key%d" % (i,) for i in range(5)],
+                         sorted(record['key'] for record in records[1:]))
+
+    def test_gzip_backup(self):
+        self.redis.set("bar:s", "foo")
+        db_backup = self.mktemp()
+        cfg = self.make_cfg(["backup", "--gzip", self.mkdbconfig("bar"),
+                             db_backup])
+        cfg.run()
+        backup = gzip.open(db_backup)
+        self.assertEqual([json.loads(x) for x in backup][1:], [
+            {'key': 's', 'type': 'string', 'value': 'foo', 'ttl': None}])
+
     def test_ttl_backup(self):
         self.redis.set("bar:s", "foo")
         self.redis.expire("bar:s", 30)
@@ -216,6 +260,42 @@ class RestoreDbCmdTestCase(DbBackupBaseTestCase):
         expected_data = [("bar:%s" % k, v) for k, v in expected_data]
         self.assertEqual(redis_data, expected_data)
 
+    def test_restore_gzipped_backup(self):
+        db_backup = self.mktemp()
+        backup = gzip.open(db_backup, "wb")
+        backup.write("\n".join(json.dumps(x) for x in self.DB_BACKUP))
+        backup.close()
+        cfg = self.make_cfg(["restore", self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        self.assertEqual(cfg.output, [
+            'Restoring dbs ...',
+            '2 keys successfully restored.',
+        ])
+        self.assertEqual(self.redis.get("bar:baz"), "bar")
+
+    def test_restore_in_parallel_batches(self):
+        backup_data = [self.DB_BACKUP[0]] + [
+            {'key': 'key%02d' % (i,), 'type': 'string', 'value': str(i),
+             'ttl': None} for i in range(25)]
+        cfg = self.make_cfg(["restore", "--batch-size", "3", "--workers",
+                             "3", self.mkdbconfig("bar"),
+                             self.mkdbbackup(backup_data)])
+        cfg.run()
+        self.assertEqual(cfg.output, [
+            'Restoring dbs ...',
+            '25 keys successfully restored.',
+        ])
+        self.assertEqual(
+            sorted(self.redis.keys()),
+            ["bar:key%02d" % (i,) for i in range(25)])
+        self.assertEqual(self.redis.get("bar:key24"), "24")
+
+    def test_restore_repeated_key(self):
+        record = {'key': 'l', 'type': 'list', 'value': ['a', 'b'],
+                  'ttl': None}
+        self.check_restore([record, record], {'l': ['a', 'b']},
+                           lambda k: self.redis.lrange(k, 0, -1))
+
     def test_restore_with_purge(self):
         redis = self.redis.sub_manager("bar")
         redis.set("foo", 1)
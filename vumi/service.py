@@ -1,23 +1,32 @@
 # -*- test-case-name: vumi.tests.test_service -*-
 
 import json
+import heapq
 from copy import deepcopy
+from collections import deque
 
 from twisted.python import log
 from twisted.application.service import MultiService
 from twisted.application.internet import TCPClient
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (inlineCallbacks, returnValue, Deferred,
+                                    succeed, gatherResults, DeferredList,
+                                    DeferredSemaphore, DeferredLock)
 from twisted.internet import protocol, reactor
+from twisted.internet.error import ConnectError, DNSLookupError
+from twisted.python.failure import Failure
 from twisted.web.resource import Resource
+from twisted.web.client import ResponseFailed
 import txamqp
 from txamqp.client import TwistedDelegate
 from txamqp.content import Content
 from txamqp.protocol import AMQClient
 
 from vumi.errors import VumiError
-from vumi.message import Message
-from vumi.utils import (load_class_by_string, vumi_resource_path, http_request,
-                        basic_auth_string, LogFilterSite)
+from vumi.message import (Message, get_message_codec,
+                          codec_for_content_type, COMPACT_MESSAGE_CLASSES)
+from vumi.utils import (load_class_by_string, vumi_resource_path,
+                        http_request_full, basic_auth_string, LogFilterSite,
+                        HttpTimeoutError)
 
 
 SPECS = {}
@@ -42,7 +51,7 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
         self.options = worker.options
         self.config = worker.config
         self.spec = get_spec(vumi_resource_path(worker.options['specfile']))
-        self.delegate = TwistedDelegate()
+        self.delegate = WorkerDelegate()
         self.worker = worker
         self.amqp_client = None
 
@@ -53,6 +62,14 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
         self.amqp_client.factory = self
         self.amqp_client.vumi_options = self.options
         self.amqp_client.connected_callback = self.worker._amqp_connected
+        max_channels = self.config.get('amqp_max_publisher_channels')
+        if max_channels is not None:
+            self.amqp_client.max_publisher_channels = int(max_channels)
+        self.amqp_client.management_url = self.config.get(
+            'amqp_management_url')
+        management_timeout = self.config.get('amqp_management_timeout')
+        if management_timeout is not None:
+            self.amqp_client.management_timeout = float(management_timeout)
         self.resetDelay()
         return self.amqp_client
 
@@ -74,7 +91,49 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
             self, connector, reason)
 
 
+class WorkerDelegate(TwistedDelegate):
+    """
+    Delegate that passes publisher confirms from the broker on to the
+    channel's ``confirm_handler`` (if it has one).
+    """
+
+    def basic_ack(self, ch, msg):
+        self._confirm(ch, msg, True)
+
+    def basic_nack(self, ch, msg):
+        self._confirm(ch, msg, False)
+
+    def _confirm(self, ch, msg, acked):
+        handler = getattr(ch, 'confirm_handler', None)
+        if handler is None:
+            log.msg("Received unexpected publisher confirm: %r" % (msg,))
+            return
+        handler(msg.delivery_tag, msg.multiple, acked)
+
+
 class WorkerAMQClient(AMQClient):
+
+    # Publishers that can share a channel are pooled by exchange. Once
+    # this many publisher channels are open, new exchanges are assigned to
+    # the least used existing channel. ``None`` means no limit.
+    max_publisher_channels = 8
+
+    # The RabbitMQ management API URL to check routing key bindings
+    # against, and how long to wait for it. Bindings aren't checked if
+    # there's no URL. See :class:`BindingCache`.
+    management_url = None
+    management_timeout = 5
+
+    def __init__(self, *args, **kwargs):
+        AMQClient.__init__(self, *args, **kwargs)
+        self.binding_caches = {}
+        self.publishers = []
+        self.publisher_channels = {}
+        self._publisher_channel_users = {}
+        self._publisher_channel_lock = DeferredLock()
+        self._free_channel_ids = []
+        self._next_channel_id = 0
+
     @inlineCallbacks
     def connectionMade(self):
         AMQClient.connectionMade(self)
@@ -98,11 +157,65 @@ class WorkerAMQClient(AMQClient):
 
     def get_new_channel_id(self):
         """
-        AMQClient keeps track of channels in a dictionary. The
-        channel ids are the keys, get the highest number and up it
-        or just return zero for the first channel
+        Return the lowest channel id released by :meth:`release_channel`
+        or, if there aren't any, the next id that hasn't been used yet.
+        """
+        if self._free_channel_ids:
+            return heapq.heappop(self._free_channel_ids)
+        while self._next_channel_id in self.channels:
+            self._next_channel_id += 1
+        channel_id = self._next_channel_id
+        self._next_channel_id += 1
+        return channel_id
+
+    def release_channel(self, channel):
+        """
+        Forget about a closed channel so that its id can be reused.
         """
-        return (max(self.channels) + 1) if self.channels else 0
+        if self.channels.get(channel.id) is channel:
+            del self.channels[channel.id]
+            heapq.heappush(self._free_channel_ids, channel.id)
+        self._publisher_channel_users.pop(channel.id, None)
+        for exchange_name, pooled in self.publisher_channels.items():
+            if pooled is channel:
+                del self.publisher_channels[exchange_name]
+
+    @inlineCallbacks
+    def get_publisher_channel(self, publisher):
+        """
+        Return a channel for ``publisher`` to publish on.
+
+        Publishers on the same exchange share a channel unless they need
+        one of their own (see :meth:`Publisher.can_share_channel`).
+        """
+        if not publisher.can_share_channel():
+            channel = yield self.get_channel()
+            returnValue(channel)
+        yield self._publisher_channel_lock.acquire()
+        try:
+            exchange_name = publisher.exchange_name
+            channel = self.publisher_channels.get(exchange_name)
+            if channel is None:
+                users = self._publisher_channel_users
+                if (self.max_publisher_channels is not None
+                        and len(users) >= self.max_publisher_channels):
+                    channel = self.channels[min(users, key=users.get)]
+                else:
+                    channel = yield self.get_channel()
+                    users[channel.id] = 0
+                self.publisher_channels[exchange_name] = channel
+            self._publisher_channel_users[channel.id] += 1
+        finally:
+            self._publisher_channel_lock.release()
+        returnValue(channel)
+
+    def get_binding_cache(self, exchange_name):
+        if exchange_name not in self.binding_caches:
+            self.binding_caches[exchange_name] = BindingCache(
+                self.vumi_options, exchange_name,
+                management_url=self.management_url,
+                timeout=self.management_timeout)
+        return self.binding_caches[exchange_name]
 
     def _declare_exchange(self, source, channel):
         # get the details for AMQP
@@ -138,6 +251,7 @@ class WorkerAMQClient(AMQClient):
         reply = yield channel.basic_consume(queue=queue_name)
         queue = yield self.queue(reply.consumer_tag)
         # start consuming! nom nom nom
+        consumer.amqp_client = self
         consumer.start(channel, queue)
         # return the newly created & consuming consumer
         returnValue(consumer)
@@ -145,18 +259,35 @@ class WorkerAMQClient(AMQClient):
     @inlineCallbacks
     def start_publisher(self, publisher_class, *args, **kwargs):
         # much more braindead than start_consumer
-        # get a channel
-        channel = yield self.get_channel()
-        # start the publisher
         publisher = publisher_class(*args, **kwargs)
+        # get a channel, possibly shared with other publishers
+        channel = yield self.get_publisher_channel(publisher)
         publisher.vumi_options = self.vumi_options
+        # share routing key binding information between publishers
+        publisher.binding_cache = self.get_binding_cache(
+            publisher.exchange_name)
+        if publisher.require_bind:
+            yield publisher.binding_cache.load()
         # declare the exchange, doesn't matter if it already exists
         yield self._declare_exchange(publisher, channel)
         # start!
         yield publisher.start(channel)
+        self.publishers.append(publisher)
         # return the publisher
         returnValue(publisher)
 
+    def stop_publishers(self):
+        """
+        Stop all the publishers, publishing any messages they're holding.
+        """
+        publishers, self.publishers = self.publishers, []
+        return gatherResults([publisher.stop() for publisher in publishers])
+
+    def connectionLost(self, reason):
+        for publisher in self.publishers:
+            publisher.connection_lost(reason)
+        AMQClient.connectionLost(self, reason)
+
 
 class Worker(MultiService, object):
     """
@@ -195,14 +326,37 @@ class Worker(MultiService, object):
     def stopService(self):
         if self.running:
             yield self.stopWorker()
+            if self._amqp_client is not None:
+                yield self._amqp_client.stop_publishers()
         yield super(Worker, self).stopService()
 
     def routing_key_to_class_name(self, routing_key):
         return ''.join(map(lambda s: s.capitalize(), routing_key.split('.')))
 
+    def get_message_codec(self):
+        """
+        Return the codec to use for this worker's messages.
+
+        The codec is chosen by the ``message_codec`` config option, see
+        :data:`vumi.message.MESSAGE_CODECS`.
+        """
+        return get_message_codec(self.config.get('message_codec'))
+
     def consume(self, routing_key, callback, queue_name=None,
                 exchange_name='vumi', exchange_type='direct', durable=True,
-                message_class=None, paused=False):
+                message_class=None, paused=False, message_codec=None,
+                concurrency=1):
+        """
+        Consume messages from a queue bound to ``routing_key``.
+
+        Acknowledgements are batched if the ``amqp_ack_batch_size`` config
+        option is more than 1, see :class:`Consumer`. Messages that fail to
+        be consumed concurrently are requeued unless the
+        ``amqp_discard_failed_messages`` config option is set. If the
+        ``compact_messages`` config option is set, user messages and events
+        are decoded into the compact message classes, see
+        :data:`vumi.message.COMPACT_MESSAGE_CLASSES`.
+        """
 
         # use the routing key to generate the name for the class
         # amq.routing.key -> AmqRoutingKey
@@ -215,28 +369,65 @@ class Worker(MultiService, object):
             'exchange_type': exchange_type,
             'durable': durable,
             'start_paused': paused,
+            'message_codec': message_codec or self.get_message_codec(),
+            'concurrency': concurrency,
+            'ack_batch_size': int(self.config.get('amqp_ack_batch_size', 1)),
+            'ack_batch_interval': float(
+                self.config.get('amqp_ack_batch_interval', 0.1)),
+            'discard_failed': bool(
+                self.config.get('amqp_discard_failed_messages', False)),
         }
         log.msg('Starting %s with %s' % (class_name, kwargs))
         klass = type(class_name, (DynamicConsumer,), kwargs)
         if message_class is not None:
+            if self.config.get('compact_messages', False):
+                message_class = COMPACT_MESSAGE_CLASSES.get(
+                    message_class, message_class)
             klass.message_class = message_class
         return self.start_consumer(klass, callback)
 
     def start_consumer(self, consumer_class, *args, **kw):
         return self._amqp_client.start_consumer(consumer_class, *args, **kw)
 
+    def get_publisher_options(self):
+        """
+        Return the publisher class and attributes to use for this worker's
+        publishers.
+
+        Publishing is batched if the ``amqp_publish_batch_size`` or
+        ``amqp_publisher_confirms`` config options are set, see
+        :class:`BatchingPublisher`. Publishers share channels unless
+        ``amqp_share_publisher_channels`` is false.
+        """
+        batch_size = self.config.get('amqp_publish_batch_size')
+        use_confirms = self.config.get('amqp_publisher_confirms', False)
+        attrs = {"share_channel": bool(
+            self.config.get('amqp_share_publisher_channels', True))}
+        if not (batch_size or use_confirms):
+            return Publisher, attrs
+        attrs["use_confirms"] = use_confirms
+        if batch_size:
+            attrs["batch_size"] = int(batch_size)
+        batch_interval = self.config.get('amqp_publish_batch_interval')
+        if batch_interval is not None:
+            attrs["batch_interval"] = float(batch_interval)
+        return BatchingPublisher, attrs
+
     def publish_to(self, routing_key,
                    exchange_name='vumi', exchange_type='direct', durable=True,
-                   delivery_mode=2):
+                   delivery_mode=2, message_codec=None):
         class_name = self.routing_key_to_class_name(routing_key)
-        publisher_class = type("%sDynamicPublisher" % class_name, (Publisher,),
-            {
+        base_class, attrs = self.get_publisher_options()
+        attrs.update({
                 "routing_key": routing_key,
                 "exchange_name": exchange_name,
                 "exchange_type": exchange_type,
                 "durable": durable,
                 "delivery_mode": delivery_mode,
+                "message_codec": message_codec or self.get_message_codec(),
             })
+        publisher_class = type(
+            "%sDynamicPublisher" % class_name, (base_class,), attrs)
         return self.start_publisher(publisher_class)
 
     def start_publisher(self, publisher_class, *args, **kw):
@@ -283,7 +474,25 @@ class Consumer(object):
     routing_key = "routing_key"
 
     message_class = Message
+    message_codec = None
     start_paused = False
+    # Maximum number of messages processed at the same time. This should be
+    # no larger than the channel's prefetch count.
+    concurrency = 1
+    # If ack_batch_size is more than 1, acknowledgements are sent once that
+    # many messages are ready to be acknowledged or ack_batch_interval
+    # seconds after the first one is, whichever comes first.
+    ack_batch_size = 1
+    ack_batch_interval = 0.1
+    # A message that fails to be consumed is handled differently depending
+    # on concurrency. When messages are consumed one at a time the failure
+    # stops the consumer, leaving the message unacknowledged for the broker
+    # to redeliver once the channel closes. When they are consumed
+    # concurrently the consumer carries on and rejects the message, which
+    # the broker requeues unless discard_failed is set, in which case it is
+    # dropped (or dead-lettered if the queue is set up to).
+    discard_failed = False
+    clock = reactor
 
     @inlineCallbacks
     def start(self, channel, queue):
@@ -292,6 +501,16 @@ class Consumer(object):
         self.keep_consuming = True
         self._testing = hasattr(channel, 'message_processed')
         self.paused = self.start_paused
+        self._slots = DeferredSemaphore(max(1, self.concurrency))
+        # Delivery tags in the order they arrived and whether each message is
+        # ready to be acknowledged, for batched acknowledgements.
+        self._delivery_tags = deque()
+        self._ack_ready = {}
+        self._ack_ready_count = 0
+        self._ack_call = None
+        # Deferreds for the messages being consumed, so that stop() can
+        # wait for them.
+        self._in_flight = set()
 
         @inlineCallbacks
         def read_messages():
@@ -302,7 +521,18 @@ class Consumer(object):
                     if isinstance(message, QueueCloseMarker):
                         log.msg("Queue closed.")
                         return
-                    yield self.consume(message)
+                    if self.concurrency > 1:
+                        yield self._slots.acquire()
+                        if not self.keep_consuming:
+                            # The broker redelivers this message once the
+                            # channel is closed.
+                            self._slots.release()
+                            return
+                        self.consume_concurrently(message)
+                    else:
+                        if not self.keep_consuming:
+                            return
+                        yield self._track(self.consume(message))
             except txamqp.queue.Closed, e:
                 log.err("Queue has closed", e)
 
@@ -318,10 +548,22 @@ class Consumer(object):
         self.paused = False
         return self.channel.channel_flow(active=True)
 
+    def decode_message(self, message):
+        properties = getattr(message.content, 'properties', None) or {}
+        codec = codec_for_content_type(properties.get('content type'),
+                                       self.message_codec)
+        return self.message_class.decode(message.content.body, codec)
+
     @inlineCallbacks
     def consume(self, message):
-        result = yield self.consume_message(self.message_class.from_json(
-                                            message.content.body))
+        if self.ack_batch_size > 1:
+            self._delivery_tags.append(message.delivery_tag)
+            self._ack_ready[message.delivery_tag] = False
+        try:
+            result = yield self.consume_message(self.decode_message(message))
+        except Exception:
+            self._forget_delivery(message.delivery_tag)
+            raise
         if self._testing:
             self.channel.message_processed()
         if result is not False:
@@ -329,22 +571,113 @@ class Consumer(object):
         else:
             log.msg('Received %s as a return value consume_message. '
                     'Not acknowledging AMQ message' % result)
+            self._forget_delivery(message.delivery_tag)
+
+    def consume_concurrently(self, message):
+        d = self._track(self.consume(message))
+        d.addErrback(self._consume_failed, message)
+        d.addBoth(lambda _: self._slots.release())
+        return d
+
+    def _consume_failed(self, failure, message):
+        log.err(failure, "Error consuming message")
+        # Reject the message so that it doesn't hold on to a prefetch slot
+        # forever.
+        self.channel.basic_reject(
+            message.delivery_tag, not self.discard_failed)
+        if self._testing:
+            self.channel.message_processed()
+
+    def _track(self, d):
+        self._in_flight.add(d)
+
+        def untrack(result):
+            self._in_flight.discard(d)
+            return result
+
+        return d.addBoth(untrack)
 
     def consume_message(self, message):
         """helper method, override in implementation"""
         log.msg("Received message: %s" % message)
 
     def ack(self, message):
-        self.channel.basic_ack(message.delivery_tag, True)
+        if message.delivery_tag in self._ack_ready:
+            return self._batch_ack(message.delivery_tag)
+        # Messages can complete out of order when they are processed
+        # concurrently, so we may only acknowledge this one.
+        self.channel.basic_ack(message.delivery_tag, self.concurrency <= 1)
+
+    def _forget_delivery(self, delivery_tag):
+        # A message that won't be acknowledged on its own mustn't hold up
+        # the batched acknowledgement of the messages after it. As with
+        # unbatched acknowledgements, the next ``multiple`` ack covers it.
+        self._ack_ready.pop(delivery_tag, None)
+
+    def _batch_ack(self, delivery_tag):
+        self._ack_ready[delivery_tag] = True
+        self._ack_ready_count += 1
+        if self._ack_ready_count >= self.ack_batch_size:
+            self.flush_acks()
+        elif self._ack_call is None:
+            self._ack_call = self.clock.callLater(
+                self.ack_batch_interval, self.flush_acks)
+
+    def flush_acks(self):
+        """
+        Send any pending batched acknowledgements.
+
+        Everything up to the last message in an unbroken run of ready
+        messages at the front of the delivery order is acknowledged with a
+        single ``multiple`` ack. Messages that failed or that
+        :meth:`consume_message` chose not to acknowledge don't break the
+        run. Messages that completed out of order are acknowledged
+        individually.
+        """
+        if self._ack_call is not None and self._ack_call.active():
+            self._ack_call.cancel()
+        self._ack_call = None
+        self._ack_ready_count = 0
+
+        last_tag = None
+        tags = self._delivery_tags
+        while tags and self._ack_ready.get(tags[0], True):
+            # Tags missing from _ack_ready have been acknowledged already.
+            tag = tags.popleft()
+            if self._ack_ready.pop(tag, False):
+                last_tag = tag
+        if last_tag is not None:
+            self.channel.basic_ack(last_tag, True)
+        if not tags:
+            return
+
+        # Anything left is behind a message that is still being consumed.
+        # There are at most `concurrency` of those, so this stays short.
+        pending = deque()
+        for tag in tags:
+            if self._ack_ready.get(tag):
+                del self._ack_ready[tag]
+                self.channel.basic_ack(tag, False)
+            elif tag in self._ack_ready:
+                pending.append(tag)
+        self._delivery_tags = pending
 
     @inlineCallbacks
     def stop(self):
         log.msg("Consumer stopping...")
         self.keep_consuming = False
+        # Let messages that are being consumed finish and be acknowledged
+        # before the channel is closed.
+        if self._in_flight:
+            yield DeferredList(list(self._in_flight))
+        self.flush_acks()
         # This actually closes the channel on the server
         yield self.channel.channel_close()
         # This just marks the channel as closed on the client
         self.channel.close(None)
+        amqp_client = getattr(self, 'amqp_client', None)
+        if amqp_client is not None:
+            amqp_client.release_channel(self.channel)
         self.queue.put(QueueCloseMarker())
         returnValue(self.keep_consuming)
 
@@ -365,6 +698,157 @@ class RoutingKeyError(Exception):
         return repr(self.value)
 
 
+class BindingCache(object):
+    """
+    Cache of the routing keys bound on one exchange, as reported by the
+    RabbitMQ management API.
+
+    Lookups never wait for the management API. Once the cache has been
+    loaded, keys missing from it are assumed to be bound while the cache is
+    refreshed in the background, and keys that are still missing after the
+    refresh are cached as unbound. Entries older than :attr:`ttl` seconds
+    are used while a background refresh fetches new ones.
+
+    If no management API URL is given, or the management API isn't
+    available, every key is treated as bound. The ``amqp_management_url``
+    (e.g. ``http://localhost:55672/api/bindings``) and
+    ``amqp_management_timeout`` worker config options set the URL and
+    timeout.
+
+    :param str management_url:
+        The URL of the management API's bindings resource, or ``None``.
+    :param float timeout:
+        Seconds to wait for the management API.
+    """
+
+    ttl = 60
+    clock = reactor
+
+    def __init__(self, vumi_options, exchange_name, management_url=None,
+                 timeout=5):
+        self.vumi_options = vumi_options
+        self.exchange_name = exchange_name
+        self.management_url = management_url
+        self.timeout = timeout
+        self.bound_routing_keys = None
+        self.unbound_routing_keys = set()
+        self._unchecked_routing_keys = set()
+        self._last_refresh = None
+        self._refresh_waiters = []
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    @inlineCallbacks
+    def list_bindings(self):
+        """
+        Fetch bindings from the management API.
+
+        Returns a dict mapping bound routing keys to lists of queue names, or
+        ``None`` if the bindings could not be fetched.
+        """
+        if self.management_url is None:
+            returnValue(None)
+        try:
+            resp = yield http_request_full(
+                self.management_url, '', method='GET', headers={
+                    'Authorization': basic_auth_string(
+                        self.vumi_options.get('username', ''),
+                        self.vumi_options.get('password', '')),
+                    }, timeout=self.timeout)
+            if resp.code != 200:
+                raise ValueError("Management API responded with %s." % (
+                    resp.code,))
+            bindings = json.loads(resp.delivered_body)
+            bound_routing_keys = {}
+            for b in bindings:
+                if (b['vhost'] == self.vumi_options.get('vhost') and
+                    b['source'] == self.exchange_name):
+                    bound_routing_keys.setdefault(
+                        b['routing_key'], []).append(b['destination'])
+        except (ConnectError, DNSLookupError, HttpTimeoutError,
+                ResponseFailed, ValueError, KeyError, TypeError), e:
+            log.msg("Can't fetch routing key bindings from %s: %s" % (
+                self.management_url, e))
+            bound_routing_keys = None
+        returnValue(bound_routing_keys)
+
+    def refresh(self):
+        """
+        Refresh the cache. Returns a deferred that fires when done.
+
+        Only one refresh happens at a time, concurrent callers wait for the
+        one already in progress.
+        """
+        d = Deferred()
+        self._refresh_waiters.append(d)
+        if len(self._refresh_waiters) == 1:
+            self.refreshes += 1
+            checking = self._unchecked_routing_keys
+            self._unchecked_routing_keys = set()
+            d_bindings = self.list_bindings()
+            d_bindings.addErrback(log.err, "Error fetching bindings")
+            d_bindings.addCallback(self._refreshed, checking)
+        return d
+
+    def _refreshed(self, bound_routing_keys, checking):
+        self._last_refresh = self.clock.seconds()
+        self.bound_routing_keys = bound_routing_keys
+        if bound_routing_keys is None:
+            self.unbound_routing_keys = set()
+        else:
+            self.unbound_routing_keys = set(
+                key for key in self.unbound_routing_keys | checking
+                if key not in bound_routing_keys)
+        waiters, self._refresh_waiters = self._refresh_waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def is_loaded(self):
+        return self._last_refresh is not None
+
+    def load(self):
+        """Load the cache if it hasn't been loaded yet."""
+        if self.is_loaded():
+            return succeed(None)
+        return self.refresh()
+
+    def is_bound(self, key):
+        """
+        Return ``False`` if ``key`` is known to be unbound, ``True``
+        otherwise.
+        """
+        if not self.is_loaded():
+            self.misses += 1
+            self._unchecked_routing_keys.add(key)
+            if not self._refresh_waiters:
+                self.refresh()
+            return True
+        if self.clock.seconds() - self._last_refresh > self.ttl:
+            if not self._refresh_waiters:
+                self.refresh()
+        if self.bound_routing_keys is None or key in self.bound_routing_keys:
+            self.hits += 1
+            return True
+        if key in self.unbound_routing_keys:
+            self.hits += 1
+            return False
+        self.misses += 1
+        self._unchecked_routing_keys.add(key)
+        if not self._refresh_waiters:
+            self.refresh()
+        return True
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'bound': len(self.bound_routing_keys or ()),
+            'unbound': len(self.unbound_routing_keys),
+        }
+
+
 class Publisher(object):
     exchange_name = "vumi"
     exchange_type = "direct"
@@ -373,41 +857,41 @@ class Publisher(object):
     durable = False
     auto_delete = False
     delivery_mode = 2  # save to disk
+    message_codec = None
+    share_channel = True
+
+    def can_share_channel(self):
+        """
+        Return ``True`` if this publisher may publish on a channel shared
+        with other publishers.
+        """
+        return self.share_channel
 
     def start(self, channel):
         log.msg("Started the publisher")
         self.channel = channel
-        self.bound_routing_keys = {}
 
         # There's probably a better way to do this.
         if not hasattr(self, 'vumi_options'):
             self.vumi_options = {}
+        if getattr(self, 'binding_cache', None) is None:
+            self.binding_cache = BindingCache(
+                self.vumi_options, self.exchange_name)
 
-    @inlineCallbacks
-    def list_bindings(self):
-        try:
-            # Note utils.callback() does a POST not a GET
-            # which may lead to errors if the RabbitMQ Management REST api
-            # changes
-            resp = yield http_request(
-                "http://localhost:55672/api/bindings", headers={
-                    'Authorization': basic_auth_string(
-                        self.vumi_options['username'],
-                        self.vumi_options['password']),
-                    })
-            bindings = json.loads(resp)
-            bound_routing_keys = {}
-            for b in bindings:
-                if (b['vhost'] == self.vumi_options['vhost'] and
-                    b['source'] == self.exchange_name):
-                    bound_routing_keys[b['routing_key']] = \
-                            bound_routing_keys.get(b['routing_key'], []) + \
-                            [b['destination']]
-        except:
-            bound_routing_keys = {"bindings": "undetected"}
-        returnValue(bound_routing_keys)
+    def stop(self):
+        """
+        Stop publishing. Publishers that hold on to messages publish them
+        here.
+        """
+        return succeed(None)
+
+    def connection_lost(self, reason):
+        """
+        Called when the AMQP connection is lost. Publishers that hold on to
+        messages fail them here.
+        """
+        pass
 
-    @inlineCallbacks
     def routing_key_is_bound(self, key):
         # Don't check for bound routing keys on RPC reply exchanges
         # The one-use queues are changing too frequently to cache efficiently,
@@ -415,36 +899,19 @@ class Publisher(object):
         # and the auto-generated queues & routing_keys are unlikley to
         # result in errors where routing keys are unbound
         if self.exchange_name[-4:].lower() == '_rpc':
-            returnValue(True)
-        if (len(self.bound_routing_keys) == 1 and
-            self.bound_routing_keys.get("bindings") == "undetected"):
-            # The following is very noisy in the logs:
-            # log.msg("No bindings detected, is the RabbitMQ Management plugin"
-            #         " installed?")
-            returnValue(True)
-        if key in self.bound_routing_keys.keys():
-            returnValue(True)
-        self.bound_routing_keys = yield self.list_bindings()
-        if (len(self.bound_routing_keys) == 1 and
-            self.bound_routing_keys.get("bindings") == "undetected"):
-            # The following is very noisy in the logs:
-            # log.msg("No bindings detected, is the RabbitMQ Management plugin"
-            #         " installed?")
-            returnValue(True)
-        returnValue(key in self.bound_routing_keys.keys())
+            return True
+        return self.binding_cache.is_bound(key)
 
-    @inlineCallbacks
     def check_routing_key(self, routing_key, require_bind):
         if(routing_key != routing_key.lower()):
             raise RoutingKeyError("The routing_key: %s is not all lower case!"
                                   % (routing_key))
         if not require_bind:
             return
-        is_bound = yield self.routing_key_is_bound(routing_key)
-        if not is_bound:
+        if not self.routing_key_is_bound(routing_key):
             raise RoutingKeyError("The routing_key: %s is not bound to any"
                                   " queues in vhost: %s  exchange: %s" % (
-                                  routing_key, self.vumi_options['vhost'],
+                                  routing_key, self.vumi_options.get('vhost'),
                                   self.exchange_name))
 
     @inlineCallbacks
@@ -458,7 +925,9 @@ class Publisher(object):
                                          routing_key=routing_key)
 
     def publish_message(self, message, **kwargs):
-        d = self.publish_raw(message.to_json(), **kwargs)
+        codec = self.message_codec or get_message_codec(None)
+        kwargs.setdefault('content_type', codec.content_type)
+        d = self.publish_raw(message.encode(codec), **kwargs)
         d.addCallback(lambda r: message)
         return d
 
@@ -470,9 +939,185 @@ class Publisher(object):
         amq_message = Content(data)
         amq_message['delivery mode'] = kwargs.pop('delivery_mode',
                 self.delivery_mode)
+        content_type = kwargs.pop('content_type', None)
+        if content_type is not None:
+            amq_message['content type'] = content_type
         return self.publish(amq_message, **kwargs)
 
 
+class PublishNackedError(VumiError):
+    """The broker could not handle a published message."""
+
+
+class PublisherStoppedError(VumiError):
+    """The connection was lost before a message was published or
+    confirmed."""
+
+
+class BatchingPublisher(Publisher):
+    """
+    Publisher that writes messages to the channel in batches.
+
+    Messages published within :attr:`batch_interval` seconds of the first
+    unsent message (up to :attr:`batch_size` of them) are written together
+    and each routing key is only checked once per batch. The default
+    interval of 0 batches the messages published during a single reactor
+    iteration, so a caller that waits for each message to be published
+    isn't held up. Pending messages are published when the publisher is
+    stopped, and fail with :class:`PublisherStoppedError` if the
+    connection is lost first.
+
+    If :attr:`use_confirms` is set, the channel is put in RabbitMQ's
+    confirm mode and the deferred returned by :meth:`publish` only fires
+    once the broker has confirmed the message (or fails with
+    :class:`PublishNackedError` if the broker rejects it). This needs an
+    AMQP spec that includes the confirm extension, such as
+    ``amqp-spec-0-9-1.xml``.
+
+    Throughput and latency counters are available from :meth:`get_stats`.
+    """
+
+    batch_size = 100
+    batch_interval = 0
+    use_confirms = False
+    clock = reactor
+
+    @inlineCallbacks
+    def start(self, channel):
+        super(BatchingPublisher, self).start(channel)
+        self._pending = []
+        self._flush_call = None
+        self._unconfirmed = {}
+        self._publish_seq = 0
+        self._started_at = self.clock.seconds()
+        self.published = 0
+        self.confirmed = 0
+        self.nacked = 0
+        self.batches = 0
+        self.total_latency = 0.0
+        if self.use_confirms:
+            if not hasattr(channel, 'confirm_select'):
+                raise VumiError("Publisher confirms require an AMQP spec with"
+                                " the confirm extension.")
+            channel.confirm_handler = self.handle_confirm
+            yield channel.confirm_select()
+
+    def publish(self, message, **kwargs):
+        d = Deferred()
+        self._pending.append((message, kwargs, d, self.clock.seconds()))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(
+                self.batch_interval, self.flush)
+        return d
+
+    @inlineCallbacks
+    def flush(self):
+        """Publish all pending messages."""
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        self.batches += 1
+
+        failures = {}
+        for key in set(self._batch_key(kwargs) for _, kwargs, _, _ in batch):
+            try:
+                yield self.check_routing_key(key[1], key[2])
+            except Exception:
+                failures[key] = Failure()
+
+        for content, kwargs, d, queued_at in batch:
+            key = self._batch_key(kwargs)
+            if key in failures:
+                d.errback(failures[key])
+                continue
+            if self.use_confirms:
+                self._publish_seq += 1
+                self._unconfirmed[self._publish_seq] = (d, queued_at)
+            self.channel.basic_publish(exchange=key[0], content=content,
+                                       routing_key=key[1])
+            self.published += 1
+            if not self.use_confirms:
+                self._record_latency(queued_at)
+                d.callback(None)
+
+    def stop(self):
+        return self.flush()
+
+    def connection_lost(self, reason):
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        pending, self._pending = self._pending, []
+        unconfirmed, self._unconfirmed = self._unconfirmed, {}
+        deferreds = [d for _, _, d, _ in pending]
+        deferreds.extend(d for _, (d, _) in sorted(unconfirmed.items()))
+        for d in deferreds:
+            d.errback(PublisherStoppedError(
+                "Connection lost before message was published: %s" % (
+                    reason.getErrorMessage(),)))
+
+    def can_share_channel(self):
+        # Publisher confirms are numbered per channel, so a confirming
+        # publisher needs a channel to itself.
+        return self.share_channel and not self.use_confirms
+
+    def _batch_key(self, kwargs):
+        return (kwargs.get('exchange_name') or self.exchange_name,
+                kwargs.get('routing_key') or self.routing_key,
+                kwargs.get('require_bind', self.require_bind))
+
+    def _record_latency(self, queued_at):
+        self.total_latency += self.clock.seconds() - queued_at
+
+    def handle_confirm(self, delivery_tag, multiple, acked):
+        if multiple:
+            tags = sorted(t for t in self._unconfirmed if t <= delivery_tag)
+        else:
+            tags = [delivery_tag]
+        for tag in tags:
+            d, queued_at = self._unconfirmed.pop(tag, (None, None))
+            if d is None:
+                continue
+            if acked:
+                self.confirmed += 1
+                self._record_latency(queued_at)
+                d.callback(None)
+            else:
+                self.nacked += 1
+                d.errback(PublishNackedError(
+                    "Broker rejected published message %d." % (tag,)))
+
+    def get_stats(self):
+        """
+        Return a dictionary of publishing counters:
+
+        * ``published``: messages written to the channel.
+        * ``confirmed`` and ``nacked``: broker confirms received.
+        * ``unconfirmed``: messages awaiting a confirm.
+        * ``batches``: batches written.
+        * ``throughput``: messages published per second since starting.
+        * ``avg_latency``: mean seconds from :meth:`publish` being called to
+          the message being written (or confirmed, with confirms enabled).
+        """
+        elapsed = self.clock.seconds() - self._started_at
+        completed = self.confirmed if self.use_confirms else self.published
+        return {
+            'published': self.published,
+            'confirmed': self.confirmed,
+            'nacked': self.nacked,
+            'unconfirmed': len(self._unconfirmed),
+            'batches': self.batches,
+            'throughput': (self.published / elapsed) if elapsed else 0.0,
+            'avg_latency': ((self.total_latency / completed)
+                            if completed else 0.0),
+        }
+
+
 class WorkerCreator(object):
     """
     Creates workers
@@ -5,11 +5,10 @@ import re
 
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
-from txamqp.client import TwistedDelegate
 from txamqp.content import Content
 
-from vumi.service import WorkerAMQClient
-from vumi.message import Message as VumiMessage
+from vumi.service import WorkerAMQClient, WorkerDelegate, BindingCache
+from vumi.message import Message as VumiMessage, codec_for_content_type
 
 
 def gen_id(prefix=''):
@@ -67,23 +66,23 @@ def mkContent(body, children=None, properties=None):
                  properties=properties)
 
 
-def mk_deliver(body, exchange, routing_key, ctag, dtag):
+def mk_deliver(body, exchange, routing_key, ctag, dtag, properties=None):
     return Message(mkMethod('deliver', 60), [
             ('consumer_tag', ctag),
             ('delivery_tag', dtag),
             ('redelivered', False),
             ('exchange', exchange),
             ('routing_key', routing_key),
-            ], mkContent(body))
+            ], mkContent(body, properties=properties))
 
 
-def mk_get_ok(body, exchange, routing_key, dtag):
+def mk_get_ok(body, exchange, routing_key, dtag, properties=None):
     return Message(mkMethod('get-ok', 71), [
             ('delivery_tag', dtag),
             ('redelivered', False),
             ('exchange', exchange),
             ('routing_key', routing_key),
-            ], mkContent(body))
+            ], mkContent(body, properties=properties))
 
 
 class FakeAMQPBroker(object):
@@ -167,6 +166,10 @@ class FakeAMQPBroker(object):
         self._get_queue(queue).ack(delivery_tag)
         return None
 
+    def basic_reject(self, queue, delivery_tag, requeue):
+        self._get_queue(queue).reject(delivery_tag, requeue)
+        return None
+
     def deliver_to_channels(self):
         # Since all delivery goes through kick_delivery(), this can
         # only happen if message_processed() is called too many times.
@@ -186,7 +189,8 @@ class FakeAMQPBroker(object):
             dtag, msg = self._get_queue(queue).get_message()
             while dtag is not None:
                 dmsg = mk_deliver(msg['content'], msg['exchange'],
-                                  msg['routing_key'], ctag, dtag)
+                                  msg['routing_key'], ctag, dtag,
+                                  msg['properties'])
                 self._delivering['count'] += 1
                 channel.deliver_message(dmsg, queue)
                 delivered = True
@@ -252,7 +256,9 @@ class FakeAMQPBroker(object):
 
     def get_messages(self, exchange, rkey):
         contents = self.get_dispatched(exchange, rkey)
-        messages = [VumiMessage.from_json(content.body)
+        messages = [VumiMessage.decode(content.body, codec_for_content_type(
+                    (getattr(content, 'properties', None) or {}).get(
+                        'content type')))
                     for content in contents]
         return messages
 
@@ -275,6 +281,7 @@ class FakeAMQPBroker(object):
 
 class FakeAMQPChannel(object):
     def __init__(self, channel_id, broker, delegate):
+        self.id = channel_id
         self.channel_id = channel_id
         self.broker = broker
         self.qos_prefetch_count = 0
@@ -282,6 +289,8 @@ class FakeAMQPChannel(object):
         self.delegate = delegate
         self.unacked = []
         self.flow_active = True
+        self.confirm_mode = False
+        self.publish_seq = 0
 
     def __repr__(self):
         return '<FakeAMQPChannel: id=%s flow=%s>' % (
@@ -329,7 +338,18 @@ class FakeAMQPChannel(object):
         return Message(mkMethod("cancel-ok", 31))
 
     def basic_publish(self, exchange, routing_key, content):
-        return self.broker.basic_publish(exchange, routing_key, content)
+        resp = self.broker.basic_publish(exchange, routing_key, content)
+        if self.confirm_mode:
+            self.publish_seq += 1
+            self.delegate.basic_ack(self, Message(mkMethod("ack", 80), [
+                        ('delivery_tag', self.publish_seq),
+                        ('multiple', False),
+                        ]))
+        return resp
+
+    def confirm_select(self, nowait=False):
+        self.confirm_mode = True
+        return Message(mkMethod("select-ok", 11))
 
     def basic_ack(self, delivery_tag, multiple):
         assert delivery_tag in [d for d, _q in self.unacked]
@@ -340,6 +360,13 @@ class FakeAMQPChannel(object):
                 if (dtag == delivery_tag):
                     return resp
 
+    def basic_reject(self, delivery_tag, requeue):
+        for dtag, queue in self.unacked[:]:
+            if dtag == delivery_tag:
+                self.unacked.remove((dtag, queue))
+                return self.broker.basic_reject(queue, dtag, requeue)
+        raise AssertionError("Unknown delivery tag %r" % (delivery_tag,))
+
     def deliverable(self):
         if not self.flow_active:
             return False
@@ -356,7 +383,7 @@ class FakeAMQPChannel(object):
         if msg:
             self.unacked.append((dtag, queue))
             return mk_get_ok(msg['content'], msg['exchange'],
-                             msg['routing_key'], dtag)
+                             msg['routing_key'], dtag, msg['properties'])
         return Message(mkMethod("get-empty", 72))
 
     def message_processed(self):
@@ -442,11 +469,17 @@ class FakeAMQPQueue(object):
                 'exchange': exchange,
                 'routing_key': routing_key,
                 'content': content.body,
+                'properties': getattr(content, 'properties', None),
                 })
 
     def ack(self, delivery_tag):
         self.unacked_messages.pop(delivery_tag)
 
+    def reject(self, delivery_tag, requeue):
+        msg = self.unacked_messages.pop(delivery_tag)
+        if requeue:
+            self.messages.insert(0, msg)
+
     def get_message(self):
         try:
             msg = self.messages.pop(0)
@@ -459,7 +492,7 @@ class FakeAMQPQueue(object):
 
 class FakeAMQClient(WorkerAMQClient):
     def __init__(self, spec, vumi_options=None, broker=None):
-        WorkerAMQClient.__init__(self, TwistedDelegate(), '', spec)
+        WorkerAMQClient.__init__(self, WorkerDelegate(), '', spec)
         if vumi_options is not None:
             self.vumi_options = vumi_options
         if broker is None:
@@ -478,3 +511,12 @@ class FakeAMQClient(WorkerAMQClient):
         finally:
             self.channelLock.release()
         returnValue(ch)
+
+    def get_binding_cache(self, exchange_name):
+        # There's no management API to ask about bindings, so every routing
+        # key is treated as bound.
+        if exchange_name not in self.binding_caches:
+            self.binding_caches[exchange_name] = BindingCache(
+                getattr(self, 'vumi_options', {}), exchange_name,
+                management_url=None)
+        return self.binding_caches[exchange_name]
@@ -0,0 +1,192 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.task import Clock
+from txamqp.content import Content
+
+from vumi.local_amqp import (LocalAMQPBroker, LocalAMQClient,
+                             LocalWorkerCreator, LocalAMQPError)
+from vumi.message import Message
+from vumi.service import Worker
+
+
+class RecordingDelegate(object):
+    def __init__(self):
+        self.delivered = []
+        self.confirms = []
+
+    def basic_deliver(self, channel, msg):
+        self.delivered.append(msg)
+
+    def basic_ack(self, channel, msg):
+        self.confirms.append(msg.delivery_tag)
+
+
+class LocalAMQPBrokerTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.broker = LocalAMQPBroker(self.clock)
+        self.client = LocalAMQClient(self.broker)
+
+    @inlineCallbacks
+    def make_channel(self, channel_id=1):
+        channel = yield self.client.channel(channel_id)
+        channel.delegate = RecordingDelegate()
+        yield channel.channel_open()
+        yield channel.exchange_declare('direct', 'direct')
+        yield channel.exchange_declare('topic', 'topic')
+        self.channel = channel
+        self.delivered = channel.delegate.delivered
+
+    @inlineCallbacks
+    def consume(self, queue, exchange, routing_key, channel=None):
+        channel = channel or self.channel
+        yield channel.queue_declare(queue)
+        yield channel.queue_bind(queue, exchange, routing_key)
+        yield channel.basic_consume(queue)
+
+    def publish(self, exchange, routing_key, body):
+        self.broker.publish(exchange, routing_key, body, {})
+        self.clock.advance(0)
+
+    def bodies(self):
+        return [msg.content.body for msg in self.delivered]
+
+    @inlineCallbacks
+    def test_direct_routing(self):
+        yield self.make_channel()
+        yield self.consume('q1', 'direct', 'foo')
+        self.publish('direct', 'foo', 'm1')
+        self.publish('direct', 'bar', 'm2')
+        self.assertEqual(self.bodies(), ['m1'])
+
+    @inlineCallbacks
+    def test_topic_routing(self):
+        yield self.make_channel()
+        yield self.consume('q1', 'topic', 'a.*.c')
+        yield self.consume('q2', 'topic', 'a.#')
+        self.publish('topic', 'a.b.c', 'm1')
+        self.publish('topic', 'a', 'm2')
+        self.publish('topic', 'a.b.b.c', 'm3')
+        self.publish('topic', 'b.a', 'm4')
+        self.assertEqual(sorted(self.bodies()), ['m1', 'm1', 'm2', 'm3'])
+
+    @inlineCallbacks
+    def test_unknown_exchange(self):
+        yield self.make_channel()
+        self.assertRaises(LocalAMQPError, self.broker.publish,
+                          'missing', 'foo', 'm1', {})
+
+    @inlineCallbacks
+    def test_prefetch_and_ack(self):
+        yield self.make_channel()
+        yield self.channel.basic_qos(0, 2, False)
+        yield self.consume('q1', 'direct', 'foo')
+        for i in range(4):
+            self.publish('direct', 'foo', 'm%d' % (i,))
+        self.assertEqual(self.bodies(), ['m0', 'm1'])
+        self.channel.basic_ack(self.delivered[0].delivery_tag, False)
+        self.clock.advance(0)
+        self.assertEqual(self.bodies(), ['m0', 'm1', 'm2'])
+        self.channel.basic_ack(self.delivered[2].delivery_tag, True)
+        self.clock.advance(0)
+        self.assertEqual(self.bodies(), ['m0', 'm1', 'm2', 'm3'])
+
+    @inlineCallbacks
+    def test_round_robin(self):
+        yield self.make_channel(1)
+        channel1 = self.channel
+        yield self.make_channel(2)
+        yield self.consume('q1', 'direct', 'foo', channel1)
+        yield self.consume('q1', 'direct', 'foo')
+        for i in range(4):
+            self.broker.publish('direct', 'foo', 'm%d' % (i,), {})
+        self.clock.advance(0)
+        self.assertEqual(len(channel1.delegate.delivered), 2)
+        self.assertEqual(len(self.delivered), 2)
+
+    @inlineCallbacks
+    def test_channel_flow(self):
+        yield self.make_channel()
+        yield self.consume('q1', 'direct', 'foo')
+        yield self.channel.channel_flow(False)
+        self.publish('direct', 'foo', 'm1')
+        self.assertEqual(self.bodies(), [])
+        yield self.channel.channel_flow(True)
+        self.clock.advance(0)
+        self.assertEqual(self.bodies(), ['m1'])
+
+    @inlineCallbacks
+    def test_close_requeues_unacked(self):
+        yield self.make_channel(1)
+        channel1 = self.channel
+        yield self.consume('q1', 'direct', 'foo')
+        self.publish('direct', 'foo', 'm1')
+        yield self.make_channel(2)
+        yield self.consume('q1', 'direct', 'foo')
+        yield channel1.channel_close()
+        self.clock.advance(0)
+        self.assertEqual(self.bodies(), ['m1'])
+        self.assertTrue(self.delivered[0].redelivered)
+
+    @inlineCallbacks
+    def test_publisher_confirms(self):
+        yield self.make_channel()
+        yield self.channel.confirm_select()
+        yield self.channel.basic_publish('direct', 'foo', Content('m1'))
+        self.assertEqual(self.channel.delegate.confirms, [1])
+
+
+class EchoWorker(Worker):
+    @inlineCallbacks
+    def startWorker(self):
+        self.pub = yield self.publish_to('test.out')
+        self.con = yield self.consume('test.in', self.pub.publish_message)
+
+
+class CollectingWorker(Worker):
+    @inlineCallbacks
+    def startWorker(self):
+        self.msgs = []
+        self.waiting = Deferred()
+        self.pub = yield self.publish_to('test.in')
+        self.con = yield self.consume('test.out', self.consume_msg)
+
+    def consume_msg(self, msg):
+        self.msgs.append(msg)
+        if len(self.msgs) == self.config['count']:
+            self.waiting.callback(self.msgs)
+
+
+class LocalWorkerCreatorTestCase(TestCase):
+    timeout = 5
+
+    def setUp(self):
+        self.creator = LocalWorkerCreator({})
+
+    @inlineCallbacks
+    def start_worker(self, worker_class, config):
+        worker = worker_class({}, config)
+        yield worker._amqp_connected(
+            LocalAMQClient(self.creator.broker, self.creator.options))
+        self.addCleanup(worker.stopWorker)
+        returnValue(worker)
+
+    @inlineCallbacks
+    def test_workers_share_broker(self):
+        yield self.start_worker(EchoWorker, {})
+        collector = yield self.start_worker(CollectingWorker, {'count': 3})
+        for i in range(3):
+            yield collector.pub.publish_message(Message(i=i))
+        msgs = yield collector.waiting
+        self.assertEqual([msg['i'] for msg in msgs], [0, 1, 2])
+
+    @inlineCallbacks
+    def test_connect(self):
+        worker = EchoWorker({}, {})
+        d = Deferred()
+        worker._amqp_connected = d.callback
+        self.creator._connect(worker, timeout=30, bindAddress=None)
+        amq_client = yield d
+        self.assertTrue(isinstance(amq_client, LocalAMQClient))
+        self.assertTrue(amq_client.broker is self.creator.broker)
@@ -1,8 +1,13 @@
+from datetime import datetime
+
 from twisted.trial.unittest import TestCase
 
 from vumi.tests.utils import RegexMatcher, UTCNearNow
-from vumi.message import (Message, TransportMessage, TransportEvent,
-                          TransportUserMessage)
+from vumi.message import (
+    Message, TransportMessage, TransportEvent, TransportUserMessage,
+    CompactTransportUserMessage, CompactTransportEvent,
+    from_json, to_json, JSONMessageCodec, MsgpackMessageCodec,
+    MessageCodecError, get_message_codec, codec_for_content_type, msgpack)
 
 
 class MessageTest(TestCase):
@@ -206,6 +211,26 @@ class MessageTest(TestCase):
         self.assertEqual(msg['transport_metadata'], {})
         self.assertEqual(msg['helper_metadata'], {})
 
+    def test_transport_user_message_copy(self):
+        msg = TransportUserMessage(
+            to_addr='123',
+            from_addr='456',
+            transport_name='sphex',
+            transport_type='sms',
+            transport_metadata={'foo': ['bar']},
+            helper_metadata={'tag': {'tag': ['pool', 'tag1']}},
+            )
+        msg_copy = msg.copy()
+        self.assertEqual(msg_copy, msg)
+        self.assertEqual(msg_copy, TransportUserMessage.from_json(
+            msg.to_json()))
+        self.assertTrue(isinstance(msg_copy, TransportUserMessage))
+        msg_copy['transport_metadata']['foo'].append('baz')
+        msg_copy['helper_metadata']['tag']['tag'] = None
+        self.assertEqual(msg['transport_metadata'], {'foo': ['bar']})
+        self.assertEqual(msg['helper_metadata'],
+                         {'tag': {'tag': ['pool', 'tag1']}})
+
     def test_transport_event_ack(self):
         msg = TransportEvent(
             event_id='def',
@@ -251,3 +276,145 @@ class MessageTest(TestCase):
         self.assertEqual('20110921', msg['message_version'])
         # self.assertEqual('sphex', msg['transport_name'])
         self.assertEqual('delivered', msg['delivery_status'])
+
+
+class MessageCodecTest(TestCase):
+
+    def mk_msg(self, **kw):
+        kw.setdefault('timestamp', datetime(2012, 10, 3, 12, 30, 0, 123))
+        return TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345',
+            transport_name='sphex', transport_type='sms',
+            content='2012-10-03 12:30:00.000123', **kw)
+
+    def test_legacy_from_json(self):
+        dt = datetime(2012, 10, 3, 12, 30, 0, 123)
+        self.assertEqual(from_json(to_json({'a': dt, 'b': {'c': dt}})),
+                         {'a': dt, 'b': {'c': dt}})
+        self.assertEqual(from_json(to_json({'a': '2012-10-03', 'b': 1})),
+                         {'a': '2012-10-03', 'b': 1})
+
+    def test_json_codec_roundtrip(self):
+        codec = JSONMessageCodec()
+        msg = self.mk_msg(transport_metadata={
+            'deliver_at': datetime(2012, 10, 3, 13, 0, 0, 0)})
+        self.assertEqual(msg.encode(codec), msg.to_json())
+        decoded = TransportUserMessage.decode(msg.encode(codec), codec)
+        self.assertEqual(decoded['timestamp'], msg['timestamp'])
+        self.assertEqual(decoded['transport_metadata'],
+                         msg['transport_metadata'])
+        self.assertEqual(decoded['content'],
+                         datetime(2012, 10, 3, 12, 30, 0, 123))
+
+    def test_json_codec_known_date_fields_only(self):
+        codec = JSONMessageCodec(decode_all_dates=False)
+        msg = self.mk_msg(transport_metadata={
+            'deliver_at': datetime(2012, 10, 3, 13, 0, 0, 0)})
+        decoded = TransportUserMessage.decode(msg.encode(codec), codec)
+        self.assertEqual(decoded['timestamp'], msg['timestamp'])
+        self.assertEqual(decoded['content'], '2012-10-03 12:30:00.000123')
+        self.assertEqual(decoded['transport_metadata'],
+                         {'deliver_at': '2012-10-03 13:00:00.000000'})
+
+    def test_msgpack_codec_roundtrip(self):
+        codec = MsgpackMessageCodec(decode_all_dates=False)
+        msg = self.mk_msg()
+        decoded = TransportUserMessage.decode(msg.encode(codec), codec)
+        self.assertEqual(decoded['timestamp'], msg['timestamp'])
+        self.assertEqual(decoded['content'], msg['content'])
+        self.assertEqual(decoded['message_id'], msg['message_id'])
+
+    if msgpack is None:
+        test_msgpack_codec_roundtrip.skip = "msgpack not installed."
+
+    def test_get_message_codec(self):
+        self.assertTrue(get_message_codec(None).decode_all_dates)
+        codec = get_message_codec('fast_json')
+        self.assertEqual(codec.content_type, 'application/json')
+        self.assertFalse(codec.decode_all_dates)
+        self.assertRaises(MessageCodecError, get_message_codec, 'unknown')
+
+    def test_codec_for_content_type(self):
+        preferred = JSONMessageCodec(decode_all_dates=False)
+        self.assertEqual(codec_for_content_type(None, preferred), preferred)
+        self.assertEqual(
+            codec_for_content_type('application/json', preferred), preferred)
+        self.assertEqual(
+            codec_for_content_type(None).content_type, 'application/json')
+        self.assertEqual(
+            codec_for_content_type('text/plain', preferred), preferred)
+
+    def test_codec_for_unknown_content_type_falls_back_to_json(self):
+        preferred = MsgpackMessageCodec(decode_all_dates=False)
+        for content_type in (None, 'text/plain'):
+            codec = codec_for_content_type(content_type, preferred)
+            self.assertEqual(codec.content_type, 'application/json')
+            self.assertFalse(codec.decode_all_dates)
+
+    if msgpack is None:
+        test_codec_for_unknown_content_type_falls_back_to_json.skip = (
+            "msgpack not installed.")
+
+
+class CompactMessageTest(TestCase):
+
+    def mk_msg(self, msg_class=CompactTransportUserMessage, **kw):
+        return msg_class(
+            to_addr='+27831234567', from_addr='12345',
+            transport_name='sphex', transport_type='sms',
+            content='heya', transport_metadata={'foo': 'bar'}, **kw)
+
+    def test_fields(self):
+        msg = self.mk_msg(extra='value')
+        self.assertEqual(msg['to_addr'], '+27831234567')
+        self.assertEqual(msg['content'], 'heya')
+        self.assertEqual(msg['extra'], 'value')
+        self.assertEqual(msg['message_type'], 'user_message')
+        self.assertEqual(UTCNearNow(), msg['timestamp'])
+        self.assertRaises(KeyError, lambda: msg['missing'])
+        self.assertEqual(msg.get('missing', 'default'), 'default')
+        self.assertTrue('extra' in msg)
+        self.assertFalse('missing' in msg)
+
+    def test_payload_view(self):
+        msg = self.mk_msg()
+        msg.payload['extra'] = 'value'
+        msg.payload['content'] = 'changed'
+        self.assertEqual(msg['extra'], 'value')
+        self.assertEqual(msg['content'], 'changed')
+        self.assertEqual(msg.payload.setdefault('content', 'nope'), 'changed')
+        del msg.payload['extra']
+        self.assertFalse('extra' in msg)
+        self.assertEqual(sorted(msg.payload.keys()),
+                         sorted(self.mk_msg(TransportUserMessage).payload))
+
+    def test_compatible_with_plain_message(self):
+        msg = self.mk_msg()
+        plain = TransportUserMessage.from_json(msg.to_json())
+        self.assertEqual(msg, plain)
+        self.assertEqual(plain, msg)
+        self.assertEqual(from_json(msg.encode()), from_json(plain.encode()))
+        self.assertEqual(CompactTransportUserMessage.from_message(plain), msg)
+        self.assertEqual(
+            CompactTransportUserMessage.from_json(plain.to_json()), plain)
+        self.assertTrue(isinstance(msg, TransportUserMessage))
+
+    def test_copy(self):
+        msg = self.mk_msg()
+        msg_copy = msg.copy()
+        self.assertEqual(msg_copy, msg)
+        self.assertTrue(isinstance(msg_copy, CompactTransportUserMessage))
+        msg_copy['transport_metadata']['foo'] = 'baz'
+        self.assertEqual(msg['transport_metadata'], {'foo': 'bar'})
+
+    def test_event(self):
+        event = CompactTransportEvent(
+            event_type='ack', user_message_id='abc', sent_message_id='def')
+        self.assertEqual(event['event_type'], 'ack')
+        self.assertEqual(event, TransportEvent.from_json(event.to_json()))
+
+    def test_payload_serializable(self):
+        msg = self.mk_msg()
+        self.assertEqual(
+            from_json(to_json({'message': msg.payload})),
+            {'message': from_json(msg.to_json())})
@@ -1,9 +1,23 @@
+import json
+
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import (inlineCallbacks, returnValue, Deferred,
+                                    succeed, fail)
+from twisted.internet import reactor
+from twisted.internet.task import Clock, deferLater
+from twisted.internet.error import ConnectionLost, ConnectionRefusedError
+from twisted.python.failure import Failure
 
-from vumi.service import Worker, WorkerCreator
+from vumi import service
+from vumi.service import (Worker, WorkerCreator, Publisher, Consumer,
+                          WorkerAMQClient,
+                          BatchingPublisher, PublishNackedError,
+                          PublisherStoppedError,
+                          RoutingKeyError, BindingCache)
 from vumi.tests.utils import (fake_amq_message, get_stubbed_worker)
-from vumi.message import Message
+from vumi.utils import HttpTimeoutError
+from vumi.message import (Message, MsgpackMessageCodec, msgpack,
+                          TransportUserMessage, CompactTransportUserMessage)
 
 
 class ServiceTestCase(TestCase):
@@ -44,7 +58,567 @@ class ServiceTestCase(TestCase):
             'vumi', 'test.routing.key')
 
         self.assertEquals(published_msg.body, '{"key": "value"}')
-        self.assertEquals(published_msg.properties, {'delivery mode': 2})
+        self.assertEquals(published_msg.properties, {
+            'delivery mode': 2, 'content type': 'application/json'})
+
+    @inlineCallbacks
+    def test_publish_with_codec(self):
+        worker = get_stubbed_worker(Worker)
+        codec = MsgpackMessageCodec()
+        publisher = yield worker.publish_to('test.routing.key',
+                                            message_codec=codec)
+        publisher.publish_message(Message(key="value"))
+        [published_msg] = publisher.channel.broker.get_dispatched(
+            'vumi', 'test.routing.key')
+        self.assertEquals(published_msg.body, codec.encode({"key": "value"}))
+        self.assertEquals(published_msg.properties, {
+            'delivery mode': 2, 'content type': 'application/x-msgpack'})
+
+    @inlineCallbacks
+    def test_publish_with_configured_codec(self):
+        worker = get_stubbed_worker(Worker, {'message_codec': 'fast_json'})
+        publisher = yield worker.publish_to('test.routing.key')
+        self.assertEqual(publisher.message_codec.decode_all_dates, False)
+
+    @inlineCallbacks
+    def test_consume_negotiates_codec(self):
+        worker = get_stubbed_worker(Worker)
+        log = []
+        yield worker.consume('test.routing.key', log.append)
+        publisher = yield worker.publish_to(
+            'test.routing.key', message_codec=MsgpackMessageCodec())
+        yield publisher.publish_message(Message(key="value"))
+        yield worker._amqp_client.broker.kick_delivery()
+        self.assertEquals(log, [Message(key="value")])
+
+    @inlineCallbacks
+    def test_consume_compact_messages(self):
+        worker = get_stubbed_worker(Worker, {'compact_messages': True})
+        log = []
+        yield worker.consume('test.routing.key', log.append,
+                             message_class=TransportUserMessage)
+        msg = TransportUserMessage(
+            to_addr='+1234', from_addr='+5678', transport_name='sphex',
+            transport_type='sms', content='hello')
+        worker._amqp_client.broker.publish_message(
+            'vumi', 'test.routing.key', msg)
+        yield worker._amqp_client.broker.kick_delivery()
+        [consumed] = log
+        self.assertTrue(isinstance(consumed, CompactTransportUserMessage))
+        self.assertEqual(consumed, msg)
+
+    @inlineCallbacks
+    def test_consume_ordinary_messages_by_default(self):
+        worker = get_stubbed_worker(Worker)
+        consumer = yield worker.consume('test.routing.key', lambda msg: None,
+                                        message_class=TransportUserMessage)
+        self.assertEqual(consumer.message_class, TransportUserMessage)
+
+    if msgpack is None:
+        test_publish_with_codec.skip = "msgpack not installed."
+        test_consume_negotiates_codec.skip = "msgpack not installed."
+
+
+class BatchedAckTestCase(TestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(Consumer, 'clock', self.clock)
+        self.worker = get_stubbed_worker(Worker, {
+            'amqp_ack_batch_size': 3, 'amqp_ack_batch_interval': 1})
+        self.broker = self.worker._amqp_client.broker
+        self.results = {}
+        self.consumer = yield self.worker.consume(
+            'test.routing.key', self.consume_message)
+        self.channel = self.consumer.channel
+        self.acks = []
+        self.delivery_tags = []
+        orig_basic_ack = self.channel.basic_ack
+        orig_deliver_message = self.channel.deliver_message
+
+        def basic_ack(delivery_tag, multiple):
+            self.acks.append((self.tag_index(delivery_tag), multiple))
+            return orig_basic_ack(delivery_tag, multiple)
+
+        def deliver_message(msg, queue):
+            self.delivery_tags.append(msg.delivery_tag)
+            return orig_deliver_message(msg, queue)
+
+        self.channel.basic_ack = basic_ack
+        self.channel.deliver_message = deliver_message
+
+    def consume_message(self, msg):
+        return self.results.get(msg['i'])
+
+    def tag_index(self, delivery_tag):
+        return self.delivery_tags.index(delivery_tag)
+
+    @inlineCallbacks
+    def publish(self, *indexes):
+        for i in indexes:
+            self.broker.publish_message(
+                'vumi', 'test.routing.key', Message(i=i))
+        yield self.broker.kick_delivery()
+
+    @inlineCallbacks
+    def test_ack_batch_size(self):
+        yield self.publish(0, 1, 2, 3)
+        self.assertEqual(self.acks, [(2, True)])
+        self.assertEqual(len(self.channel.unacked), 1)
+        self.clock.advance(1)
+        self.assertEqual(self.acks, [(2, True), (3, True)])
+        self.assertEqual(self.channel.unacked, [])
+
+    @inlineCallbacks
+    def test_ack_batch_interval(self):
+        yield self.publish(0)
+        self.assertEqual(self.acks, [])
+        self.clock.advance(1)
+        self.assertEqual(self.acks, [(0, True)])
+
+    @inlineCallbacks
+    def test_unacknowledged_message_does_not_break_run(self):
+        self.results[1] = False
+        yield self.publish(0, 1, 2, 3)
+        self.assertEqual(self.acks, [(3, True)])
+        self.assertEqual(self.channel.unacked, [])
+        self.assertEqual(self.consumer._ack_ready, {})
+        yield self.publish(4, 5, 6)
+        self.assertEqual(self.acks, [(3, True), (6, True)])
+        self.assertEqual(list(self.consumer._delivery_tags), [])
+
+    @inlineCallbacks
+    def test_failed_message_does_not_break_run(self):
+        self.consumer.concurrency = 2
+        self.consumer.discard_failed = True
+        self.results[1] = fail(ValueError("Bad message"))
+        yield self.publish(0, 1, 2, 3)
+        self.flushLoggedErrors(ValueError)
+        self.assertEqual(self.acks, [(3, True)])
+        self.assertEqual(self.channel.unacked, [])
+        self.assertEqual(self.consumer._ack_ready, {})
+
+    @inlineCallbacks
+    def test_stop_flushes_acks(self):
+        yield self.publish(0)
+        yield self.consumer.stop()
+        self.assertEqual(self.acks, [(0, True)])
+
+
+class ConcurrentConsumerTestCase(TestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.worker = get_stubbed_worker(Worker)
+        self.broker = self.worker._amqp_client.broker
+        self.pending = {}
+        # The number of times to fail each message.
+        self.failures = {}
+        self.consumer = yield self.worker.consume(
+            'test.routing.key', self.consume_message, concurrency=2)
+        self.channel = self.consumer.channel
+
+    def consume_message(self, msg):
+        if self.failures.get(msg['i']):
+            self.failures[msg['i']] -= 1
+            raise ValueError("Bad message")
+        d = self.pending[msg['i']] = Deferred()
+        return d
+
+    def publish(self, *indexes):
+        for i in indexes:
+            self.broker.publish_message(
+                'vumi', 'test.routing.key', Message(i=i))
+        return self.broker.kick_delivery()
+
+    @inlineCallbacks
+    def test_failed_message_is_requeued(self):
+        self.failures['fail'] = 1
+        yield self.publish('fail')
+        [error] = self.flushLoggedErrors(ValueError)
+        # The requeued message is consumed again on the next delivery run.
+        d = self.broker.kick_delivery()
+        yield deferLater(reactor, 0, lambda: None)
+        self.assertEqual(self.pending.keys(), ['fail'])
+        self.assertEqual(len(self.channel.unacked), 1)
+        self.pending['fail'].callback(None)
+        yield d
+        self.assertEqual(self.channel.unacked, [])
+        self.assertEqual(
+            self.broker.queues['test.routing.key'].unacked_messages, {})
+
+    @inlineCallbacks
+    def test_failed_message_is_discarded(self):
+        self.consumer.discard_failed = True
+        self.failures['fail'] = 1
+        yield self.publish('fail')
+        [error] = self.flushLoggedErrors(ValueError)
+        self.assertEqual(self.channel.unacked, [])
+        self.assertEqual(
+            self.broker.queues['test.routing.key'].unacked_messages, {})
+        # The failure doesn't use up a concurrency slot.
+        d = self.publish(0, 1)
+        yield deferLater(reactor, 0, lambda: None)
+        self.assertEqual(sorted(self.pending), [0, 1])
+        self.pending[0].callback(None)
+        self.pending[1].callback(None)
+        yield d
+
+    @inlineCallbacks
+    def test_stop_waits_for_in_flight_messages(self):
+        self.publish(0)
+        yield deferLater(reactor, 0, lambda: None)
+        self.assertEqual(len(self.channel.unacked), 1)
+        stopped = self.consumer.stop()
+        self.assertNoResult(stopped)
+        self.pending[0].callback(None)
+        yield stopped
+        self.assertEqual(self.channel.unacked, [])
+
+
+class ChannelPoolTestCase(TestCase):
+
+    def setUp(self):
+        self.worker = get_stubbed_worker(Worker)
+        self.client = self.worker._amqp_client
+
+    def tearDown(self):
+        return self.client.broker.wait_delivery()
+
+    @inlineCallbacks
+    def test_publishers_share_channel_per_exchange(self):
+        pub1 = yield self.worker.publish_to('foo')
+        pub2 = yield self.worker.publish_to('bar')
+        pub3 = yield self.worker.publish_to('baz', exchange_name='other')
+        self.assertTrue(pub1.channel is pub2.channel)
+        self.assertFalse(pub1.channel is pub3.channel)
+        self.assertEqual(len(self.client.channels), 2)
+
+    @inlineCallbacks
+    def test_publisher_channel_limit(self):
+        self.client.max_publisher_channels = 2
+        pub1 = yield self.worker.publish_to('foo', exchange_name='ex1')
+        yield self.worker.publish_to('bar', exchange_name='ex1')
+        pub3 = yield self.worker.publish_to('foo', exchange_name='ex2')
+        pub4 = yield self.worker.publish_to('foo', exchange_name='ex3')
+        self.assertEqual(len(self.client.channels), 2)
+        self.assertFalse(pub1.channel is pub3.channel)
+        self.assertTrue(pub4.channel is pub3.channel)
+
+    @inlineCallbacks
+    def test_unshared_publisher_channels(self):
+        self.worker.config['amqp_share_publisher_channels'] = False
+        pub1 = yield self.worker.publish_to('foo')
+        pub2 = yield self.worker.publish_to('bar')
+        self.assertFalse(pub1.channel is pub2.channel)
+
+    @inlineCallbacks
+    def test_confirming_publishers_do_not_share(self):
+        self.worker.config['amqp_publisher_confirms'] = True
+        pub1 = yield self.worker.publish_to('foo')
+        pub2 = yield self.worker.publish_to('bar')
+        self.assertFalse(pub1.channel is pub2.channel)
+
+    @inlineCallbacks
+    def test_released_channel_ids_are_reused(self):
+        consumer1 = yield self.worker.consume('foo', lambda msg: None)
+        consumer2 = yield self.worker.consume('bar', lambda msg: None)
+        channel_id = consumer1.channel.id
+        yield consumer1.stop()
+        self.assertFalse(channel_id in self.client.channels)
+        consumer3 = yield self.worker.consume('baz', lambda msg: None)
+        self.assertEqual(consumer3.channel.id, channel_id)
+        self.assertEqual(self.client.get_new_channel_id(),
+                         consumer2.channel.id + 1)
+
+
+class BatchingPublisherTestCase(TestCase):
+
+    def tearDown(self):
+        return self.broker.wait_delivery()
+
+    @inlineCallbacks
+    def get_publisher(self, **config):
+        self.clock = Clock()
+        self.patch(BatchingPublisher, 'clock', self.clock)
+        self.worker = get_stubbed_worker(Worker, config)
+        self.broker = self.worker._amqp_client.broker
+        publisher = yield self.worker.publish_to('test.routing.key')
+        self.assertTrue(isinstance(publisher, BatchingPublisher))
+        publisher.require_bind = False
+        returnValue(publisher)
+
+    def dispatched(self):
+        return self.broker.get_messages('vumi', 'test.routing.key')
+
+    def test_plain_publisher_by_default(self):
+        self.worker = get_stubbed_worker(Worker)
+        self.broker = self.worker._amqp_client.broker
+        self.assertEqual(self.worker.get_publisher_options(),
+                         (Publisher, {'share_channel': True}))
+
+    @inlineCallbacks
+    def test_publish_batch_on_interval(self):
+        publisher = yield self.get_publisher(amqp_publish_batch_size=10,
+                                             amqp_publish_batch_interval=0.5)
+        results = []
+        for i in range(3):
+            d = publisher.publish_message(Message(i=i))
+            d.addCallback(results.append)
+        self.assertEqual(self.dispatched(), [])
+        self.clock.advance(0.5)
+        self.assertEqual(self.dispatched(), [Message(i=i) for i in range(3)])
+        self.assertEqual(results, [Message(i=i) for i in range(3)])
+        stats = publisher.get_stats()
+        self.assertEqual(stats['published'], 3)
+        self.assertEqual(stats['batches'], 1)
+        self.assertEqual(stats['avg_latency'], 0.5)
+        self.assertEqual(stats['throughput'], 6.0)
+
+    @inlineCallbacks
+    def test_publish_batch_when_full(self):
+        publisher = yield self.get_publisher(amqp_publish_batch_size=2)
+        publisher.publish_message(Message(i=0))
+        self.assertEqual(self.dispatched(), [])
+        publisher.publish_message(Message(i=1))
+        self.assertEqual(self.dispatched(), [Message(i=0), Message(i=1)])
+        publisher.publish_message(Message(i=2))
+        self.clock.advance(publisher.batch_interval)
+        self.assertEqual(len(self.dispatched()), 3)
+        self.assertEqual(publisher.get_stats()['batches'], 2)
+
+    @inlineCallbacks
+    def test_publish_routing_key_error(self):
+        publisher = yield self.get_publisher(amqp_publish_batch_size=2)
+        d1 = publisher.publish_message(Message(i=0), routing_key='Bad')
+        d2 = publisher.publish_message(Message(i=1))
+        yield self.assertFailure(d1, RoutingKeyError)
+        yield d2
+        self.assertEqual(self.dispatched(), [Message(i=1)])
+
+    @inlineCallbacks
+    def test_publisher_confirms(self):
+        publisher = yield self.get_publisher(amqp_publisher_confirms=True,
+                                             amqp_publish_batch_size=2)
+        self.assertTrue(publisher.channel.confirm_mode)
+        results = []
+        publisher.publish_message(Message(i=0)).addCallback(results.append)
+        publisher.publish_message(Message(i=1)).addCallback(results.append)
+        self.assertEqual(results, [Message(i=0), Message(i=1)])
+        stats = publisher.get_stats()
+        self.assertEqual(stats['confirmed'], 2)
+        self.assertEqual(stats['unconfirmed'], 0)
+
+    @inlineCallbacks
+    def test_publisher_nacks(self):
+        publisher = yield self.get_publisher(amqp_publisher_confirms=True)
+        publisher.channel.confirm_mode = False
+        d1 = publisher.publish_message(Message(i=0))
+        d2 = publisher.publish_message(Message(i=1))
+        d3 = publisher.publish_message(Message(i=2))
+        self.clock.advance(publisher.batch_interval)
+        self.assertEqual(publisher.get_stats()['unconfirmed'], 3)
+        publisher.handle_confirm(2, True, False)
+        publisher.handle_confirm(3, False, True)
+        yield self.assertFailure(d1, PublishNackedError)
+        yield self.assertFailure(d2, PublishNackedError)
+        yield d3
+        stats = publisher.get_stats()
+        self.assertEqual((stats['confirmed'], stats['nacked']), (1, 2))
+
+    @inlineCallbacks
+    def test_default_batch_interval_does_not_delay(self):
+        publisher = yield self.get_publisher(amqp_publish_batch_size=10)
+        publisher.publish_message(Message(i=0))
+        publisher.publish_message(Message(i=1))
+        self.assertEqual(self.dispatched(), [])
+        self.clock.advance(0)
+        self.assertEqual(self.dispatched(), [Message(i=0), Message(i=1)])
+        self.assertEqual(publisher.get_stats()['batches'], 1)
+
+    @inlineCallbacks
+    def test_stop_worker_publishes_pending(self):
+        publisher = yield self.get_publisher(amqp_publish_batch_size=10,
+                                             amqp_publish_batch_interval=10)
+        d = publisher.publish_message(Message(i=0))
+        self.worker.startService()
+        yield self.worker.stopService()
+        self.assertEqual(self.dispatched(), [Message(i=0)])
+        self.assertEqual((yield d), Message(i=0))
+        self.assertEqual(self.worker._amqp_client.publishers, [])
+        self.assertEqual(publisher._flush_call, None)
+
+    @inlineCallbacks
+    def test_connection_lost_fails_pending(self):
+        publisher = yield self.get_publisher(amqp_publisher_confirms=True,
+                                             amqp_publish_batch_size=10,
+                                             amqp_publish_batch_interval=10)
+        publisher.channel.confirm_mode = False
+        d1 = publisher.publish_message(Message(i=0))
+        publisher.flush()
+        d2 = publisher.publish_message(Message(i=1))
+        publisher.connection_lost(Failure(ConnectionLost()))
+        yield self.assertFailure(d1, PublisherStoppedError)
+        yield self.assertFailure(d2, PublisherStoppedError)
+        self.assertEqual(publisher.get_stats()['unconfirmed'], 0)
+        self.clock.advance(10)
+        self.assertEqual(self.dispatched(), [Message(i=0)])
+
+
+class BindingCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.requests = []
+        self.cache = BindingCache({}, 'vumi')
+        self.cache.clock = self.clock
+        self.cache.list_bindings = self.list_bindings
+
+    def list_bindings(self):
+        d = Deferred()
+        self.requests.append(d)
+        return d
+
+    def respond(self, bindings):
+        self.requests.pop(0).callback(bindings)
+
+    def test_load(self):
+        d = self.cache.load()
+        self.assertFalse(self.cache.is_loaded())
+        self.cache.load()
+        self.assertEqual(len(self.requests), 1)
+        self.respond({'foo': ['foo_queue']})
+        self.assertTrue(self.cache.is_loaded())
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(self.successResultOf(self.cache.load()), None)
+        self.assertEqual(len(self.requests), 0)
+
+    def test_is_bound(self):
+        self.cache.load()
+        self.respond({'foo': ['foo_queue']})
+        self.assertTrue(self.cache.is_bound('foo'))
+        self.assertEqual(self.requests, [])
+        self.assertEqual(self.cache.get_stats()['hits'], 1)
+
+    def test_unknown_key_refreshes_in_background(self):
+        self.cache.load()
+        self.respond({'foo': ['foo_queue']})
+        self.assertTrue(self.cache.is_bound('bar'))
+        self.assertTrue(self.cache.is_bound('baz'))
+        self.assertEqual(len(self.requests), 1)
+        self.respond({'foo': ['foo_queue'], 'bar': ['bar_queue']})
+        # baz was looked up during the refresh, so it hasn't been checked.
+        self.assertTrue(self.cache.is_bound('bar'))
+        self.assertTrue(self.cache.is_bound('baz'))
+        self.respond({'foo': ['foo_queue'], 'bar': ['bar_queue']})
+        self.assertFalse(self.cache.is_bound('baz'))
+        self.assertEqual(self.requests, [])
+        self.assertEqual(self.cache.get_stats(), {
+            'hits': 2, 'misses': 3, 'refreshes': 3, 'bound': 2,
+            'unbound': 1})
+
+    def test_unbound_key_becomes_bound(self):
+        self.cache.load()
+        self.respond({})
+        self.cache.is_bound('foo')
+        self.respond({})
+        self.assertFalse(self.cache.is_bound('foo'))
+        self.clock.advance(self.cache.ttl + 1)
+        # Stale entries are used while refreshing.
+        self.assertFalse(self.cache.is_bound('foo'))
+        self.respond({'foo': ['foo_queue']})
+        self.assertTrue(self.cache.is_bound('foo'))
+
+    def test_management_api_unavailable(self):
+        self.cache.load()
+        self.respond(None)
+        self.assertTrue(self.cache.is_bound('foo'))
+        self.assertEqual(self.requests, [])
+
+    @inlineCallbacks
+    def test_publisher_uses_shared_cache(self):
+        worker = get_stubbed_worker(Worker)
+        publisher1 = yield worker.publish_to('foo')
+        publisher2 = yield worker.publish_to('bar')
+        self.assertTrue(publisher1.binding_cache is publisher2.binding_cache)
+        cache = publisher1.binding_cache
+        self.assertTrue(cache.is_loaded())
+        cache.bound_routing_keys = {'foo': ['foo_queue']}
+        cache.unbound_routing_keys = set(['bar'])
+        publisher1.check_routing_key('foo', True)
+        self.assertRaises(RoutingKeyError,
+                          publisher2.check_routing_key, 'bar', True)
+
+
+class DummyResponse(object):
+    def __init__(self, code, delivered_body):
+        self.code = code
+        self.delivered_body = delivered_body
+
+
+class BindingCacheListBindingsTestCase(TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.responses = []
+        self.patch(service, 'http_request_full', self.http_request_full)
+
+    def http_request_full(self, url, data, **kw):
+        self.requests.append((url, kw))
+        return self.responses.pop(0)
+
+    def mk_cache(self, management_url='http://mgmt/api/bindings'):
+        return BindingCache({'vhost': '/', 'username': 'user',
+                             'password': 'pass'}, 'vumi',
+                            management_url=management_url, timeout=2)
+
+    def test_no_management_url(self):
+        cache = self.mk_cache(management_url=None)
+        self.assertEqual(self.successResultOf(cache.list_bindings()), None)
+        self.assertEqual(self.requests, [])
+
+    def test_list_bindings(self):
+        self.responses.append(succeed(DummyResponse(200, json.dumps([
+            {'vhost': '/', 'source': 'vumi', 'routing_key': 'foo',
+             'destination': 'foo_queue'},
+            {'vhost': '/', 'source': 'other', 'routing_key': 'bar',
+             'destination': 'bar_queue'},
+        ]))))
+        cache = self.mk_cache()
+        self.assertEqual(self.successResultOf(cache.list_bindings()),
+                         {'foo': ['foo_queue']})
+        [(url, kw)] = self.requests
+        self.assertEqual(url, 'http://mgmt/api/bindings')
+        self.assertEqual(kw['method'], 'GET')
+        self.assertEqual(kw['timeout'], 2)
+
+    def test_management_api_errors(self):
+        self.responses.extend([
+            fail(ConnectionRefusedError()),
+            fail(HttpTimeoutError("Timeout while connecting")),
+            succeed(DummyResponse(401, 'Not authorized')),
+            succeed(DummyResponse(200, 'not json')),
+        ])
+        cache = self.mk_cache()
+        for i in range(4):
+            self.assertEqual(
+                self.successResultOf(cache.list_bindings()), None)
+
+    def test_unexpected_errors_are_not_hidden(self):
+        self.responses.append(fail(ZeroDivisionError()))
+        cache = self.mk_cache()
+        self.failureResultOf(cache.list_bindings()).trap(ZeroDivisionError)
+
+    def test_client_binding_cache_options(self):
+        client = get_stubbed_worker(Worker)._amqp_client
+        cache = WorkerAMQClient.get_binding_cache(client, 'foo')
+        self.assertEqual(cache.management_url, None)
+        client.management_url = 'http://mgmt/api/bindings'
+        client.management_timeout = 3
+        cache = WorkerAMQClient.get_binding_cache(client, 'bar')
+        self.assertEqual(cache.management_url, 'http://mgmt/api/bindings')
+        self.assertEqual(cache.timeout, 3)
 
 
 class LoadableTestWorker(Worker):
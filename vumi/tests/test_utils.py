@@ -2,7 +2,8 @@ import os.path
 
 from twisted.trial.unittest import TestCase
 from twisted.internet import reactor
-from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.defer import Deferred, inlineCallbacks, succeed
+from twisted.internet.task import Clock
 from twisted.web.server import Site, NOT_DONE_YET
 from twisted.web.resource import Resource
 from twisted.web import http
@@ -11,7 +12,8 @@ from twisted.internet.protocol import Protocol, Factory
 
 from vumi.utils import (normalize_msisdn, vumi_resource_path, cleanup_msisdn,
                         get_operator_name, http_request, http_request_full,
-                        get_first_word, redis_from_config)
+                        get_first_word, redis_from_config,
+                        HttpConnectionPool, HttpTimeoutError)
 from vumi.persist.fake_redis import FakeRedis
 from vumi.tests.utils import import_skip
 
@@ -285,3 +287,152 @@ class HttpUtilsTestCase(TestCase):
             self.assertTrue(reason.check('vumi.utils.HttpTimeoutError'))
         client_done.addBoth(check_client_response)
         yield client_done
+
+    @inlineCallbacks
+    def test_http_request_full_pooled(self):
+        self.set_render(lambda r: "Yay")
+        pool = HttpConnectionPool()
+        self.addCleanup(pool.closeCachedConnections)
+
+        for _ in range(3):
+            request = yield http_request_full(self.url, '', pool=pool)
+            self.assertEqual(request.delivered_body, "Yay")
+            self.assertEqual(request.code, http.OK)
+
+        self.assertEqual(pool.get_stats(), {
+            'requested': 3,
+            'created': 1,
+            'reused': 2,
+            'reuse_rate': 2.0 / 3,
+        })
+
+    @inlineCallbacks
+    def test_http_request_full_pooled_metrics(self):
+        self.set_render(lambda r: "Yay")
+        pool = HttpConnectionPool(metrics_prefix="vumi.test.")
+        self.addCleanup(pool.closeCachedConnections)
+        metric_manager = yield pool.start_metrics(FakeWorker())
+
+        for _ in range(3):
+            yield http_request_full(self.url, '', pool=pool)
+
+        metric = metric_manager['http_pool.reuse_rate']
+        self.assertEqual(metric.name, "vumi.test.http_pool.reuse_rate")
+        self.assertEqual([value for _, value in metric.poll()],
+                         [0.0, 1.0, 1.0])
+
+    @inlineCallbacks
+    def test_http_request_full_pooled_timeout_while_queued(self):
+        def interrupt(r):
+            raise self.InterruptHttp
+        request_started = Deferred()
+        self.set_render(interrupt, request_started)
+        pool = HttpConnectionPool(max_connections_per_host=1)
+        self.addCleanup(pool.closeCachedConnections)
+
+        first_done = http_request_full(self.url, '', pool=pool)
+        request = yield request_started
+        # The second request never gets a connection.
+        second_done = http_request_full(self.url, '', timeout=0.1, pool=pool)
+
+        def check_response(reason):
+            self.assertTrue(reason.check('vumi.utils.HttpTimeoutError'))
+        second_done.addBoth(check_response)
+        yield second_done
+        self.assertEqual(pool.connections_requested, 1)
+
+        request.write("Done")
+        request.finish()
+        yield first_done
+
+
+class FakeAgent(object):
+    def __init__(self, requests):
+        self.requests = requests
+
+    def request(self, method, url, headers, body_producer):
+        d = Deferred()
+        self.requests.append((method, url, d))
+        return d
+
+
+class FakeWorker(object):
+    def start_publisher(self, publisher_class, *args, **kw):
+        return succeed(publisher_class(*args, **kw))
+
+
+class HttpConnectionPoolTestCase(TestCase):
+
+    def test_from_config(self):
+        pool = HttpConnectionPool.from_config({
+            'max_connections_per_host': 3,
+            'max_persistent_per_host': 4,
+            'idle_timeout': 5,
+            'metrics_prefix': 'vumi.test.',
+        })
+        self.assertEqual(pool.max_connections_per_host, 3)
+        self.assertEqual(pool.maxPersistentPerHost, 4)
+        self.assertEqual(pool.cachedConnectionTimeout, 5)
+        self.assertEqual(pool.metrics_prefix, 'vumi.test.')
+
+    def test_from_config_defaults(self):
+        pool = HttpConnectionPool.from_config({})
+        self.assertEqual(pool.max_connections_per_host,
+                         HttpConnectionPool.DEFAULT_MAX_CONNECTIONS_PER_HOST)
+        self.assertEqual(pool.maxPersistentPerHost,
+                         HttpConnectionPool.DEFAULT_MAX_PERSISTENT_PER_HOST)
+        self.assertEqual(pool.cachedConnectionTimeout,
+                         HttpConnectionPool.DEFAULT_IDLE_TIMEOUT)
+
+    def test_from_config_none(self):
+        self.assertEqual(HttpConnectionPool.from_config(None), None)
+
+    def test_reuse_rate_no_requests(self):
+        self.assertEqual(HttpConnectionPool().reuse_rate(), None)
+
+    def test_start_metrics_without_prefix(self):
+        pool = HttpConnectionPool()
+        self.assertEqual(
+            self.successResultOf(pool.start_metrics(FakeWorker())), None)
+        self.assertEqual(pool.metric_manager, None)
+
+    def test_request_timeout_uses_pool_reactor(self):
+        clock = Clock()
+        pool = HttpConnectionPool(max_connections_per_host=1, reactor=clock)
+        requests = []
+        pool.agent = FakeAgent(requests)
+        url = "http://a.example.com/"
+        busy = Deferred()
+        pool.run_request(url, lambda: busy)
+
+        d1 = pool.request(url, '', {}, 'GET', 5, None)
+        d2 = pool.request(url, '', {}, 'GET', 1, None)
+        clock.advance(1)
+        self.failureResultOf(d2).trap(HttpTimeoutError)
+        self.assertEqual(requests, [])
+
+        # The first request gets what's left of its timeout once it's sent.
+        clock.advance(1)
+        busy.callback(None)
+        self.assertEqual(len(requests), 1)
+        clock.advance(2.9)
+        self.assertNoResult(d1)
+        clock.advance(0.1)
+        self.failureResultOf(d1).trap(HttpTimeoutError)
+
+    def test_run_request_limits_per_host(self):
+        pool = HttpConnectionPool(max_connections_per_host=1)
+        requests = []
+
+        def request(name):
+            d = Deferred()
+            requests.append((name, d))
+            return d
+
+        pool.run_request("http://a.example.com/foo", request, "a1")
+        pool.run_request("http://a.example.com/bar", request, "a2")
+        pool.run_request("http://b.example.com/", request, "b1")
+        self.assertEqual([name for name, _ in requests], ["a1", "b1"])
+
+        requests[0][1].callback(None)
+        self.assertEqual([name for name, _ in requests], ["a1", "b1", "a2"])
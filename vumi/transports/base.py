@@ -28,6 +28,11 @@ class TransportConfig(Config):
     amqp_prefetch_count = ConfigInt(
         "The number of messages processed concurrently from each AMQP queue.",
         static=True)
+    amqp_consumer_concurrency = ConfigInt(
+        "The maximum number of outbound messages handled at the same time."
+        " Set this to the prefetch count to let slow transports work on"
+        " every message in the prefetch window at once.",
+        default=1, static=True)
 
 
 class Transport(Worker):
@@ -164,9 +169,11 @@ class Transport(Worker):
 
     @inlineCallbacks
     def setup_transport_connection(self):
+        config = self.get_static_config()
         self.message_consumer = yield self.consume(
             self.get_rkey('outbound'), self._process_message,
-            message_class=TransportUserMessage, paused=True)
+            message_class=TransportUserMessage, paused=True,
+            concurrency=config.amqp_consumer_concurrency)
         self._consumers.append(self.message_consumer)
 
         # Set up publishers
@@ -180,7 +187,7 @@ class Transport(Worker):
             failure_code = getattr(exception, "failure_code",
                                    FailureMessage.FC_UNSPECIFIED)
             failure_msg = FailureMessage(
-                    message=message.payload, failure_code=failure_code,
+                    message=dict(message.payload), failure_code=failure_code,
                     reason=traceback)
             d = self._middlewares.apply_publish("failure", failure_msg,
                                                 self.transport_name)
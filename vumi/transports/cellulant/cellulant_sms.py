@@ -5,7 +5,6 @@ from urllib import urlencode
 
 from twisted.internet.defer import inlineCallbacks
 
-from vumi.utils import http_request_full
 from vumi.errors import ConfigError
 from vumi import log
 from vumi.config import ConfigDict, ConfigText
@@ -65,7 +64,7 @@ class CellulantSmsTransport(HttpRpcTransport):
         log.msg("Sending outbound message: %s" % (message,))
         url = '%s?%s' % (self._outbound_url, urlencode(params))
         log.msg("Making HTTP request: %s" % (url,))
-        response = yield http_request_full(url, '', method='GET')
+        response = yield self.http_dispatcher.request(url, '', method='GET')
         log.msg("Response: (%s) %r" % (response.code, response.delivered_body))
         content = response.delivered_body.strip()
 
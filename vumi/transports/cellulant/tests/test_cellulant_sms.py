@@ -73,7 +73,11 @@ class TestCellulantSmsTransport(TransportTestCase):
     def test_health(self):
         result = yield http_request(
             self.transport_url + "health", "", method='GET')
-        self.assertEqual(json.loads(result), {'pending_requests': 0})
+        self.assertEqual(json.loads(result), {
+            'pending_requests': 0,
+            'timed_out_requests': 0,
+            'timeout_rate': None,
+        })
 
     @inlineCallbacks
     def test_inbound(self):
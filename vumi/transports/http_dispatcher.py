@@ -0,0 +1,211 @@
+# -*- test-case-name: vumi.transports.tests.test_http_dispatcher -*-
+
+"""Rate and concurrency limited outbound HTTP requests for transports."""
+
+import random
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    DeferredSemaphore, Deferred, succeed, maybeDeferred)
+from twisted.internet.error import ConnectError
+
+from vumi import log
+from vumi.utils import http_request_full
+
+
+class OutboundHttpDispatcher(object):
+    """Makes a transport's outbound HTTP requests.
+
+    Requests are limited to `max_in_flight` at a time and to `rate_limit`
+    a second. Requests that fail to connect, or that get a response with
+    one of the `retry_codes`, are retried after a randomised, growing
+    delay.
+
+    If a message consumer is given, it's paused while `max_queued`
+    requests are waiting to be sent and unpaused once they've all gone,
+    so that the transport stops taking messages off the queue faster than
+    it can send them. A consumer that is already paused is left alone,
+    and one that has been unpaused by something else isn't unpaused
+    again.
+
+    :param int max_in_flight:
+        The most requests to have in progress at once. If `None`, there's
+        no limit.
+    :param float rate_limit:
+        The most requests to start a second. If `None`, there's no limit.
+    :param int burst:
+        The number of requests that may be started at once after a quiet
+        period without exceeding the rate limit. Defaults to one second's
+        worth.
+    :param int max_retries:
+        The number of times to retry a request.
+    :param float retry_delay:
+        The delay before the first retry. Each retry after that waits
+        twice as long, and every delay is scaled by a random factor
+        between 0.5 and 1.5.
+    :param retry_codes:
+        The HTTP response codes to retry on.
+    :param int max_queued:
+        The number of waiting requests at which the consumer is paused.
+        Defaults to `max_in_flight`.
+    :param consumer:
+        The message consumer to pause, or `None`.
+    :param pool:
+        The :class:`vumi.utils.HttpConnectionPool` to make requests with,
+        or `None`.
+    :param clock:
+        The clock to schedule retries and rate limiting with. Defaults
+        to the reactor.
+    """
+
+    DEFAULT_RETRY_DELAY = 1.0
+    DEFAULT_RETRY_CODES = (429, 503)
+
+    def __init__(self, max_in_flight=None, rate_limit=None, burst=None,
+                 max_retries=0, retry_delay=None, retry_codes=None,
+                 max_queued=None, consumer=None, pool=None, clock=None):
+        self.max_in_flight = max_in_flight
+        self.rate_limit = rate_limit
+        self.burst = burst or max(1, rate_limit or 1)
+        self.max_retries = max_retries
+        self.retry_delay = (retry_delay if retry_delay is not None
+                            else self.DEFAULT_RETRY_DELAY)
+        self.retry_codes = frozenset(retry_codes if retry_codes is not None
+                                     else self.DEFAULT_RETRY_CODES)
+        self.max_queued = max_queued or max_in_flight
+        self.consumer = consumer
+        self.pool = pool
+        self.clock = clock if clock is not None else reactor
+
+        self._slots = None
+        if max_in_flight is not None:
+            self._slots = DeferredSemaphore(max_in_flight)
+        self._tokens = float(self.burst)
+        self._tokens_updated = None
+        self.in_flight = 0
+        self.paused = False
+        self.flow_d = succeed(None)
+
+    @classmethod
+    def from_config(cls, config, **kw):
+        """Construct a dispatcher from a dictionary of options.
+
+        Extra keyword arguments (e.g. `consumer` and `pool`) are passed
+        through to the constructor.
+        """
+        options = dict((key, config[key]) for key in (
+            'max_in_flight', 'rate_limit', 'burst', 'max_retries',
+            'retry_delay', 'retry_codes', 'max_queued') if key in config)
+        options.update(kw)
+        return cls(**options)
+
+    @property
+    def queued(self):
+        """The number of requests waiting for a free slot."""
+        if self._slots is None:
+            return 0
+        return len(self._slots.waiting)
+
+    def request(self, url, data=None, headers={}, method='POST',
+                timeout=None, data_limit=None):
+        """Make an HTTP request once the limits allow it.
+
+        Takes the same arguments as :func:`vumi.utils.http_request_full`.
+
+        :returns:
+            A deferred that fires with the response.
+        """
+        return self._attempt(0, url, data, headers, method, timeout,
+                             data_limit)
+
+    def _attempt(self, attempt, *args):
+        d = self._acquire()
+        self._check_saturation()
+        d.addCallback(lambda _: self._take_token())
+        d.addCallback(lambda _: self._send(*args))
+        d.addBoth(self._release)
+        d.addCallbacks(self._check_response, self._check_failure,
+                       callbackArgs=(attempt, args),
+                       errbackArgs=(attempt, args))
+        return d
+
+    def _acquire(self):
+        if self._slots is None:
+            return succeed(None)
+        return self._slots.acquire()
+
+    def _release(self, result):
+        if self._slots is not None:
+            self._slots.release()
+        self._check_saturation()
+        return result
+
+    def _send(self, url, data, headers, method, timeout, data_limit):
+        self.in_flight += 1
+        d = http_request_full(url, data=data, headers=headers,
+                              method=method, timeout=timeout,
+                              data_limit=data_limit, pool=self.pool)
+
+        def finished(result):
+            self.in_flight -= 1
+            return result
+
+        return d.addBoth(finished)
+
+    def _take_token(self):
+        """Return a deferred that fires when the rate limit allows another
+        request to start.
+
+        Each request takes a token as soon as it asks for one, even if that
+        leaves the bucket in debt, and then waits for the debt to be repaid.
+        This keeps waiting requests in order.
+        """
+        if self.rate_limit is None:
+            return succeed(None)
+        now = self.clock.seconds()
+        if self._tokens_updated is not None:
+            self._tokens = min(
+                self.burst,
+                self._tokens + (now - self._tokens_updated) * self.rate_limit)
+        self._tokens_updated = now
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return succeed(None)
+        d = Deferred()
+        self.clock.callLater(-self._tokens / self.rate_limit, d.callback, None)
+        return d
+
+    def _check_saturation(self):
+        if self.consumer is None or self.max_queued is None:
+            return
+        if not self.paused and self.queued >= self.max_queued:
+            if self.consumer.paused:
+                # Whoever paused it will unpause it.
+                return
+            self.paused = True
+            self._change_flow(self.consumer.pause)
+        elif self.paused and self.queued == 0:
+            self.paused = False
+            if self.consumer.paused:
+                self._change_flow(self.consumer.unpause)
+
+    def _change_flow(self, func):
+        d = maybeDeferred(func)
+        d.addErrback(log.err, "Error pausing or unpausing consumer")
+        self.flow_d = d
+
+    def _retry_later(self, attempt, args):
+        delay = self.retry_delay * (2 ** attempt) * random.uniform(0.5, 1.5)
+        d = Deferred()
+        self.clock.callLater(delay, d.callback, None)
+        return d.addCallback(lambda _: self._attempt(attempt + 1, *args))
+
+    def _check_response(self, response, attempt, args):
+        if response.code in self.retry_codes and attempt < self.max_retries:
+            return self._retry_later(attempt, args)
+        return response
+
+    def _check_failure(self, failure, attempt, args):
+        if failure.check(ConnectError) and attempt < self.max_retries:
+            return self._retry_later(attempt, args)
+        return failure
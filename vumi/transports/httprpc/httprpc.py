@@ -1,16 +1,19 @@
 # -*- test-case-name: vumi.transports.httprpc.tests.test_httprpc -*-
 
 import json
+import heapq
 
 from twisted.internet.defer import inlineCallbacks
 from twisted.internet import reactor
-from twisted.internet.task import LoopingCall
 from twisted.web import http
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 
 from vumi.transports.base import Transport
-from vumi.config import ConfigText, ConfigInt, ConfigBool, ConfigError
+from vumi.config import (
+    ConfigText, ConfigInt, ConfigBool, ConfigDict, ConfigError)
+from vumi.utils import HttpConnectionPool
+from vumi.transports.http_dispatcher import OutboundHttpDispatcher
 from vumi import log
 
 
@@ -27,13 +30,18 @@ class HttpRpcTransportConfig(Transport.CONFIG_CLASS):
     health_path = ConfigText(
         "The path to listen for downstream health checks on"
         " (useful with HAProxy)", default='health', static=True)
+    request_cleanup = ConfigBool(
+        "Whether old connections should manually be timed out. Requests are"
+        " timed out as soon as they've waited `request_timeout` seconds."
+        " `False` disables the request cleanup meaning that all request"
+        " objects will be kept in memory until the server is restarted,"
+        " regardless if the remote side has dropped the connection or not."
+        " Defaults to `True`.",
+        default=True, static=True)
     request_cleanup_interval = ConfigInt(
-        "How often should we actively look for old connections that should"
-        " manually be timed out. Anything less than `1` disables the request"
-        " cleanup meaning that all request objects will be kept in memory"
-        " until the server is restarted, regardless if the remote side has"
-        " dropped the connection or not. Defaults to 5 seconds.",
-        default=5, static=True)
+        "Deprecated, use `request_cleanup` instead. Anything less than `1`"
+        " disables the request cleanup. Other values enable it; the interval"
+        " itself is ignored.", static=True)
     request_timeout = ConfigInt(
         "How long should we wait for the remote side generating the response"
         " for this synchronous operation to come back. Any connection that has"
@@ -54,6 +62,19 @@ class HttpRpcTransportConfig(Transport.CONFIG_CLASS):
         " nor in IGNORED_FIELDS will raise an error. If 'permissive' then no"
         " error is raised as long as all the EXPECTED_FIELDS are present.",
         default='strict', static=True)
+    http_connection_pool = ConfigDict(
+        "Options for a pool of persistent connections for outbound HTTP"
+        " requests. May contain `max_connections_per_host`,"
+        " `max_persistent_per_host`, `idle_timeout` and `metrics_prefix`"
+        " (to publish the connection reuse rate). If this isn't set, each"
+        " outbound request uses a new connection.", static=True)
+    outbound_http = ConfigDict(
+        "Limits for outbound HTTP requests. May contain `max_in_flight`,"
+        " `rate_limit` (requests per second), `burst`, `max_retries`,"
+        " `retry_delay`, `retry_codes` and `max_queued`. The message"
+        " consumer is paused while `max_queued` requests are waiting to be"
+        " sent. See :class:`vumi.transports.http_dispatcher."
+        "OutboundHttpDispatcher`.", default={}, static=True)
 
 
 class HttpRpcHealthResource(Resource):
@@ -119,7 +140,14 @@ class HttpRpcTransport(Transport):
         self.request_timeout_status_code = config.request_timeout_status_code
         self.noisy = config.noisy
         self.request_timeout_body = config.request_timeout_body
-        self.gc_requests_interval = config.request_cleanup_interval
+        self.request_cleanup = config.request_cleanup
+        if 'request_cleanup_interval' in self.config:
+            log.msg("NOTE: 'request_cleanup_interval' in config is"
+                    " deprecated. Use 'request_cleanup' instead.")
+            if 'request_cleanup' not in self.config:
+                self.request_cleanup = config.request_cleanup_interval >= 1
+        self.http_connection_pool_config = config.http_connection_pool
+        self.outbound_http_config = config.outbound_http
         self._validation_mode = config.validation_mode
         if self._validation_mode not in self.KNOWN_VALIDATION_MODES:
             raise ConfigError('Invalid validation mode: %s' % (
@@ -139,10 +167,20 @@ class HttpRpcTransport(Transport):
     @inlineCallbacks
     def setup_transport(self):
         self._requests = {}
-        self.request_gc = LoopingCall(self.manually_close_requests)
+        # A heap of (deadline, request_id) pairs. Entries for requests that
+        # have finished are skipped when they reach the top.
+        self._request_deadlines = []
+        self._request_expiry_call = None
+        self.requests_finished = 0
+        self.requests_timed_out = 0
+        self.http_pool = HttpConnectionPool.from_config(
+            self.http_connection_pool_config)
+        if self.http_pool is not None:
+            yield self.http_pool.start_metrics(self)
+        self.http_dispatcher = OutboundHttpDispatcher.from_config(
+            self.outbound_http_config, consumer=self.message_consumer,
+            pool=self.http_pool)
         self.clock = self.get_clock()
-        self.request_gc.clock = self.clock
-        self.request_gc.start(self.gc_requests_interval)
 
         # start receipt web resource
         self.web_resource = yield self.start_web_resources(
@@ -155,8 +193,11 @@ class HttpRpcTransport(Transport):
     @inlineCallbacks
     def teardown_transport(self):
         yield self.web_resource.loseConnection()
-        if self.request_gc.running:
-            self.request_gc.stop()
+        if (self._request_expiry_call is not None
+                and self._request_expiry_call.active()):
+            self._request_expiry_call.cancel()
+        if self.http_pool is not None:
+            yield self.http_pool.closeCachedConnections()
 
     def get_clock(self):
         """
@@ -187,24 +228,74 @@ class HttpRpcTransport(Transport):
         return missing_fields
 
     def manually_close_requests(self):
-        for request_id, (timestamp, request) in self._requests.items():
-            if timestamp < self.clock.seconds() - self.request_timeout:
+        now = self.clock.seconds()
+        deadlines = self._request_deadlines
+        while deadlines and deadlines[0][0] <= now:
+            deadline, request_id = heapq.heappop(deadlines)
+            if self._request_deadline(request_id) == deadline:
                 self.close_request(request_id)
+        self._schedule_request_expiry()
+
+    def _request_deadline(self, request_id):
+        if request_id in self._requests:
+            timestamp, _ = self._requests[request_id]
+            return timestamp + self.request_timeout
+
+    def _schedule_request_expiry(self):
+        """Arrange for the earliest pending request to be timed out at its
+        deadline.
+        """
+        if not self.request_cleanup or not self._request_deadlines:
+            return
+        deadline = self._request_deadlines[0][0]
+        call = self._request_expiry_call
+        if call is not None and call.active():
+            if call.getTime() <= deadline:
+                return
+            call.cancel()
+        self._request_expiry_call = self.clock.callLater(
+            max(0, deadline - self.clock.seconds()),
+            self.manually_close_requests)
+
+    def _compact_request_deadlines(self):
+        """Drop the deadlines of finished requests if they make up most of
+        the heap.
+        """
+        if len(self._request_deadlines) <= 2 * len(self._requests) + 100:
+            return
+        self._request_deadlines = [
+            (timestamp + self.request_timeout, request_id)
+            for request_id, (timestamp, _) in self._requests.iteritems()]
+        heapq.heapify(self._request_deadlines)
 
     def close_request(self, request_id):
         log.warning('Timing out %s' % (request_id,))
+        self.requests_timed_out += 1
         self.finish_request(request_id, self.request_timeout_body,
             self.request_timeout_status_code)
 
+    def timeout_rate(self):
+        """Return the fraction of finished requests that timed out, or
+        `None` if no requests have finished yet.
+        """
+        if not self.requests_finished:
+            return None
+        return float(self.requests_timed_out) / self.requests_finished
+
     def get_health_response(self):
         return json.dumps({
-            'pending_requests': len(self._requests)
+            'pending_requests': len(self._requests),
+            'timed_out_requests': self.requests_timed_out,
+            'timeout_rate': self.timeout_rate(),
         })
 
     def set_request(self, request_id, request_object, timestamp=None):
         if timestamp is None:
             timestamp = self.clock.seconds()
         self._requests[request_id] = (timestamp, request_object)
+        heapq.heappush(self._request_deadlines,
+                       (timestamp + self.request_timeout, request_id))
+        self._schedule_request_expiry()
 
     def get_request(self, request_id):
         if request_id in self._requests:
@@ -213,6 +304,7 @@ class HttpRpcTransport(Transport):
 
     def remove_request(self, request_id):
         del self._requests[request_id]
+        self._compact_request_deadlines()
 
     def emit(self, msg):
         if self.noisy:
@@ -251,6 +343,7 @@ class HttpRpcTransport(Transport):
             request.write(data)
             request.finish()
             self.remove_request(request_id)
+            self.requests_finished += 1
             response_id = "%s:%s:%s" % (request.client.host,
                                         request.client.port,
                                         Transport.generate_message_id())
@@ -2,6 +2,7 @@ import json
 
 from twisted.internet.defer import inlineCallbacks
 from twisted.internet.task import Clock
+from twisted.web.http_headers import Headers
 
 from vumi.utils import http_request, http_request_full
 from vumi.transports.tests.test_base import TransportTestCase
@@ -9,6 +10,28 @@ from vumi.transports.httprpc import HttpRpcTransport
 from vumi.message import TransportUserMessage
 
 
+class DummyRequest(object):
+    """Just enough of a request for timing out."""
+
+    class client(object):
+        host = '127.0.0.1'
+        port = 0
+
+    def __init__(self):
+        self.responseHeaders = Headers()
+        self.written = []
+        self.code = None
+
+    def setResponseCode(self, code):
+        self.code = code
+
+    def write(self, data):
+        self.written.append(data)
+
+    def finish(self):
+        pass
+
+
 class OkTransport(HttpRpcTransport):
 
     def handle_raw_inbound_message(self, msgid, request):
@@ -51,7 +74,9 @@ class TestTransport(TransportTestCase):
         result = yield http_request(self.transport_url + "health", "",
                                     method='GET')
         self.assertEqual(json.loads(result), {
-            'pending_requests': 0
+            'pending_requests': 0,
+            'timed_out_requests': 0,
+            'timeout_rate': None,
         })
 
     @inlineCallbacks
@@ -86,6 +111,65 @@ class TestTransport(TransportTestCase):
         self.assertEqual(response.delivered_body, 'I am a teapot')
         self.assertEqual(response.code, 418)
 
+    @inlineCallbacks
+    def test_timeout_at_deadline(self):
+        d = http_request_full(self.transport_url + "foo", '', method='GET')
+        yield self.wait_for_dispatched_messages(1)
+        self.clock.advance(9.9)
+        self.assertEqual(self.transport.requests_timed_out, 0)
+        self.clock.advance(0.2)
+        self.assertEqual(self.transport.requests_timed_out, 1)
+        response = yield d
+        self.assertEqual(response.code, 418)
+
+    @inlineCallbacks
+    def test_health_after_timeout(self):
+        d = http_request_full(self.transport_url + "foo", '', method='GET')
+        [msg] = yield self.wait_for_dispatched_messages(1)
+        self.clock.advance(10.1)
+        yield d
+
+        d = http_request_full(self.transport_url + "foo", '', method='GET')
+        [_, msg] = yield self.wait_for_dispatched_messages(2)
+        rep = TransportUserMessage(**msg.payload).reply("OK")
+        yield self.dispatch(rep)
+        yield d
+
+        result = yield http_request(self.transport_url + "health", "",
+                                    method='GET')
+        self.assertEqual(json.loads(result), {
+            'pending_requests': 0,
+            'timed_out_requests': 1,
+            'timeout_rate': 0.5,
+        })
+
+    @inlineCallbacks
+    def test_request_cleanup_disabled(self):
+        transport = yield self.get_transport(
+            {'web_path': "foo", 'request_cleanup': False}, start=False)
+        transport._validate_config()
+        self.assertFalse(transport.request_cleanup)
+
+    @inlineCallbacks
+    def test_request_cleanup_interval_deprecated(self):
+        transport = yield self.get_transport(
+            {'web_path': "foo", 'request_cleanup_interval': 0}, start=False)
+        transport._validate_config()
+        self.assertFalse(transport.request_cleanup)
+
+        transport = yield self.get_transport(
+            {'web_path': "foo", 'request_cleanup_interval': 5}, start=False)
+        transport._validate_config()
+        self.assertTrue(transport.request_cleanup)
+
+    def test_finished_requests_not_timed_out(self):
+        self.transport.set_request('req1', DummyRequest(), timestamp=0)
+        self.transport.remove_request('req1')
+        self.transport.set_request('req2', DummyRequest(), timestamp=5)
+        self.clock.advance(20)
+        self.assertEqual(self.transport.requests_timed_out, 1)
+        self.assertEqual(self.transport._requests, {})
+
 
 class JSONTransport(HttpRpcTransport):
 
@@ -8,7 +8,7 @@ from twisted.web import http
 from twisted.internet.defer import inlineCallbacks
 
 from vumi.transports.httprpc import HttpRpcTransport
-from vumi.utils import http_request_full, get_operator_name
+from vumi.utils import get_operator_name
 
 
 class MediaEdgeGSMTransport(HttpRpcTransport):
@@ -66,7 +66,8 @@ class MediaEdgeGSMTransport(HttpRpcTransport):
             }
 
             url = '%s?%s' % (self._outbound_url, urlencode(params))
-            response = yield http_request_full(url, '', method='GET')
+            response = yield self.http_dispatcher.request(
+                url, '', method='GET')
             log.msg("Response: (%s) %r" % (response.code,
                 response.delivered_body))
             if response.code == http.OK:
@@ -7,7 +7,6 @@ from twisted.python import log
 from twisted.web import http
 from twisted.internet.defer import inlineCallbacks
 
-from vumi.utils import http_request_full
 from vumi.transports.httprpc import HttpRpcTransport
 
 
@@ -51,7 +50,7 @@ class MediafoneTransport(HttpRpcTransport):
         log.msg("Sending outbound message: %s" % (message,))
         url = '%s?%s' % (self._outbound_url, urlencode(params))
         log.msg("Making HTTP request: %s" % (url,))
-        response = yield http_request_full(url, '', method='GET')
+        response = yield self.http_dispatcher.request(url, '', method='GET')
         log.msg("Response: (%s) %r" % (response.code, response.delivered_body))
         if response.code == http.OK:
             yield self.publish_ack(user_message_id=message['message_id'],
@@ -17,6 +17,7 @@ from smpp.pdu_inspector import (
     MultipartMessage, detect_multipart, multipart_key)
 
 from vumi import log
+from vumi.persist.redis_base import RedisScript
 
 
 def unpacked_pdu_opts(unpacked_pdu):
@@ -40,6 +41,27 @@ def update_ussd_pdu(sm_pdu, continue_session, session_info=None):
     return sm_pdu
 
 
+def _reset_seq_counter_emulation(redis, keys, args):
+    [seq_key] = keys
+    seq = redis.get(seq_key)
+    if seq is not None and int(seq) >= int(args[0]):
+        redis.delete(seq_key)
+        return 1
+    return 0
+
+
+# Deletes the sequence number key if it has reached the threshold given as
+# the only argument. The next INCR will recreate it.
+RESET_SEQ_COUNTER_SCRIPT = RedisScript("""
+local seq = tonumber(redis.call('GET', KEYS[1]))
+if seq and seq >= tonumber(ARGV[1]) then
+    redis.call('DEL', KEYS[1])
+    return 1
+end
+return 0
+""", _reset_seq_counter_emulation)
+
+
 class EsmeTransceiver(Protocol):
     BIND_PDU = BindTransceiver
     CONNECTED_STATE = 'BOUND_TRX'
@@ -85,42 +107,16 @@ class EsmeTransceiver(Protocol):
 
         returnValue(seq)
 
-    @inlineCallbacks
     def _reset_seq_counter(self):
         """Reset the sequence counter in a safe manner.
 
-        NOTE: There is a potential race condition in this implementation. If we
-        acquire the lock and it expires while we still think we hold it, it's
-        possible for the sequence number to be reset by someone else between
-        the final vlue check and the reset call. This seems like a very
-        unlikely situation, so we'll leave it like that for now.
-
-        A better solution is to replace this whole method with a lua script
-        that we send to redis, but scripting support is still very new at the
-        time of writing.
+        This runs as a single script on the redis server, so the counter is
+        only reset if it's still outside the allowed range and nobody else
+        can get in between the check and the reset.
         """
-        # SETNX can be used as a lock.
-        locked = yield self.redis.setnx('smpp_last_sequence_number_wrap', 1)
-
-        # If someone crashed in exactly the wrong place, the lock may be
-        # held by someone else but have no expire time. A race condition
-        # here may set the TTL multiple times, but that's fine.
-        if (yield self.redis.ttl('smpp_last_sequence_number_wrap')) < 0:
-            # The TTL only gets set if the lock exists and recently had no TTL.
-            yield self.redis.expire('smpp_last_sequence_number_wrap', 10)
-
-        if not locked:
-            # We didn't actually get the lock, so our job is done.
-            return
-
-        if (yield self.redis.get('smpp_last_sequence_number')) < 0xFFFF0000:
-            # Our stored sequence number is no longer outside the allowed
-            # range, so someone else must have reset it before we got the lock.
-            return
-
-        # We reset the counter by deleting the key. The next INCR will recreate
-        # it for us.
-        yield self.redis.delete('smpp_last_sequence_number')
+        return self.redis.run_script(
+            RESET_SEQ_COUNTER_SCRIPT, ['smpp_last_sequence_number'],
+            [0xFFFF0000])
 
     def pop_data(self):
         data = None
@@ -148,6 +148,7 @@ class SmppTransport(Transport):
                 )
         r_prefix = self.config.get('split_bind_prefix', default_prefix)
         redis = yield TxRedisManager.from_config(r_config)
+        yield redis.start_metrics(self)
         self.redis = redis.sub_manager(r_prefix)
 
         self.r_message_prefix = "message_json"
@@ -316,7 +317,7 @@ class SmppTransport(Transport):
             yield self.r_delete_message(sent_sms_id)
             yield self.publish_nack(sent_sms_id, reason)
             yield self.failure_publisher.publish_message(FailureMessage(
-                    message=error_message.payload,
+                    message=dict(error_message.payload),
                     failure_code=None,
                     reason=reason))
 
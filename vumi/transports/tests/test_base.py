@@ -1,7 +1,10 @@
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
 
 from vumi.transports.tests.utils import TransportTestCase
 from vumi.transports.base import Transport
+from vumi.message import CompactTransportUserMessage
 
 
 class BaseTransportTestCase(TransportTestCase):
@@ -71,6 +74,18 @@ class BaseTransportTestCase(TransportTestCase):
             ['mw1', 'failure', self.transport_name],
             ])
 
+    @inlineCallbacks
+    def test_send_failure_for_compact_message(self):
+        transport = yield self.get_transport({'compact_messages': True})
+        orig_msg = self.mkmsg_out()
+        orig_msg['timestamp'] = 0
+        compact_msg = CompactTransportUserMessage.from_message(orig_msg)
+        yield transport.send_failure(
+            compact_msg, ValueError(), "dummy_traceback")
+        [failure] = self.get_dispatched_failures()
+        self.assertEqual(failure['message'], orig_msg.payload)
+        self.assertEqual(failure['reason'], "dummy_traceback")
+
     @inlineCallbacks
     def test_middleware_for_outbound_messages(self):
         transport = yield self.get_transport(self.TEST_MIDDLEWARE_CONFIG)
@@ -100,3 +115,38 @@ class BaseTransportTestCase(TransportTestCase):
         self.assertTrue(transport._consumers)
         for consumer in transport._consumers:
             self.assertFalse(consumer.channel.qos_prefetch_count)
+
+    @inlineCallbacks
+    def test_outbound_consumer_concurrency(self):
+        transport = yield self.get_transport({
+            'amqp_prefetch_count': 2,
+            'amqp_consumer_concurrency': 2,
+            })
+        self.assertEqual(transport.message_consumer.concurrency, 2)
+        pending = []
+
+        def handle_outbound_message(msg):
+            d = Deferred()
+            pending.append((msg, d))
+            return d
+
+        transport.handle_outbound_message = handle_outbound_message
+        msgs = [self.mkmsg_out(message_id=str(i)) for i in range(3)]
+        for msg in msgs:
+            self._amqp.publish_message('vumi', self.rkey('outbound'), msg)
+        delivered = self._amqp.kick_delivery()
+        yield deferLater(reactor, 0, lambda: None)
+        self.assertEqual([m['message_id'] for m, _ in pending], ['0', '1'])
+        pending[1][1].callback(None)
+        yield deferLater(reactor, 0, lambda: None)
+        self.assertEqual([m['message_id'] for m, _ in pending],
+                         ['0', '1', '2'])
+        pending[0][1].callback(None)
+        pending[2][1].callback(None)
+        yield delivered
+        self.assertEqual(transport.message_consumer.channel.unacked, [])
+
+    @inlineCallbacks
+    def test_outbound_consumer_concurrency_default(self):
+        transport = yield self.get_transport({})
+        self.assertEqual(transport.message_consumer.concurrency, 1)
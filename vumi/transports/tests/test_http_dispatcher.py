@@ -0,0 +1,242 @@
+"""Tests for vumi.transports.http_dispatcher."""
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import Deferred, succeed, fail
+from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.task import Clock
+
+from vumi.transports import http_dispatcher
+from vumi.transports.http_dispatcher import OutboundHttpDispatcher
+
+
+class DummyResponse(object):
+    def __init__(self, code):
+        self.code = code
+
+
+class DummyConsumer(object):
+    def __init__(self):
+        self.calls = []
+        self.paused = False
+        self.result = None
+
+    def pause(self):
+        self.calls.append('pause')
+        self.paused = True
+        return self.result
+
+    def unpause(self):
+        self.calls.append('unpause')
+        self.paused = False
+        return self.result
+
+
+class OutboundHttpDispatcherTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.requests = []
+        self.patch(http_dispatcher, 'http_request_full',
+                   self.dummy_http_request)
+
+    def dummy_http_request(self, url, **kw):
+        d = Deferred()
+        self.requests.append((url, kw, d))
+        return d
+
+    def mk_dispatcher(self, **kw):
+        kw.setdefault('clock', self.clock)
+        return OutboundHttpDispatcher(**kw)
+
+    def request_urls(self):
+        return [url for url, _kw, _d in self.requests]
+
+    def respond(self, index, code=200):
+        response = DummyResponse(code)
+        self.requests[index][2].callback(response)
+        return response
+
+    def test_from_config(self):
+        pool = object()
+        dispatcher = OutboundHttpDispatcher.from_config({
+            'max_in_flight': 2,
+            'rate_limit': 10,
+            'burst': 3,
+            'max_retries': 4,
+            'retry_delay': 0.5,
+            'retry_codes': [500],
+            'max_queued': 5,
+        }, pool=pool)
+        self.assertEqual(dispatcher.max_in_flight, 2)
+        self.assertEqual(dispatcher.rate_limit, 10)
+        self.assertEqual(dispatcher.burst, 3)
+        self.assertEqual(dispatcher.max_retries, 4)
+        self.assertEqual(dispatcher.retry_delay, 0.5)
+        self.assertEqual(dispatcher.retry_codes, frozenset([500]))
+        self.assertEqual(dispatcher.max_queued, 5)
+        self.assertEqual(dispatcher.pool, pool)
+
+    def test_from_config_defaults(self):
+        dispatcher = OutboundHttpDispatcher.from_config({})
+        self.assertEqual(dispatcher.max_in_flight, None)
+        self.assertEqual(dispatcher.rate_limit, None)
+        self.assertEqual(dispatcher.max_retries, 0)
+        self.assertEqual(dispatcher.retry_codes, frozenset([429, 503]))
+
+    def test_request(self):
+        dispatcher = self.mk_dispatcher()
+        d = dispatcher.request('http://example.com/', 'data', method='PUT',
+                               timeout=5)
+        [(url, kw, _)] = self.requests
+        self.assertEqual(url, 'http://example.com/')
+        self.assertEqual(kw, {
+            'data': 'data', 'headers': {}, 'method': 'PUT', 'timeout': 5,
+            'data_limit': None, 'pool': None,
+        })
+        response = self.respond(0)
+        self.assertEqual(self.successResultOf(d), response)
+
+    def test_max_in_flight(self):
+        dispatcher = self.mk_dispatcher(max_in_flight=2)
+        for i in range(3):
+            dispatcher.request('http://example.com/%d' % (i,))
+        self.assertEqual(self.request_urls(),
+                         ['http://example.com/0', 'http://example.com/1'])
+        self.assertEqual(dispatcher.in_flight, 2)
+        self.assertEqual(dispatcher.queued, 1)
+
+        self.respond(0)
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(dispatcher.in_flight, 2)
+        self.assertEqual(dispatcher.queued, 0)
+
+    def test_rate_limit(self):
+        dispatcher = self.mk_dispatcher(rate_limit=2, burst=1)
+        for i in range(3):
+            dispatcher.request('http://example.com/%d' % (i,))
+        self.assertEqual(len(self.requests), 1)
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.requests), 2)
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(self.request_urls(), [
+            'http://example.com/0', 'http://example.com/1',
+            'http://example.com/2'])
+
+    def test_rate_limit_burst(self):
+        dispatcher = self.mk_dispatcher(rate_limit=1, burst=2)
+        for i in range(3):
+            dispatcher.request('http://example.com/%d' % (i,))
+        self.assertEqual(len(self.requests), 2)
+        self.clock.advance(1)
+        self.assertEqual(len(self.requests), 3)
+
+    def test_retry_on_connection_failure(self):
+        dispatcher = self.mk_dispatcher(max_retries=1, retry_delay=1)
+        d = dispatcher.request('http://example.com/')
+        self.requests[0][2].errback(ConnectionRefusedError())
+        self.assertEqual(len(self.requests), 1)
+        self.clock.advance(1.5)
+        self.assertEqual(len(self.requests), 2)
+        response = self.respond(1)
+        self.assertEqual(self.successResultOf(d), response)
+
+    def test_retries_exhausted(self):
+        dispatcher = self.mk_dispatcher(max_retries=1, retry_delay=1)
+        d = dispatcher.request('http://example.com/')
+        self.requests[0][2].errback(ConnectionRefusedError())
+        self.clock.advance(1.5)
+        self.requests[1][2].errback(ConnectionRefusedError())
+        self.failureResultOf(d).trap(ConnectionRefusedError)
+        self.clock.advance(10)
+        self.assertEqual(len(self.requests), 2)
+
+    def test_no_retry_on_other_failures(self):
+        dispatcher = self.mk_dispatcher(max_retries=1)
+        d = dispatcher.request('http://example.com/')
+        self.requests[0][2].errback(ValueError("bad"))
+        self.failureResultOf(d).trap(ValueError)
+
+    def test_retry_on_response_code(self):
+        dispatcher = self.mk_dispatcher(max_retries=2, retry_delay=1)
+        d = dispatcher.request('http://example.com/')
+        self.respond(0, code=503)
+        self.clock.advance(1.5)
+        self.respond(1, code=503)
+        self.clock.advance(3)
+        response = self.respond(2, code=503)
+        self.assertEqual(self.successResultOf(d), response)
+        self.clock.advance(10)
+        self.assertEqual(len(self.requests), 3)
+
+    def test_pause_consumer_when_saturated(self):
+        consumer = DummyConsumer()
+        dispatcher = self.mk_dispatcher(max_in_flight=1, max_queued=2,
+                                        consumer=consumer)
+        for i in range(3):
+            dispatcher.request('http://example.com/%d' % (i,))
+        self.assertEqual(consumer.calls, ['pause'])
+
+        self.respond(0)
+        self.assertEqual(consumer.calls, ['pause'])
+        self.respond(1)
+        self.assertEqual(consumer.calls, ['pause', 'unpause'])
+        self.respond(2)
+        self.assertEqual(consumer.calls, ['pause', 'unpause'])
+
+    def test_leave_consumer_paused_by_others(self):
+        consumer = DummyConsumer()
+        consumer.paused = True
+        dispatcher = self.mk_dispatcher(max_in_flight=1, max_queued=1,
+                                        consumer=consumer)
+        for i in range(2):
+            dispatcher.request('http://example.com/%d' % (i,))
+        self.respond(0)
+        self.respond(1)
+        self.assertEqual(consumer.calls, [])
+        self.assertTrue(consumer.paused)
+
+    def test_no_unpause_if_unpaused_by_others(self):
+        consumer = DummyConsumer()
+        dispatcher = self.mk_dispatcher(max_in_flight=1, max_queued=1,
+                                        consumer=consumer)
+        for i in range(2):
+            dispatcher.request('http://example.com/%d' % (i,))
+        self.assertEqual(consumer.calls, ['pause'])
+        consumer.unpause()
+        self.respond(0)
+        self.assertEqual(consumer.calls, ['pause', 'unpause'])
+
+    def test_pause_failure_logged(self):
+        consumer = DummyConsumer()
+        consumer.result = fail(ValueError("No channel"))
+        dispatcher = self.mk_dispatcher(max_in_flight=1, max_queued=1,
+                                        consumer=consumer)
+        for i in range(2):
+            dispatcher.request('http://example.com/%d' % (i,))
+        self.assertEqual(consumer.calls, ['pause'])
+        self.successResultOf(dispatcher.flow_d)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_no_pause_without_limits(self):
+        consumer = DummyConsumer()
+        dispatcher = self.mk_dispatcher(consumer=consumer)
+        for i in range(3):
+            dispatcher.request('http://example.com/%d' % (i,))
+        self.assertEqual(consumer.calls, [])
+
+
+class FailingHttpRequestTestCase(TestCase):
+
+    def test_slot_released_on_failure(self):
+        response = DummyResponse(200)
+        responses = [fail(ConnectionRefusedError()), succeed(response)]
+        self.patch(http_dispatcher, 'http_request_full',
+                   lambda url, **kw: responses.pop(0))
+        dispatcher = OutboundHttpDispatcher(max_in_flight=1)
+        self.failureResultOf(
+            dispatcher.request('http://example.com/')).trap(
+                ConnectionRefusedError)
+        self.assertEqual(
+            self.successResultOf(dispatcher.request('http://example.com/')),
+            response)
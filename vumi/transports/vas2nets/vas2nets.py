@@ -15,9 +15,10 @@ from twisted.internet.defer import inlineCallbacks
 from twisted.internet.protocol import Protocol
 from twisted.internet.error import ConnectionRefusedError
 
-from vumi.utils import http_request_full, normalize_msisdn, LogFilterSite
+from vumi.utils import normalize_msisdn, LogFilterSite, HttpConnectionPool
 from vumi.transports.base import Transport
 from vumi.transports.failures import TemporaryFailure, PermanentFailure
+from vumi.transports.http_dispatcher import OutboundHttpDispatcher
 from vumi.errors import VumiError
 
 
@@ -209,6 +210,13 @@ class Vas2NetsTransport(Transport):
     def setup_transport(self):
         self._resources = []
         self.config.setdefault('web_health_path', 'health')
+        self.http_pool = HttpConnectionPool.from_config(
+            self.config.get('http_connection_pool'))
+        if self.http_pool is not None:
+            yield self.http_pool.start_metrics(self)
+        self.http_dispatcher = OutboundHttpDispatcher.from_config(
+            self.config.get('outbound_http', {}),
+            consumer=self.message_consumer, pool=self.http_pool)
         resources = [
             self.mkres(ReceiveSMSResource, self.publish_message, 'receive'),
             self.mkres(DeliveryReceiptResource, self.publish_delivery_report,
@@ -256,7 +264,7 @@ class Vas2NetsTransport(Transport):
         log.msg(urlencode(params))
 
         try:
-            response = yield http_request_full(
+            response = yield self.http_dispatcher.request(
                 self.config['url'], urlencode(params), {
                     'User-Agent': ['Vumi Vas2Net Transport'],
                     'Content-Type': ['application/x-www-form-urlencoded'],
@@ -285,7 +293,10 @@ class Vas2NetsTransport(Transport):
                 reason=err_msg)
             raise Vas2NetsTransportError(err_msg)
 
+    @inlineCallbacks
     def stopWorker(self):
         """shutdown"""
+        if getattr(self, 'http_pool', None) is not None:
+            yield self.http_pool.closeCachedConnections()
         if hasattr(self, 'receipt_resource'):
-            return self.receipt_resource.stopListening()
+            yield self.receipt_resource.stopListening()
@@ -5,7 +5,9 @@ import re
 import sys
 import base64
 import pkg_resources
+import urlparse
 import warnings
+import weakref
 from functools import wraps
 
 from zope.interface import implements
@@ -13,7 +15,7 @@ from twisted.internet import defer
 from twisted.internet import reactor, protocol
 from twisted.internet.defer import succeed
 from twisted.python.failure import Failure
-from twisted.web.client import Agent, ResponseDone
+from twisted.web.client import Agent, ResponseDone, HTTPConnectionPool
 from twisted.web.server import Site
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
@@ -112,9 +114,186 @@ class SimplishReceiver(protocol.Protocol):
             self.deferred.errback(reason)
 
 
+class HttpConnectionPool(HTTPConnectionPool):
+    """A pool of persistent HTTP connections for :func:`http_request_full`.
+
+    Idle connections are kept open and reused for later requests to the
+    same host, which saves a TCP (and TLS) handshake for each request.
+
+    :param int max_connections_per_host:
+        The most requests in flight to a single host at a time. Requests
+        over the limit wait for an earlier one to finish.
+    :param int max_persistent_per_host:
+        The most idle connections to keep open for a single host.
+    :param float idle_timeout:
+        The number of seconds an idle connection is kept open for.
+    :param str metrics_prefix:
+        If set, :meth:`start_metrics` publishes the connection reuse rate
+        with this prefix.
+    :param reactor:
+        The reactor to make connections with. Defaults to the global
+        reactor.
+    """
+
+    DEFAULT_MAX_CONNECTIONS_PER_HOST = 10
+    DEFAULT_MAX_PERSISTENT_PER_HOST = 2
+    DEFAULT_IDLE_TIMEOUT = 240
+
+    def __init__(self, max_connections_per_host=None,
+                 max_persistent_per_host=None, idle_timeout=None,
+                 metrics_prefix=None, reactor=reactor):
+        HTTPConnectionPool.__init__(self, reactor, persistent=True)
+        self.max_connections_per_host = (
+            max_connections_per_host or self.DEFAULT_MAX_CONNECTIONS_PER_HOST)
+        self.maxPersistentPerHost = (
+            max_persistent_per_host or self.DEFAULT_MAX_PERSISTENT_PER_HOST)
+        self.cachedConnectionTimeout = (
+            idle_timeout or self.DEFAULT_IDLE_TIMEOUT)
+        self.metrics_prefix = metrics_prefix
+        self.agent = Agent(reactor, pool=self)
+        self._host_semaphores = {}
+        self._known_connections = weakref.WeakKeyDictionary()
+        self.connections_requested = 0
+        self.connections_created = 0
+        self.metric_manager = None
+        self._reuse_metric = None
+
+    @classmethod
+    def from_config(cls, config):
+        """Construct a pool from a dictionary of options, or return `None`
+        if `config` is `None`.
+        """
+        if config is None:
+            return None
+        return cls(
+            max_connections_per_host=config.get('max_connections_per_host'),
+            max_persistent_per_host=config.get('max_persistent_per_host'),
+            idle_timeout=config.get('idle_timeout'),
+            metrics_prefix=config.get('metrics_prefix'))
+
+    def start_metrics(self, worker):
+        """Start a metric manager on `worker` that publishes this pool's
+        connection reuse rate as ``<metrics_prefix>http_pool.reuse_rate``.
+
+        Does nothing if the pool has no `metrics_prefix`. The metric manager
+        is stopped by :meth:`closeCachedConnections`.
+        """
+        if self.metrics_prefix is None:
+            return succeed(None)
+        # vumi.blinkenlights.metrics imports vumi.service, which imports us.
+        from vumi.blinkenlights.metrics import MetricManager, Metric
+
+        def register(metric_manager):
+            self.metric_manager = metric_manager
+            self._reuse_metric = metric_manager.register(
+                Metric('http_pool.reuse_rate'))
+            return metric_manager
+
+        d = worker.start_publisher(MetricManager, self.metrics_prefix)
+        return d.addCallback(register)
+
+    def closeCachedConnections(self):
+        if self.metric_manager is not None:
+            self.metric_manager.stop()
+        return HTTPConnectionPool.closeCachedConnections(self)
+
+    def getConnection(self, key, endpoint):
+        self.connections_requested += 1
+        d = HTTPConnectionPool.getConnection(self, key, endpoint)
+        return d.addCallback(self._count_connection)
+
+    def _count_connection(self, connection):
+        reused = connection in self._known_connections
+        if not reused:
+            self._known_connections[connection] = True
+            self.connections_created += 1
+        if self._reuse_metric is not None:
+            self._reuse_metric.set(1.0 if reused else 0.0)
+        return connection
+
+    def request(self, url, data, headers, method, timeout, data_limit):
+        """Make a request over one of the pool's connections.
+
+        The timeout starts when the request is queued, so it includes any
+        time spent waiting for a free connection.
+        """
+        if timeout is None:
+            return self.run_request(
+                url, _http_request_full, self.agent, url, data, headers,
+                method, None, data_limit, reactor=self._reactor)
+
+        result = defer.Deferred()
+        deadline = self._reactor.seconds() + timeout
+
+        def expire():
+            result.errback(
+                HttpTimeoutError("Timeout while waiting for a connection"))
+
+        def start():
+            if result.called:
+                # We timed out in the queue.
+                return
+            expiry.cancel()
+            d = _http_request_full(
+                self.agent, url, data, headers, method,
+                max(deadline - self._reactor.seconds(), 0), data_limit,
+                reactor=self._reactor)
+            return d.addCallbacks(result.callback, result.errback)
+
+        expiry = self._reactor.callLater(timeout, expire)
+        self.run_request(url, start)
+        return result
+
+    def run_request(self, url, f, *args, **kw):
+        """Call `f` once there are fewer than `max_connections_per_host`
+        requests in flight to the host `url` points at.
+
+        `f` should return a deferred that fires when the request is
+        finished with.
+        """
+        scheme, netloc = urlparse.urlsplit(url)[:2]
+        host_key = (scheme, netloc)
+        semaphore = self._host_semaphores.get(host_key)
+        if semaphore is None:
+            semaphore = defer.DeferredSemaphore(self.max_connections_per_host)
+            self._host_semaphores[host_key] = semaphore
+        return semaphore.run(f, *args, **kw)
+
+    def reuse_rate(self):
+        """Return the fraction of requests that reused an open connection,
+        or `None` if there haven't been any requests yet.
+        """
+        if not self.connections_requested:
+            return None
+        reused = self.connections_requested - self.connections_created
+        return float(reused) / self.connections_requested
+
+    def get_stats(self):
+        return {
+            'requested': self.connections_requested,
+            'created': self.connections_created,
+            'reused': self.connections_requested - self.connections_created,
+            'reuse_rate': self.reuse_rate(),
+        }
+
+
 def http_request_full(url, data=None, headers={}, method='POST',
-                      timeout=None, data_limit=None):
-    agent = Agent(reactor)
+                      timeout=None, data_limit=None, pool=None):
+    """Make an HTTP request and read the whole response body.
+
+    If a :class:`HttpConnectionPool` is given as `pool`, the request is
+    made over one of its connections (and may have to wait for a free
+    one). The timeout includes any time spent waiting. Without a pool a
+    new connection is made and closed afterwards.
+    """
+    if pool is None:
+        return _http_request_full(
+            Agent(reactor), url, data, headers, method, timeout, data_limit)
+    return pool.request(url, data, headers, method, timeout, data_limit)
+
+
+def _http_request_full(agent, url, data, headers, method, timeout,
+                       data_limit, reactor=reactor):
     d = agent.request(method,
                       url,
                       mkheaders(headers),
@@ -158,8 +337,9 @@ def mkheaders(headers):
     return Headers(raw_headers)
 
 
-def http_request(url, data, headers={}, method='POST'):
-    d = http_request_full(url, data, headers=headers, method=method)
+def http_request(url, data, headers={}, method='POST', pool=None):
+    d = http_request_full(url, data, headers=headers, method=method,
+                          pool=pool)
     return d.addCallback(lambda r: r.delivered_body)
 
 